@@ -0,0 +1,185 @@
+"""Deterministic generators of synthetic VCF files and STR tables
+
+The same config and seed always give the same file, so benchmark results of different
+commits are comparable
+"""
+import csv
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+NUCLEOTIDES = ("A", "C", "G", "T")
+
+
+@dataclass
+class SyntheticVCFConfig:
+    """Parameters of a synthetic VCF file
+
+    :param n_samples: number of samples
+    :param n_sites: number of variants. They are spread evenly over `n_chromosomes`
+    :param missing_rate: fraction of missing genotypes
+    :param multiallelic_rate: fraction of sites with two alternative alleles
+    :param n_chromosomes: number of chromosomes, starting from chr1
+    :param sample_prefix: prefix of sample names
+    :param seed: seed of the random number generator
+    """
+
+    n_samples: int = 10
+    n_sites: int = 1000
+    missing_rate: float = 0.01
+    multiallelic_rate: float = 0.02
+    n_chromosomes: int = 2
+    sample_prefix: str = "SYN"
+    seed: int = 0
+
+    @property
+    def samples(self) -> List[str]:
+        return [f"{self.sample_prefix}{i:06d}" for i in range(self.n_samples)]
+
+
+def generate_sites(config: SyntheticVCFConfig) -> Iterator[Tuple[str, int, str, List[str]]]:
+    """Yield (chromosome, position, reference allele, alternative alleles) of sites"""
+    rng = np.random.default_rng(config.seed)
+    sites_per_chromosome = -(-config.n_sites // config.n_chromosomes)
+
+    for i in range(config.n_sites):
+        chromosome = f"chr{i // sites_per_chromosome + 1}"
+        position = (i % sites_per_chromosome + 1) * 100 + int(rng.integers(0, 100))
+        ref, *alts = rng.permutation(len(NUCLEOTIDES))[:3]
+        n_alts = 2 if rng.random() < config.multiallelic_rate else 1
+
+        yield chromosome, position, NUCLEOTIDES[ref], [NUCLEOTIDES[alt] for alt in alts[:n_alts]]
+
+
+def generate_vcf_lines(config: SyntheticVCFConfig) -> Iterator[str]:
+    """Yield lines of a VCF file with genotypes of `config.samples`
+
+    Alternative allele frequencies are drawn from Beta(0.5, 2), so most sites are rare,
+    like in real exomes. Genotypes are unphased
+    """
+    rng = np.random.default_rng(config.seed + 1)
+    chromosomes = [f"chr{i + 1}" for i in range(config.n_chromosomes)]
+
+    yield "##fileformat=VCFv4.2"
+    for chromosome in chromosomes:
+        yield f"##contig=<ID={chromosome}>"
+    yield '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">'
+    yield "\t".join(
+        ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+        + config.samples
+    )
+
+    for i, (chromosome, position, ref, alts) in enumerate(generate_sites(config)):
+        frequency = rng.beta(0.5, 2)
+        genotypes = (rng.random((config.n_samples, 2)) < frequency).astype(int)
+        if len(alts) > 1:
+            genotypes *= rng.integers(1, 3, size=genotypes.shape)
+
+        missing = rng.random(config.n_samples) < config.missing_rate
+        calls = [
+            "./." if is_missing else f"{min(alleles)}/{max(alleles)}"
+            for alleles, is_missing in zip(genotypes, missing)
+        ]
+
+        yield "\t".join(
+            [chromosome, str(position), f"rs{i + 1}", ref, ",".join(alts), ".", "PASS", ".", "GT"]
+            + calls
+        )
+
+
+def generate_genotype_arrays(config: SyntheticVCFConfig) -> Tuple[np.ndarray, np.ndarray]:
+    """Return allele codes of a query of shape (n_sites, 2) and of `config.samples` of
+    shape (n_samples, n_sites, 2) for `vcf_uploading.genotype_metrics`
+
+    Code 0 is the reference allele and 1 is the alternative one with frequencies drawn
+    from Beta(0.5, 2), like in `generate_vcf_lines`. Missing alleles are -1
+    """
+    rng = np.random.default_rng(config.seed + 2)
+    frequencies = rng.beta(0.5, 2, size=config.n_sites)
+
+    alleles = rng.random((config.n_samples + 1, config.n_sites, 2)) < frequencies[:, None]
+    alleles = alleles.astype(np.int16)
+    missing = rng.random((config.n_samples + 1, config.n_sites)) < config.missing_rate
+    alleles[missing] = -1
+
+    return alleles[0], alleles[1:]
+
+
+def write_vcf(path: Path, config: SyntheticVCFConfig) -> Path:
+    with open(path, "w") as f:
+        f.writelines(line + "\n" for line in generate_vcf_lines(config))
+
+    return Path(path)
+
+
+@dataclass
+class SyntheticSTRConfig:
+    """Parameters of a synthetic table with short tandem repeats
+
+    :param n_samples: number of rows
+    :param n_regions: number of STR regions, i.e. columns besides the sample
+    :param missing_rate: fraction of empty cells
+    :param microvariant_rate: fraction of alleles with a partial repeat, e.g. 9.3
+    :param seed: seed of the random number generator
+    """
+
+    n_samples: int = 100
+    n_regions: int = 20
+    missing_rate: float = 0.02
+    microvariant_rate: float = 0.05
+    seed: int = 0
+
+
+def generate_str_rows(config: SyntheticSTRConfig) -> Iterator[List[str]]:
+    """Yield rows of an STR table, starting from the header
+
+    Cells contain one number of repeats or two comma-separated ones for heterozygous calls
+    """
+    rng = np.random.default_rng(config.seed)
+    regions = [f"STR{i + 1}" for i in range(config.n_regions)]
+    typical_repeats = rng.integers(6, 30, size=config.n_regions)
+
+    yield ["Sample"] + regions
+
+    for i in range(config.n_samples):
+        row = [f"STR_SAMPLE{i:06d}"]
+
+        for typical in typical_repeats:
+            if rng.random() < config.missing_rate:
+                row.append("")
+                continue
+
+            alleles = sorted(
+                {
+                    f"{typical + shift}.{rng.integers(1, 4)}"
+                    if rng.random() < config.microvariant_rate
+                    else str(typical + shift)
+                    for shift in rng.integers(-3, 4, size=2)
+                },
+                key=float,
+            )
+            row.append(",".join(alleles))
+
+        yield row
+
+
+def write_str_table(path: Path, config: SyntheticSTRConfig) -> Path:
+    """Write STR table to `path`. Format (xlsx, csv or tsv) is chosen by the extension"""
+    path = Path(path)
+    rows = generate_str_rows(config)
+
+    if path.suffix == ".xlsx":
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in rows:
+            sheet.append(row)
+        workbook.save(path)
+    else:
+        with open(path, "w", newline="") as f:
+            csv.writer(f, delimiter="\t" if path.suffix == ".tsv" else ",").writerows(rows)
+
+    return path
@@ -0,0 +1,71 @@
+import json
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from benchmarks.runner import compare_results, get_environment, run_benchmarks
+from benchmarks.scenarios import SCALES, SCENARIOS
+
+
+class Command(BaseCommand):
+    help = (
+        "Run benchmarks on synthetic data and print JSON with time, peak RSS and number "
+        "of queries of each scenario. By default a temporary database is created for them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+        )
+        parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small"])
+        parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each scenario")
+        parser.add_argument("--output", help="Write results to this file instead of stdout")
+        parser.add_argument(
+            "--compare", help="JSON file with results of another run to compare with"
+        )
+        parser.add_argument(
+            "--in-place",
+            action="store_true",
+            help="Use the configured database instead of a temporary one. Scenarios are run "
+            "in transactions that are rolled back",
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                baseline = json.loads(Path(options["compare"]).read_text())["results"]
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Can't read results from {options['compare']}: {e}")
+
+        old_database_name = connection.settings_dict["NAME"]
+        if not options["in_place"]:
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(
+                MEDIA_ROOT=media_root
+            ):
+                directory = Path(media_root) / "benchmarks"
+                directory.mkdir()
+
+                results = run_benchmarks(
+                    options["scenarios"], options["scales"], directory, repeat=options["repeat"]
+                )
+        finally:
+            if not options["in_place"]:
+                connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        report = {**get_environment(), "database": connection.vendor, "results": results}
+        if baseline is not None:
+            report["comparison"] = compare_results(baseline, results)
+
+        content = json.dumps(report, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(content)
+            self.stderr.write(self.style.SUCCESS(f"Results are written to {options['output']}"))
+        else:
+            self.stdout.write(content)
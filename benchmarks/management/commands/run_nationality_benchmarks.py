@@ -0,0 +1,65 @@
+import json
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from benchmarks.nationality import INPUTS, run_nationality_benchmarks, stub_tools
+from benchmarks.runner import get_environment
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure stages of nationality prediction (write, conversion, admixture, parse) "
+        "on synthetic samples and print JSON. plink and fastNGSadmix are replaced with "
+        "stubs unless --real-tools is given"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--inputs", nargs="+", choices=list(INPUTS), default=list(INPUTS))
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[1000, 10000], help="Numbers of variants"
+        )
+        parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each input")
+        parser.add_argument("--output", help="Write results to this file instead of stdout")
+        parser.add_argument(
+            "--real-tools",
+            action="store_true",
+            help="Use plink and fastNGSadmix from the settings instead of the stubs",
+        )
+        parser.add_argument(
+            "--plink-delay", type=float, default=0, help="Seconds the plink stub sleeps"
+        )
+        parser.add_argument(
+            "--fastngsadmix-delay",
+            type=float,
+            default=0,
+            help="Seconds the fastNGSadmix stub sleeps",
+        )
+
+    def handle(self, *args, **options):
+        use_stubs = not options["real_tools"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_kwargs = dict(
+                inputs=options["inputs"],
+                sizes=options["sizes"],
+                directory=Path(tmp_dir),
+                repeat=options["repeat"],
+                use_stubs=use_stubs,
+            )
+
+            if use_stubs:
+                with stub_tools(options["plink_delay"], options["fastngsadmix_delay"]):
+                    results = run_nationality_benchmarks(**benchmark_kwargs)
+            else:
+                results = run_nationality_benchmarks(**benchmark_kwargs)
+
+        report = {**get_environment(), "stub_tools": use_stubs, "results": results}
+        content = json.dumps(report, indent=2)
+
+        if options["output"]:
+            Path(options["output"]).write_text(content)
+            self.stderr.write(self.style.SUCCESS(f"Results are written to {options['output']}"))
+        else:
+            self.stdout.write(content)
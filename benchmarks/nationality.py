@@ -0,0 +1,153 @@
+"""Stage timings of the nationality prediction pipeline
+
+By default plink and fastNGSadmix are replaced with stubs from `benchmarks/stubs`, which
+follow the same I/O contracts, so the pipeline can be measured on machines without them
+"""
+import io
+import os
+import statistics
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.test.utils import override_settings
+from pysam import VariantFile
+
+from benchmarks.generators import SyntheticVCFConfig, generate_vcf_lines, write_vcf
+from nationality_prediction.predictors import FastNGSAdmixPredictor
+from vcf_uploading.vcf_processing import VCFFile, VCFRecord
+
+STUBS_DIR = Path(__file__).resolve().parent / "stubs"
+STUB_NUMBER_OF_INDIVIDUALS_FILE = STUBS_DIR / "nInd_stub.txt"
+STUB_REFERENCE_PANEL_FILE = STUBS_DIR / "refPanel_stub.txt"
+
+STAGES = ("write", "conversion", "admixture", "parse")
+
+
+@contextmanager
+def stub_tools(plink_delay: float = 0, fastngsadmix_delay: float = 0):
+    """Use stubs instead of plink and fastNGSadmix in the `with` block
+
+    :param plink_delay: seconds the plink stub sleeps to mimic the real tool
+    :param fastngsadmix_delay: seconds the fastNGSadmix stub sleeps
+    """
+    delays = {
+        "STUB_PLINK_DELAY": str(plink_delay),
+        "STUB_FASTNGSADMIX_DELAY": str(fastngsadmix_delay),
+    }
+    old_environ = {name: os.environ.get(name) for name in delays}
+    os.environ.update(delays)
+
+    try:
+        with override_settings(
+            PLINK_EXECUTABLE=str(STUBS_DIR / "plink"),
+            FASTNGSADMIX_EXECUTABLE=str(STUBS_DIR / "fastNGSadmix"),
+        ):
+            yield
+    finally:
+        for name, value in old_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def make_vcf_file(path: Path, config: SyntheticVCFConfig) -> VCFFile:
+    records = []
+
+    for line in generate_vcf_lines(config):
+        if line.startswith("#"):
+            continue
+        chromosome, position, id_, ref, alts, *_, genotype = line.split("\t")
+        records.append(
+            VCFRecord(
+                chromosome=chromosome,
+                position=int(position),
+                sample=config.samples[0],
+                sample_indexes=genotype,
+                ref=ref,
+                alts=alts.split(","),
+                id_=id_,
+            )
+        )
+
+    return VCFFile(sample=config.samples[0], records=records)
+
+
+def make_uploaded_file(path: Path, config: SyntheticVCFConfig) -> InMemoryUploadedFile:
+    content = "".join(line + "\n" for line in generate_vcf_lines(config)).encode()
+    return InMemoryUploadedFile(
+        io.BytesIO(content), "file", "sample.vcf", "text/plain", len(content), None
+    )
+
+
+def make_variant_file(path: Path, config: SyntheticVCFConfig) -> VariantFile:
+    return VariantFile(str(write_vcf(path / "input.vcf", config)))
+
+
+INPUTS: Dict[str, Callable] = {
+    "vcf_file": make_vcf_file,
+    "uploaded_file": make_uploaded_file,
+    "variant_file": make_variant_file,
+}
+
+
+def time_prediction(
+    input_kind: str, n_sites: int, directory: Path, use_stubs: bool = True
+) -> Dict:
+    """Predict nationality of a synthetic sample with `n_sites` variants
+
+    Input is created before the measurement, so it doesn't count to the "write" stage
+
+    :return: dictionary with seconds spent in each stage, their sum and the prediction
+    """
+    config = SyntheticVCFConfig(n_samples=1, n_sites=n_sites, n_chromosomes=22)
+    predictor = FastNGSAdmixPredictor(INPUTS[input_kind](directory, config))
+
+    if use_stubs:
+        predictor.number_of_individuals_file = str(STUB_NUMBER_OF_INDIVIDUALS_FILE)
+        predictor.reference_panel_file = str(STUB_REFERENCE_PANEL_FILE)
+
+    prediction = predictor.predict()
+
+    return {
+        "stages": {stage: predictor.timings.get(stage) for stage in STAGES},
+        "total": sum(predictor.timings.values()),
+        "prediction": prediction,
+    }
+
+
+def run_nationality_benchmarks(
+    inputs: List[str], sizes: List[int], directory: Path, repeat: int = 1, use_stubs: bool = True
+) -> List[Dict]:
+    """Measure stages of the prediction for each input kind and number of variants
+
+    :return: list of results with median times of stages and of the whole prediction
+    """
+    results = []
+
+    for input_kind in inputs:
+        for n_sites in sizes:
+            runs = [
+                time_prediction(input_kind, n_sites, directory, use_stubs=use_stubs)
+                for _ in range(repeat)
+            ]
+
+            results.append(
+                {
+                    "input": input_kind,
+                    "n_sites": n_sites,
+                    "stages": {
+                        stage: statistics.median(run["stages"][stage] for run in runs)
+                        if runs[0]["stages"][stage] is not None
+                        else None
+                        for stage in STAGES
+                    },
+                    "time": statistics.median(run["total"] for run in runs),
+                    "times": [run["total"] for run in runs],
+                    "prediction": runs[-1]["prediction"],
+                }
+            )
+
+    return results
@@ -0,0 +1,211 @@
+"""Measurement of time, peak memory and number of database queries"""
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import django
+from django.conf import settings
+from django.db import connection, transaction
+
+from benchmarks.scenarios import SCALES, SCENARIOS
+
+_STATM_PATH = Path("/proc/self/statm")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def get_rss() -> Optional[int]:
+    """Return current resident set size of the process in bytes, if the OS reports it"""
+    try:
+        return int(_STATM_PATH.read_text().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def get_max_rss() -> int:
+    """Return peak resident set size of the process since its start in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment() -> Dict[str, Any]:
+    """Return description of the run, so results of different commits can be matched"""
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+class PeakRSSMonitor:
+    """Sample RSS in a background thread and keep its maximum
+
+    The peak RSS reported by the OS is a maximum over the whole life of the process, so
+    it can't tell the peak of a single scenario. Where RSS of the process can't be read,
+    that lifetime peak is used instead
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = get_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def __enter__(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.peak is None:
+            self.peak = get_max_rss()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, get_rss())
+
+
+class QueryCounter:
+    """Database execute wrapper counting queries
+
+    Unlike `CaptureQueriesContext` it doesn't store queries, so it works for any number of
+    them and with DEBUG = False
+    """
+
+    def __init__(self):
+        self.n_queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.n_queries += 1
+        return execute(sql, params, many, context)
+
+
+@dataclass
+class Measurement:
+    time: float  # Seconds
+    peak_rss: float  # MiB
+    n_queries: int
+
+
+@contextmanager
+def measure():
+    """Measure the code in the `with` block. The yielded dict gets a "measurement" key"""
+    result = {}
+    counter = QueryCounter()
+
+    with PeakRSSMonitor() as monitor, connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        yield result
+        elapsed = time.perf_counter() - start
+
+    result["measurement"] = Measurement(
+        time=elapsed, peak_rss=monitor.peak / 2 ** 20, n_queries=counter.n_queries
+    )
+
+
+def run_scenario(name: str, scale: str, directory: Path) -> Measurement:
+    """Prepare data for scenario `name` at `scale` and measure its run
+
+    Everything is done in a transaction that is rolled back in the end, so scenarios
+    don't see data of each other
+    """
+    from short_tandem_repeats.search import invalidate_caches
+
+    invalidate_caches()
+
+    with transaction.atomic():
+        run = SCENARIOS[name](SCALES[scale], directory)
+
+        with measure() as result:
+            run()
+
+        transaction.set_rollback(True)
+
+    invalidate_caches()
+    return result["measurement"]
+
+
+def run_benchmarks(
+    scenarios: List[str], scales: List[str], directory: Path, repeat: int = 1
+) -> List[Dict]:
+    """Run each scenario at each scale `repeat` times
+
+    :return: list of results with the median time, the maximum peak RSS and
+        the number of queries of each scenario and scale, plus all measured times
+    """
+    results = []
+
+    for name in scenarios:
+        for scale in scales:
+            measurements = [run_scenario(name, scale, directory) for _ in range(repeat)]
+            times = [measurement.time for measurement in measurements]
+
+            results.append(
+                {
+                    "scenario": name,
+                    "scale": scale,
+                    "params": SCALES[scale].to_dict(),
+                    "time": statistics.median(times),
+                    "times": times,
+                    "peak_rss": max(measurement.peak_rss for measurement in measurements),
+                    "n_queries": measurements[-1].n_queries,
+                }
+            )
+
+    return results
+
+
+def compare_results(baseline: List[Dict], results: List[Dict]) -> List[Dict]:
+    """Return ratios of time, peak RSS and number of queries of `results` to `baseline`
+
+    Only scenarios and scales present in both lists are compared
+    """
+    baseline_by_key = {(result["scenario"], result["scale"]): result for result in baseline}
+    comparison = []
+
+    for result in results:
+        base = baseline_by_key.get((result["scenario"], result["scale"]))
+        if base is None:
+            continue
+
+        comparison.append(
+            {
+                "scenario": result["scenario"],
+                "scale": result["scale"],
+                **{
+                    metric: result[metric] / base[metric] if base[metric] else None
+                    for metric in ("time", "peak_rss", "n_queries")
+                },
+            }
+        )
+
+    return comparison
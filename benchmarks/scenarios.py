@@ -0,0 +1,195 @@
+"""Benchmark scenarios
+
+A scenario is a function that takes a `Scale` and a directory inside MEDIA_ROOT, prepares
+data and returns a function without arguments that runs the measured code
+"""
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict
+
+from django.conf import settings
+from django.forms import formset_factory
+
+from benchmarks.generators import (
+    SyntheticSTRConfig,
+    SyntheticVCFConfig,
+    generate_genotype_arrays,
+    generate_sites,
+    write_str_table,
+    write_vcf,
+)
+
+Scenario = Callable[["Scale", Path], Callable[[], object]]
+
+
+@dataclass
+class Scale:
+    """Size of benchmark data
+
+    :param vcf: config of the VCF file. It is also the cohort saved to the database
+        for search scenarios
+    :param str_table: config of the STR table
+    :param n_query_samples: number of samples in a VCF file searched in the database
+    :param n_query_snps: number of SNPs searched in the database
+    """
+
+    vcf: SyntheticVCFConfig
+    str_table: SyntheticSTRConfig
+    n_query_samples: int = 1
+    n_query_snps: int = 10
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+SCALES: Dict[str, Scale] = {
+    "tiny": Scale(
+        vcf=SyntheticVCFConfig(n_samples=3, n_sites=20),
+        str_table=SyntheticSTRConfig(n_samples=10, n_regions=5),
+        n_query_snps=2,
+    ),
+    "small": Scale(
+        vcf=SyntheticVCFConfig(n_samples=10, n_sites=200),
+        str_table=SyntheticSTRConfig(n_samples=100, n_regions=20),
+    ),
+    "medium": Scale(
+        vcf=SyntheticVCFConfig(n_samples=50, n_sites=1000),
+        str_table=SyntheticSTRConfig(n_samples=1000, n_regions=20),
+        n_query_snps=50,
+    ),
+    "large": Scale(
+        vcf=SyntheticVCFConfig(n_samples=200, n_sites=5000),
+        str_table=SyntheticSTRConfig(n_samples=10000, n_regions=25),
+        n_query_samples=2,
+        n_query_snps=200,
+    ),
+}
+
+SCENARIOS: Dict[str, Scenario] = {}
+
+
+def scenario(name: str):
+    """Register a scenario under `name`"""
+
+    def register(function: Scenario) -> Scenario:
+        SCENARIOS[name] = function
+        return function
+
+    return register
+
+
+def create_raw_vcf(config: SyntheticVCFConfig, directory: Path):
+    from vcf_uploading.models import RawVCF
+
+    path = write_vcf(directory / f"{config.sample_prefix}_{config.seed}.vcf", config)
+    return RawVCF.objects.create(
+        file=str(path.relative_to(settings.MEDIA_ROOT)), saved=False
+    )
+
+
+def save_cohort(scale: Scale, directory: Path):
+    raw_vcf = create_raw_vcf(scale.vcf, directory)
+    raw_vcf.save_samples_to_db()
+    return raw_vcf
+
+
+@scenario("save_samples_to_db")
+def save_samples_to_db(scale: Scale, directory: Path):
+    raw_vcf = create_raw_vcf(scale.vcf, directory)
+    return raw_vcf.save_samples_to_db
+
+
+@scenario("calculate_statistics")
+def calculate_statistics(scale: Scale, directory: Path):
+    raw_vcf = create_raw_vcf(scale.vcf, directory)
+    return raw_vcf.calculate_statistics
+
+
+@scenario("find_similar_samples_in_db")
+def find_similar_samples_in_db(scale: Scale, directory: Path):
+    save_cohort(scale, directory)
+    # The same sites with genotypes of other samples
+    query_config = replace(
+        scale.vcf, n_samples=scale.n_query_samples, sample_prefix="QUERY"
+    )
+    query_vcf = create_raw_vcf(query_config, directory)
+
+    return query_vcf.find_similar_samples_in_db
+
+
+@scenario("get_similar_samples_from_snp")
+def get_similar_samples_from_snp(scale: Scale, directory: Path):
+    from vcf_uploading.forms import SNPSearchForm
+    from vcf_uploading.models import Chromosome
+    from vcf_uploading.utils import get_similar_samples_from_snp
+
+    save_cohort(scale, directory)
+
+    data = {}
+    sites = list(generate_sites(scale.vcf))
+    step = max(len(sites) // scale.n_query_snps, 1)
+
+    for i, (chromosome, position, ref, alts) in enumerate(sites[::step][: scale.n_query_snps]):
+        data.update(
+            {
+                f"form-{i}-chromosome": Chromosome.NamesMapper.name_to_number(chromosome),
+                f"form-{i}-position": position,
+                f"form-{i}-allele_1": ref,
+                f"form-{i}-allele_2": alts[0],
+            }
+        )
+    data.update({"form-TOTAL_FORMS": scale.n_query_snps, "form-INITIAL_FORMS": 0})
+    formset = formset_factory(SNPSearchForm)(data)
+    formset.is_valid()
+
+    return lambda: get_similar_samples_from_snp(formset)
+
+
+@scenario("sample_to_vcf")
+def sample_to_vcf(scale: Scale, directory: Path):
+    from vcf_uploading.models import Sample
+
+    save_cohort(scale, directory)
+    sample = Sample.objects.get(cypher=scale.vcf.samples[0])
+
+    def write_vcf_lines():
+        for _ in sample.to_vcf().lines():
+            pass
+
+    return write_vcf_lines
+
+
+@scenario("str_file_save_to_db")
+def str_file_save_to_db(scale: Scale, directory: Path):
+    from short_tandem_repeats.models import STRFile
+
+    path = write_str_table(directory / f"str_{scale.str_table.seed}.xlsx", scale.str_table)
+    str_file = STRFile.objects.create(file=str(path.relative_to(settings.MEDIA_ROOT)))
+
+    return str_file.save_to_db
+
+
+def metric_kernel(name: str) -> Scenario:
+    """Return micro-benchmark of the kernel of metric `name` on genotype arrays of all
+    samples and sites of `Scale.vcf`
+    """
+
+    def prepare(scale: Scale, directory: Path):
+        from vcf_uploading.genotype_metrics import get_metric
+
+        metric = get_metric(name)
+        query, genotypes = generate_genotype_arrays(scale.vcf)
+
+        return lambda: metric(query, genotypes)
+
+    return prepare
+
+
+for metric_name in (
+    "identity",
+    "ibs_distance",
+    "concordance",
+    "allele_sharing_distance",
+    "rare_allele_weighted",
+):
+    scenario(f"metric_{metric_name}")(metric_kernel(metric_name))
@@ -0,0 +1,85 @@
+"""Start time of the project
+
+Every management command, test run and worker process sets up Django and loads the URL
+configuration, which imports all models and views. Imports are measured in a fresh
+interpreter with `python -X importtime`
+"""
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+STARTUP_CODE = "import django; django.setup(); import exome_p.urls"
+
+# Heavy dependencies, which have to be imported on the first use instead of the start
+DEFERRED_MODULES = ("pysam", "numpy", "pandas", "openpyxl", "pyarrow")
+
+_IMPORT_TIME_LINE = re.compile(
+    r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<module>\S+)$"
+)
+
+
+@dataclass
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+    parent: Optional[str] = None  # Module, which imported this one first
+
+
+def parse_import_times(output: str) -> Dict[str, ImportTime]:
+    """Parse output of `python -X importtime` to a dictionary with modules as keys
+
+    A module is printed after all modules imported by it, one level of indentation deeper
+    """
+    import_times: Dict[str, ImportTime] = {}
+    children: Dict[int, List[ImportTime]] = {}
+
+    for line in output.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+
+        depth = len(match["indent"])
+        import_time = ImportTime(
+            module=match["module"],
+            self_us=int(match["self"]),
+            cumulative_us=int(match["cumulative"]),
+        )
+        for child in children.pop(depth + 2, []):
+            child.parent = import_time.module
+
+        children.setdefault(depth, []).append(import_time)
+        import_times[import_time.module] = import_time
+
+    return import_times
+
+
+def measure_startup(code: str = STARTUP_CODE) -> Dict[str, ImportTime]:
+    """Run `code` in a new interpreter and return times of imports made by it"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=settings.BASE_DIR,
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_import_times(result.stderr)
+
+
+def get_import_chain(import_times: Dict[str, ImportTime], module: str) -> List[str]:
+    """Return list of modules from the top level import to `module`"""
+    chain = [module]
+    while import_times[chain[-1]].parent is not None:
+        chain.append(import_times[chain[-1]].parent)
+    return chain[::-1]
+
+
+def get_total_time(import_times: Dict[str, ImportTime]) -> float:
+    """Return the total time of all imports in seconds"""
+    return sum(import_time.self_us for import_time in import_times.values()) / 1e6
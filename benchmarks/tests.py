@@ -0,0 +1,155 @@
+import json
+import tempfile
+from io import StringIO
+from pathlib import Path
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from pysam import VariantFile
+
+from benchmarks.generators import (
+    SyntheticSTRConfig,
+    SyntheticVCFConfig,
+    generate_genotype_arrays,
+    generate_str_rows,
+    generate_vcf_lines,
+    write_vcf,
+)
+from benchmarks.nationality import run_nationality_benchmarks, stub_tools
+from benchmarks.scenarios import SCALES, SCENARIOS
+from benchmarks.startup import (
+    DEFERRED_MODULES,
+    get_import_chain,
+    get_total_time,
+    measure_startup,
+    parse_import_times,
+)
+from nationality_prediction.predictors import FastNGSAdmixPredictor
+from vcf_uploading.genotype_metrics import METRICS
+from vcf_uploading.models import Sample
+
+
+class GeneratorsTestCase(SimpleTestCase):
+    def test_vcf_is_deterministic_and_valid(self):
+        config = SyntheticVCFConfig(n_samples=4, n_sites=50, multiallelic_rate=0.5)
+
+        self.assertEqual(list(generate_vcf_lines(config)), list(generate_vcf_lines(config)))
+        self.assertNotEqual(
+            list(generate_vcf_lines(config)),
+            list(generate_vcf_lines(SyntheticVCFConfig(n_samples=4, n_sites=50, seed=1))),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = write_vcf(Path(tmp_dir) / "test.vcf", config)
+            records = list(VariantFile(str(path)))
+
+        self.assertEqual(len(records), 50)
+        self.assertEqual(len(records[0].samples), 4)
+        self.assertTrue(any(len(record.alts) == 2 for record in records))
+
+    def test_genotype_arrays(self):
+        config = SyntheticVCFConfig(n_samples=4, n_sites=50, missing_rate=0.1)
+        query, genotypes = generate_genotype_arrays(config)
+
+        self.assertEqual(query.shape, (50, 2))
+        self.assertEqual(genotypes.shape, (4, 50, 2))
+        self.assertEqual(set(genotypes.ravel().tolist()), {-1, 0, 1})
+
+    def test_every_metric_has_a_kernel_benchmark(self):
+        for name in METRICS:
+            run = SCENARIOS[f"metric_{name}"](SCALES["tiny"], Path("."))
+            self.assertEqual(run().shape, (3,))
+
+    def test_str_rows(self):
+        rows = list(generate_str_rows(SyntheticSTRConfig(n_samples=3, n_regions=4)))
+
+        self.assertEqual(rows[0], ["Sample", "STR1", "STR2", "STR3", "STR4"])
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(len(row) == 5 for row in rows))
+
+
+class RunBenchmarksTestCase(TestCase):
+    def test_command_reports_results_and_rolls_back(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / "results.json"
+            call_command(
+                "run_benchmarks",
+                "--in-place",
+                "--scales=tiny",
+                "--scenarios", "save_samples_to_db", "str_file_save_to_db",
+                f"--output={output}",
+                stderr=StringIO(),
+            )
+            report = json.loads(output.read_text())
+
+            call_command(
+                "run_benchmarks",
+                "--in-place",
+                "--scales=tiny",
+                "--scenarios=sample_to_vcf",
+                f"--compare={output}",
+                f"--output={output}",
+                stderr=StringIO(),
+            )
+            comparison = json.loads(output.read_text())["comparison"]
+
+        self.assertEqual(
+            [(result["scenario"], result["scale"]) for result in report["results"]],
+            [("save_samples_to_db", "tiny"), ("str_file_save_to_db", "tiny")],
+        )
+        self.assertGreater(report["results"][0]["n_queries"], 0)
+        self.assertGreater(report["results"][0]["peak_rss"], 0)
+        self.assertEqual(comparison, [])
+        self.assertFalse(Sample.objects.exists())
+
+
+class NationalityBenchmarksTestCase(SimpleTestCase):
+    def test_stages_are_timed_with_stub_tools(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, stub_tools():
+            results = run_nationality_benchmarks(
+                inputs=["vcf_file", "uploaded_file", "variant_file"],
+                sizes=[50],
+                directory=Path(tmp_dir),
+            )
+
+        for result in results:
+            self.assertEqual(set(result["prediction"]), {"PopA", "PopB", "PopC"})
+            self.assertTrue(all(time is not None for time in result["stages"].values()))
+
+        # All inputs are converted to the same plink files
+        self.assertEqual(len({str(result["prediction"]) for result in results}), 1)
+
+    def test_failed_stub_tool_is_not_predicted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, stub_tools():
+            path = write_vcf(Path(tmp_dir) / "test.vcf", SyntheticVCFConfig(n_samples=1))
+            predictor = FastNGSAdmixPredictor(VariantFile(str(path)))
+            predictor.number_of_individuals_file = str(Path(tmp_dir) / "missing.txt")
+
+            self.assertEqual(predictor.predict(), {"Not predicted": 0})
+            self.assertIn("conversion", predictor.timings)
+
+
+class StartupTestCase(SimpleTestCase):
+    def test_import_times_parsing(self):
+        import_times = parse_import_times(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:        10 |         10 |     c\n"
+            "import time:        20 |         30 |   b\n"
+            "import time:         5 |          5 |   d\n"
+            "import time:         1 |         36 | a\n"
+        )
+
+        self.assertEqual(get_import_chain(import_times, "c"), ["a", "b", "c"])
+        self.assertEqual(import_times["d"].parent, "a")
+        self.assertEqual(import_times["a"].cumulative_us, 36)
+        self.assertAlmostEqual(get_total_time(import_times), 36e-6)
+
+    def test_heavy_modules_are_not_imported_at_start(self):
+        import_times = measure_startup()
+
+        for module in DEFERRED_MODULES:
+            if module in import_times:
+                self.fail(
+                    f"{module} is imported at start: "
+                    + " -> ".join(get_import_chain(import_times, module))
+                )
@@ -13,5 +13,7 @@ fi
 
 python manage.py makemigrations
 python manage.py migrate
+python manage.py partition_variants
+python manage.py fill_variant_alleles
 
 exec "$@"
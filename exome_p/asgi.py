@@ -13,4 +13,44 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exome_p.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from asgiref.wsgi import WsgiToAsgi  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.urls import Resolver404, resolve  # noqa: E402
+
+from vcf_uploading.progress import ProgressEventsApp  # noqa: E402
+
+# Views streaming responses, which query the database while they are sent. Django 3
+# can't do it under ASGI, so they are served by the WSGI application in a thread
+WSGI_URL_NAMES = {"sample_vcf_download", "cohort_vcf_download"}
+
+
+class WSGIViewsApp:
+    """ASGI application passing requests to views named in `url_names` to `wsgi_app` and
+    all other requests to `app`
+    """
+
+    def __init__(self, app, wsgi_app, url_names):
+        self.app = app
+        self.wsgi_app = WsgiToAsgi(wsgi_app)
+        self.url_names = url_names
+
+    async def __call__(self, scope, receive, send):
+        is_http = scope["type"] == "http"
+        if is_http and self._get_url_name(scope["path"]) in self.url_names:
+            return await self.wsgi_app(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+    @staticmethod
+    def _get_url_name(path: str):
+        try:
+            return resolve(path).url_name
+        except Resolver404:
+            return None
+
+
+application = ProgressEventsApp(
+    WSGIViewsApp(django_application, get_wsgi_application(), WSGI_URL_NAMES)
+)
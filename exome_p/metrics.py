@@ -0,0 +1,204 @@
+"""In-process metrics exposed in the Prometheus text format
+
+Metrics are kept in memory of the worker process. If the app is served by several
+processes, each of them has its own metrics, so scrape them separately or add
+a `process` label on the Prometheus side
+"""
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    labels = ",".join(
+        f'{name}="{_escape_label_value(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+class Metric:
+    type_: str = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues: str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Counts of observations in each bucket (not cumulative), sum and count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        bucket = bisect_left(self.buckets, value)
+
+        with self._lock:
+            if labelvalues not in self._values:
+                self._values[labelvalues] = ([0] * len(self.buckets), [0.0, 0])
+            counts, total = self._values[labelvalues]
+            counts[bucket] += 1
+            total[0] += value
+            total[1] += 1
+
+    def get_count(self, *labelvalues: str) -> int:
+        values = self._values.get(labelvalues)
+        return int(values[1][1]) if values else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), list(total)))
+                for labels, (counts, total) in self._values.items()
+            )
+
+        lines = self.header()
+        for labels, (counts, (total_sum, count)) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(
+                    self.labelnames + ("le",), labels + (_format_value(upper_bound),)
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+
+            series_labels = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{series_labels} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{series_labels} {int(count)}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "exome_p_request_duration_seconds",
+        "Time of processing requests until the response is returned",
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+        labelnames=("view", "method"),
+    )
+)
+REQUESTS = REGISTRY.register(
+    Counter("exome_p_requests_total", "Number of requests", labelnames=("view", "method", "status"))
+)
+SLOW_REQUESTS = REGISTRY.register(
+    Counter(
+        "exome_p_slow_requests_total",
+        "Number of requests slower than PERFORMANCE_SLOW_REQUEST_SECONDS",
+        labelnames=("view",),
+    )
+)
+DB_QUERIES = REGISTRY.register(
+    Histogram(
+        "exome_p_request_db_queries",
+        "Number of SQL queries of sampled requests",
+        buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000),
+        labelnames=("view",),
+    )
+)
+DB_DURATION = REGISTRY.register(
+    Histogram(
+        "exome_p_request_db_duration_seconds",
+        "Time of SQL queries of sampled requests",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+        labelnames=("view",),
+    )
+)
+N_PLUS_ONE_REQUESTS = REGISTRY.register(
+    Counter(
+        "exome_p_n_plus_one_requests_total",
+        "Number of sampled requests with repeated queries of the same shape",
+        labelnames=("view",),
+    )
+)
+PEAK_MEMORY = REGISTRY.register(
+    Histogram(
+        "exome_p_request_peak_memory_bytes",
+        "Peak memory allocated by Python during sampled requests",
+        buckets=tuple(2 ** power for power in range(16, 32, 2)),
+        labelnames=("view",),
+    )
+)
+
+
+def metrics_view(request):
+    """Return metrics in the Prometheus text format
+
+    If `settings.METRICS_TOKEN` is set, requests must have "Authorization: Bearer <token>"
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+
+    return HttpResponse(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
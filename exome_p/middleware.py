@@ -0,0 +1,177 @@
+import asyncio
+import random
+import re
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections
+from loguru import logger
+
+from exome_p import metrics
+
+_IN_LIST_PATTERN = re.compile(r"\bIN \((?:%s, )*%s\)")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def get_query_shape(sql: str) -> str:
+    """Return SQL without differences that don't change the query plan
+
+    Parameters are already replaced with placeholders by Django, so only lists of
+    different lengths (`IN (%s, %s)`) and whitespace are normalized
+    """
+    return _WHITESPACE_PATTERN.sub(" ", _IN_LIST_PATTERN.sub("IN (...)", sql)).strip()
+
+
+class QueryRecorder:
+    """Database execute wrapper counting queries, their time and shapes"""
+
+    def __init__(self):
+        self.n_queries = 0
+        self.duration = 0.0
+        self.shapes: Counter = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.n_queries += 1
+            self.shapes[get_query_shape(sql)] += 1
+
+    def get_repeated_query(self, threshold: int) -> Optional[tuple]:
+        """Return the most repeated query shape and its count if it was executed at
+        least `threshold` times. It usually means N+1 queries made in a loop
+        """
+        if not self.shapes:
+            return None
+
+        shape, count = self.shapes.most_common(1)[0]
+        return (shape, count) if count >= threshold else None
+
+
+class PerformanceMiddleware:
+    """Record time, SQL queries and memory of requests
+
+    Time of all requests is recorded to metrics exposed at /metrics. A fraction of requests,
+    `settings.PERFORMANCE_SAMPLE_RATE`, is sampled: their SQL queries are counted and
+    timed, and repeated queries of the same shape (N+1 queries) are reported. If
+    `settings.PERFORMANCE_TRACE_MEMORY` is True, peak memory allocated by Python is traced
+    for sampled requests too; tracing slows them down, and with several threads it includes
+    allocations of other requests.
+
+    Requests slower than `settings.PERFORMANCE_SLOW_REQUEST_SECONDS` are logged.
+
+    SQL queries of asynchronous views are run in other threads, so they are not recorded.
+    Time of streaming responses doesn't include streaming itself
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate: float = getattr(settings, "PERFORMANCE_SAMPLE_RATE", 0)
+        self.slow_request_seconds: float = getattr(
+            settings, "PERFORMANCE_SLOW_REQUEST_SECONDS", 1
+        )
+        self.n_plus_one_threshold: int = getattr(settings, "PERFORMANCE_N_PLUS_ONE_THRESHOLD", 10)
+        self.trace_memory: bool = getattr(settings, "PERFORMANCE_TRACE_MEMORY", False)
+
+        self.is_async = asyncio.iscoroutinefunction(self.get_response)
+        if self.is_async:
+            # Mark the middleware as a coroutine function for Django
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        if not self.is_sampled():
+            start = time.perf_counter()
+            response = self.get_response(request)
+            self.record(request, response, time.perf_counter() - start)
+            return response
+
+        recorder = QueryRecorder()
+        is_tracing_memory = self.trace_memory and not tracemalloc.is_tracing()
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            if is_tracing_memory:
+                tracemalloc.start()
+                stack.callback(tracemalloc.stop)
+
+            start = time.perf_counter()
+            response = self.get_response(request)
+            duration = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1] if is_tracing_memory else None
+
+        self.record(request, response, duration, recorder, peak_memory)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start)
+        return response
+
+    def is_sampled(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @staticmethod
+    def get_view_name(request) -> str:
+        match = getattr(request, "resolver_match", None)
+        return match.view_name if match is not None else "unmatched"
+
+    def record(
+        self,
+        request,
+        response,
+        duration: float,
+        recorder: Optional[QueryRecorder] = None,
+        peak_memory: Optional[int] = None,
+    ):
+        view = self.get_view_name(request)
+
+        metrics.REQUEST_DURATION.observe(duration, view, request.method)
+        metrics.REQUESTS.inc(view, request.method, str(response.status_code))
+
+        fields = {
+            "view": view,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration": round(duration, 4),
+        }
+
+        if recorder is not None:
+            metrics.DB_QUERIES.observe(recorder.n_queries, view)
+            metrics.DB_DURATION.observe(recorder.duration, view)
+            fields.update(n_queries=recorder.n_queries, db_duration=round(recorder.duration, 4))
+
+            repeated_query = recorder.get_repeated_query(self.n_plus_one_threshold)
+            if repeated_query is not None:
+                shape, count = repeated_query
+                metrics.N_PLUS_ONE_REQUESTS.inc(view)
+                logger.bind(**fields, repeated_query=shape, repeats=count).warning(
+                    "Possible N+1 queries in {}: the same query was executed {} times: {}",
+                    view,
+                    count,
+                    shape,
+                )
+
+        if peak_memory is not None:
+            metrics.PEAK_MEMORY.observe(peak_memory, view)
+            fields["peak_memory"] = peak_memory
+
+        if duration >= self.slow_request_seconds:
+            metrics.SLOW_REQUESTS.inc(view)
+            logger.bind(**fields).warning(
+                "Slow request {} {} took {:.3f} s", request.method, request.path, duration
+            )
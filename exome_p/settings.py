@@ -53,9 +53,11 @@ INSTALLED_APPS = [
     "vcf_uploading",
     "nationality_prediction",
     "short_tandem_repeats",
+    "benchmarks",
 ]
 
 MIDDLEWARE = [
+    "exome_p.middleware.PerformanceMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -86,6 +88,15 @@ TEMPLATES = [
 WSGI_APPLICATION = "exome_p.wsgi.application"
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Progress of long operations is stored in the cache. It must be shared between worker
+# processes (e.g. CACHE_URL=rediscache://...) to be visible to all of them. A database
+# cache isn't suitable: progress is written inside transactions of the operations
+
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+
+
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
@@ -142,3 +153,76 @@ STATIC_URL = "/static/"
 STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
+
+# External command line tools (plink, fastNGSadmix)
+
+# Executables of the tools. Names are looked up in PATH
+PLINK_EXECUTABLE = env.str("PLINK_EXECUTABLE", default="plink")
+FASTNGSADMIX_EXECUTABLE = env.str("FASTNGSADMIX_EXECUTABLE", default="fastNGSadmix")
+
+# Maximum number of tools running at the same time in one worker process
+COMMAND_LINE_TOOLS_MAX_CONCURRENCY = env.int("COMMAND_LINE_TOOLS_MAX_CONCURRENCY", default=4)
+
+# Number of seconds after which a tool is killed
+COMMAND_LINE_TOOLS_TIMEOUT = env.float("COMMAND_LINE_TOOLS_TIMEOUT", default=600)
+
+# Uploaded VCF files that are not saved to the database are hidden after this number
+# of minutes and then deleted by `manage.py delete_expired_vcfs`
+UNSAVED_VCF_LIFETIME_MINUTES = env.int("UNSAVED_VCF_LIFETIME_MINUTES", default=45)
+
+# Whether to skip homozygous reference genotypes of saved samples. They are restored
+# from callable intervals of samples, see vcf_uploading.models.CallableInterval
+SPARSE_VARIANTS = env.bool("SPARSE_VARIANTS", default=False)
+
+# Records of a VCF file closer than this number of bases are joined into one callable
+# interval. SNPs between them, which the file doesn't have, are homozygous reference, so
+# raise it only for files, which have a record at every called site (e.g. gVCF files)
+CALLABLE_INTERVAL_MAX_GAP = env.int("CALLABLE_INTERVAL_MAX_GAP", default=0)
+
+# Process-wide caches of alleles, chromosomes and alleles records, see
+# vcf_uploading/interning.py
+
+# Maximum number of cached rows of each table
+INTERNING_CACHE_SIZE = env.int("INTERNING_CACHE_SIZE", default=10000)
+
+# Alias of the cache in CACHES, where versions of the tables are shared between workers
+INTERNING_CACHE_ALIAS = env.str("INTERNING_CACHE_ALIAS", default="default")
+
+# Number of seconds between checks whether the tables were changed by other workers
+INTERNING_CHECK_INTERVAL = env.float("INTERNING_CHECK_INTERVAL", default=5)
+
+# Progress of long operations, see vcf_uploading/progress.py
+
+# Alias of the cache in CACHES, where progress is stored
+PROGRESS_CACHE_ALIAS = env.str("PROGRESS_CACHE_ALIAS", default="default")
+
+# Number of seconds the progress is kept after its last update
+PROGRESS_TTL = env.int("PROGRESS_TTL", default=3600)
+
+# Number of seconds between server-sent progress events
+PROGRESS_EVENTS_INTERVAL = env.float("PROGRESS_EVENTS_INTERVAL", default=1)
+
+# Number of seconds after which the stream of progress events is closed. The browser
+# reopens it, so under WSGI a thread isn't occupied by one page for the whole operation
+PROGRESS_EVENTS_TIMEOUT = env.float("PROGRESS_EVENTS_TIMEOUT", default=300)
+
+# Number of seconds after which the stream is closed for good if the operation hasn't
+# started
+PROGRESS_EVENTS_START_TIMEOUT = env.float("PROGRESS_EVENTS_START_TIMEOUT", default=30)
+
+# Performance monitoring, see exome_p/middleware.py. Metrics are served at /metrics
+
+# Fraction of requests, for which SQL queries are recorded. 0 turns the sampling off
+PERFORMANCE_SAMPLE_RATE = env.float("PERFORMANCE_SAMPLE_RATE", default=0)
+
+# Requests slower than this number of seconds are logged
+PERFORMANCE_SLOW_REQUEST_SECONDS = env.float("PERFORMANCE_SLOW_REQUEST_SECONDS", default=1)
+
+# Sampled requests executing the same query at least this number of times are logged
+PERFORMANCE_N_PLUS_ONE_THRESHOLD = env.int("PERFORMANCE_N_PLUS_ONE_THRESHOLD", default=10)
+
+# Whether to trace peak memory of sampled requests with tracemalloc. It slows them down
+PERFORMANCE_TRACE_MEMORY = env.bool("PERFORMANCE_TRACE_MEMORY", default=False)
+
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>" header
+METRICS_TOKEN = env.str("METRICS_TOKEN", default="")
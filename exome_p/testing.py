@@ -0,0 +1,21 @@
+"""Helpers shared by tests of the apps"""
+import shutil
+import tempfile
+
+from django.test import override_settings
+
+
+class TemporaryMediaMixin:
+    """Mixin of test cases, which stores files of each test in a temporary MEDIA_ROOT
+
+    The directory is `self.media_root`. It is deleted after the test
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
@@ -0,0 +1,94 @@
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from loguru import logger
+
+from exome_p import metrics
+from exome_p.middleware import PerformanceMiddleware, get_query_shape
+from vcf_uploading.models import Sample
+
+
+class MetricsTestCase(SimpleTestCase):
+    def test_histogram_rendering(self):
+        histogram = metrics.Histogram(
+            "test_seconds", "Test histogram", buckets=(0.1, 1), labelnames=("view",)
+        )
+        histogram.observe(0.05, 'a"b')
+        histogram.observe(0.5, 'a"b')
+        histogram.observe(5, 'a"b')
+
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP test_seconds Test histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{view="a\\"b",le="0.1"} 1',
+                'test_seconds_bucket{view="a\\"b",le="1"} 2',
+                'test_seconds_bucket{view="a\\"b",le="+Inf"} 3',
+                'test_seconds_sum{view="a\\"b"} 5.55',
+                'test_seconds_count{view="a\\"b"} 3',
+            ],
+        )
+
+    def test_query_shape(self):
+        self.assertEqual(
+            get_query_shape('SELECT "id" FROM "t"\n WHERE "id" IN (%s, %s, %s)'),
+            get_query_shape('SELECT "id" FROM "t" WHERE "id" IN (%s)'),
+        )
+
+
+class PerformanceMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.messages = []
+        self.handler_id = logger.add(lambda message: self.messages.append(message.record))
+
+    def tearDown(self):
+        logger.remove(self.handler_id)
+
+    def n_plus_one_view(self, request):
+        for cypher in ["S1", "S2", "S3"]:
+            Sample.objects.filter(cypher=cypher).exists()
+        return HttpResponse()
+
+    @override_settings(
+        PERFORMANCE_SAMPLE_RATE=1,
+        PERFORMANCE_N_PLUS_ONE_THRESHOLD=3,
+        PERFORMANCE_SLOW_REQUEST_SECONDS=0,
+    )
+    def test_sampled_request_reports_queries(self):
+        n_requests = metrics.DB_QUERIES.get_count("unmatched")
+        middleware = PerformanceMiddleware(self.n_plus_one_view)
+
+        middleware(RequestFactory().get("/test"))
+
+        self.assertEqual(metrics.DB_QUERIES.get_count("unmatched"), n_requests + 1)
+        n_plus_one_record, slow_request_record = self.messages
+        self.assertTrue(n_plus_one_record["message"].startswith("Possible N+1 queries"))
+        self.assertEqual(n_plus_one_record["extra"]["repeats"], 3)
+        self.assertTrue(slow_request_record["message"].startswith("Slow request GET /test"))
+        self.assertEqual(slow_request_record["extra"]["n_queries"], 3)
+
+    @override_settings(PERFORMANCE_SAMPLE_RATE=0)
+    def test_not_sampled_request_records_only_time(self):
+        n_requests = metrics.DB_QUERIES.get_count("unmatched")
+        n_timed_requests = metrics.REQUEST_DURATION.get_count("unmatched", "GET")
+        middleware = PerformanceMiddleware(self.n_plus_one_view)
+
+        middleware(RequestFactory().get("/test"))
+
+        self.assertEqual(metrics.DB_QUERIES.get_count("unmatched"), n_requests)
+        self.assertEqual(
+            metrics.REQUEST_DURATION.get_count("unmatched", "GET"), n_timed_requests + 1
+        )
+        self.assertEqual(self.messages, [])
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint(self):
+        self.client.get(reverse("samples_list"))
+
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertContains(
+            response, 'exome_p_requests_total{view="samples_list",method="GET",status="200"}'
+        )
@@ -16,18 +16,30 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from exome_p.metrics import metrics_view
 from nationality_prediction.views import upload_genotype_for_prediction
 import short_tandem_repeats.views
 import vcf_uploading.views
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("", vcf_uploading.views.index, name="index"),
     path("file/vcf/", vcf_uploading.views.vcf_file_upload, name="upload"),
     path("file/vcf/list", vcf_uploading.views.vcf_files_list, name="vcf_list"),
     path("file/vcf/<int:file_id>", vcf_uploading.views.vcf_view, name="vcf_view"),
     path("file/vcf/<int:file_id>/download", vcf_uploading.views.vcf_file_download, name="vcf_file"),
     path("file/vcf/<int:file_id>/save", vcf_uploading.views.save_vcf, name="save_vcf"),
+    path(
+        "file/vcf/<int:file_id>/progress/<str:operation>/events",
+        vcf_uploading.views.progress_events,
+        name="progress_events",
+    ),
+    path(
+        "profile/<int:profile_id>/<str:kind>",
+        vcf_uploading.views.profile_download,
+        name="profile_download",
+    ),
     path(
         "file/vcf/<int:file_id>/similar_samples",
         vcf_uploading.views.find_similar_samples_in_db,
@@ -39,6 +51,12 @@ urlpatterns = [
         name="predict_nationality_from_vcf"
     ),
     path("vcf/sample/list", vcf_uploading.views.samples_list, name="samples_list"),
+    path(
+        "vcf/sample/<str:cypher>/download",
+        vcf_uploading.views.sample_vcf_download,
+        name="sample_vcf_download",
+    ),
+    path("vcf/cohort/download", vcf_uploading.views.cohort_vcf_download, name="cohort_vcf_download"),
     path("snp/search", vcf_uploading.views.snp_search_form, name="snp_search"),
     path(
         "nationality/predict",
@@ -47,5 +65,11 @@ urlpatterns = [
     ),
     path("str/file/upload", short_tandem_repeats.views.str_file_upload, name="str_upload"),
     path("file/str/<int:file_id>", short_tandem_repeats.views.str_view, name="str_view"),
+    path(
+        "file/str/<int:file_id>/save",
+        short_tandem_repeats.views.save_str_file,
+        name="save_str_file",
+    ),
     path("str/search", short_tandem_repeats.views.str_search_form, name="str_search"),
+    path("str/search/json", short_tandem_repeats.views.str_search_json, name="str_search_json"),
 ]
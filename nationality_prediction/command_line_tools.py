@@ -1,6 +1,12 @@
-import subprocess
+import asyncio
+import threading
+from asyncio.subprocess import PIPE
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Union
 
+from django.conf import settings
 from loguru import logger
 
 from nationality_prediction.constants import (
@@ -10,18 +16,142 @@ from nationality_prediction.constants import (
 )
 
 
-def run_plink(dir_path: Path):
+class CommandLineToolError(Exception):
+    """Raised when an external tool can't be started or exits with a non-zero code"""
+
+
+class CommandLineToolTimeoutError(CommandLineToolError):
+    """Raised when an external tool runs longer than it is allowed to"""
+
+
+@dataclass
+class CommandLineToolResult:
+    args: List[str]
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+# Under WSGI every async view runs in its own event loop, so the limit is shared by all
+# threads of the process. Semaphores are kept by the limit, so it can be overridden
+_semaphores: Dict[int, threading.BoundedSemaphore] = {}
+_semaphores_lock = threading.Lock()
+
+# Number of seconds between attempts to take a free slot
+_SLOT_POLL_INTERVAL = 0.05
+
+
+def _get_semaphore() -> threading.BoundedSemaphore:
+    limit = settings.COMMAND_LINE_TOOLS_MAX_CONCURRENCY
+
+    with _semaphores_lock:
+        if limit not in _semaphores:
+            _semaphores[limit] = threading.BoundedSemaphore(limit)
+        return _semaphores[limit]
+
+
+@asynccontextmanager
+async def _take_slot() -> AsyncIterator[None]:
+    """Wait for a free slot without blocking the event loop and hold it"""
+    semaphore = _get_semaphore()
+    while not semaphore.acquire(blocking=False):
+        await asyncio.sleep(_SLOT_POLL_INTERVAL)
+
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+async def _read_stream(stream: asyncio.StreamReader, name: str, lines: List[str]):
+    """Log lines of `stream` as soon as they appear and collect them to `lines`"""
+    async for line in stream:
+        decoded_line = line.decode(errors="replace").rstrip("\n")
+        logger.debug("{}: {}", name, decoded_line)
+        lines.append(decoded_line)
+
+
+async def run_command_line_tool(
+    args: Sequence[Union[str, Path]], timeout: Optional[float] = None
+) -> CommandLineToolResult:
+    """Run an external tool without blocking the event loop
+
+    Number of tools running at the same time in the process, in all threads and event
+    loops, is limited by `settings.COMMAND_LINE_TOOLS_MAX_CONCURRENCY`. Other calls wait
+    for a free slot.
+
+    :param args: executable name and its arguments
+    :param timeout: maximum number of seconds the tool may run. By default,
+        `settings.COMMAND_LINE_TOOLS_TIMEOUT` is used
+    :return: result with the return code and captured STDOUT and STDERR
+    :raises CommandLineToolTimeoutError: if the tool didn't finish in `timeout` seconds.
+        The tool is killed in this case
+    :raises CommandLineToolError: if the tool can't be started or finished with
+        a non-zero return code
+    """
+    args = [str(arg) for arg in args]
+    tool = args[0]
+
+    if timeout is None:
+        timeout = settings.COMMAND_LINE_TOOLS_TIMEOUT
+
+    async with _take_slot():
+        logger.info("Running {}", tool)
+        logger.debug("Command: {}", " ".join(args))
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=PIPE, stderr=PIPE
+            )
+        except OSError as e:
+            raise CommandLineToolError(f"Couldn't start {tool}: {e}") from e
+
+        stdout: List[str] = []
+        stderr: List[str] = []
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _read_stream(process.stdout, f"{tool} STDOUT", stdout),
+                    _read_stream(process.stderr, f"{tool} STDERR", stderr),
+                    process.wait(),
+                ),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError as e:
+            logger.error("{} has exceeded the timeout of {} s. Killing it", tool, timeout)
+            process.kill()
+            await process.wait()
+            raise CommandLineToolTimeoutError(
+                f"{tool} didn't finish in {timeout} seconds"
+            ) from e
+
+    result = CommandLineToolResult(
+        args=args,
+        returncode=process.returncode,
+        stdout="\n".join(stdout),
+        stderr="\n".join(stderr),
+    )
+
+    if result.returncode != 0:
+        logger.error("{} finished with return code {}", tool, result.returncode)
+        raise CommandLineToolError(
+            f"{tool} finished with return code {result.returncode}: {result.stderr}"
+        )
+
+    return result
+
+
+async def run_plink(dir_path: Path) -> CommandLineToolResult:
     """Run plink with files in `dir_path`. Save result to the same directory
 
     :param dir_path: directory, which contains VCF file for prediction. By default, it will
         search for `constants.VCF_FILENAME` and save files in the same directory with prefix
         `constants.PLINK_FILE`
     """
-    logger.info("Running plink")
-
-    result = subprocess.run(
+    return await run_command_line_tool(
         [
-            "plink",
+            settings.PLINK_EXECUTABLE,
             "--vcf",
             dir_path / VCF_FILENAME,
             # "--id-delim",
@@ -31,14 +161,13 @@ def run_plink(dir_path: Path):
             "--recode",
             "--out",
             dir_path / PLINK_OUTPUT_PREFIX,
-        ],
-        capture_output=True,
+        ]
     )
-    logger.debug("STDOUT: {}", result.stdout)
-    logger.debug("STDERR: {}", result.stderr)
 
 
-def run_fastngsadmix(dir_path: Path, number_of_individuals_file: str, ref_panel: str):
+async def run_fastngsadmix(
+    dir_path: Path, number_of_individuals_file: str, ref_panel: str
+) -> CommandLineToolResult:
     """Run fastNGSadmix with files in `dir_path`. Save result to the same directory
 
     :param dir_path: directory, which contains plink output files. They have to start with
@@ -47,22 +176,18 @@ def run_fastngsadmix(dir_path: Path, number_of_individuals_file: str, ref_panel:
         reference population
     :param ref_panel: a file with ancestral population frequencies
     """
-    logger.info("Running fastNGSadmix")
-    fast_ngs_admix_result = subprocess.run(
+    return await run_command_line_tool(
         [
-            "fastNGSadmix",
+            settings.FASTNGSADMIX_EXECUTABLE,
             "-plink",
-            str(dir_path / PLINK_OUTPUT_PREFIX),
+            dir_path / PLINK_OUTPUT_PREFIX,
             "-Nname",
             number_of_individuals_file,
             "-fname",
             ref_panel,
             "-out",
-            str(dir_path / FAST_NGS_ADMIX_OUTPUT_PREFIX),
+            dir_path / FAST_NGS_ADMIX_OUTPUT_PREFIX,
             "-whichPops",
             "all",
-        ],
-        capture_output=True,
+        ]
     )
-    logger.debug("STDOUT: {}", fast_ngs_admix_result.stdout)
-    logger.debug("STDERR: {}", fast_ngs_admix_result.stderr)
@@ -1,3 +1,7 @@
+# Static files of the reference panel for fastNGSadmix
+NUMBER_OF_INDIVIDUALS_FILENAME = "nInd_MultiEthnic_2019_Popul.txt"
+REFERENCE_PANEL_FILENAME = "refPanel_MultiEthnic_2019_Popul.txt"
+
 VCF_FILENAME = "sample.vcf"
 PLINK_OUTPUT_PREFIX = "plink_output"
 FAST_NGS_ADMIX_OUTPUT_PREFIX = "fastNGSadmix_output"
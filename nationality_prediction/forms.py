@@ -12,8 +12,8 @@ class VCFUploadForm(forms.Form):
     )
 
     @staticmethod
-    def predict_nationality(vcf_file):
+    async def predict_nationality(vcf_file):
         logger.info("Predicting nationality for file {}", vcf_file)
 
         predictor = FastNGSAdmixPredictor(vcf_file)
-        return predictor.predict()
+        return await predictor.apredict()
@@ -0,0 +1,185 @@
+"""Writer of plink binary filesets (.bed, .bim and .fam files)
+
+Format description: https://www.cog-genomics.org/plink/1.9/formats#bed
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+BED_MAGIC_NUMBER = bytes((0x6C, 0x1B))
+BED_SNP_MAJOR_MODE = bytes((0x01,))
+
+MISSING_GENOTYPE = -1
+
+# Genotypes are numbers of alternative alleles. In .bim file the alternative allele
+# is written as A1 and the reference one as A2, so 2 bit codes are:
+# missing -> 01, 0 ALT -> 11 (homozygous A2), 1 ALT -> 10, 2 ALT -> 00 (homozygous A1)
+_GENOTYPE_TO_BED_CODE = np.array([0b01, 0b11, 0b10, 0b00], dtype=np.uint8)
+
+_GENDER_TO_FAM_SEX = {"M": 1, "F": 2}
+
+
+@dataclass
+class PlinkSite:
+    chromosome: int
+    position: int
+    ref: str
+    alt: str
+    name: str = "."
+
+    def to_bim_line(self) -> str:
+        return (
+            f"{self.chromosome}\t{self.name or '.'}\t0\t{self.position}"
+            f"\t{self.alt}\t{self.ref}"
+        )
+
+
+@dataclass
+class PlinkSample:
+    cypher: str
+    gender: str = "U"
+
+    def to_fam_line(self) -> str:
+        sex = _GENDER_TO_FAM_SEX.get(self.gender, 0)
+        # Family ID is the same as individual ID, as plink does with `--double-id`
+        return f"{self.cypher}\t{self.cypher}\t0\t0\t{sex}\t-9"
+
+
+def alleles_record_to_genotype(record: str) -> int:
+    """Convert record like "0/1" to the number of alternative alleles
+
+    Missing calls and calls of the second and further alternative alleles (which are
+    not stored in the SNP) are converted to `MISSING_GENOTYPE`
+    """
+    indices = record.replace("|", "/").split("/")
+
+    if any(index not in ("0", "1") for index in indices):
+        return MISSING_GENOTYPE
+
+    return indices.count("1")
+
+
+class PlinkFileset:
+    """Genotypes of samples in a form that can be saved as plink binary fileset
+
+    :param samples: samples, i.e. columns of `genotypes`
+    :param sites: genetic variants, i.e. rows of `genotypes`
+    :param genotypes: integer array of shape (len(sites), len(samples)) with numbers
+        of alternative alleles. Missing genotypes are `MISSING_GENOTYPE`
+    """
+
+    def __init__(
+        self, samples: List[PlinkSample], sites: List[PlinkSite], genotypes: np.ndarray
+    ):
+        genotypes = np.asarray(genotypes, dtype=np.int8)
+
+        if genotypes.shape != (len(sites), len(samples)):
+            raise ValueError(
+                f"Genotypes shape {genotypes.shape} doesn't match "
+                f"{len(sites)} sites and {len(samples)} samples"
+            )
+
+        self.samples = samples
+        self.sites = sites
+        self.genotypes = genotypes
+
+    @classmethod
+    def from_variants(cls, variants) -> "PlinkFileset":
+        """Build fileset from a queryset of `vcf_uploading.models.Variant`
+
+        Variants are fetched in a single query. Sites are sorted by genomic position.
+        If a sample has no variant at a site, its genotype is missing
+        """
+        rows = variants.filter(snp__isnull=False).values_list(
+            "sample_id",
+            "snp_id",
+            "snp__chromosome_id",
+            "snp__position",
+            "snp__name",
+            "snp__reference_allele_id",
+            "snp__alternative_allele_id",
+            "alleles_record_id",
+        )
+        return cls.from_calls(rows)
+
+    @classmethod
+    def from_calls(
+        cls, rows: Iterable[Tuple[str, int, int, int, str, str, str, Optional[str]]]
+    ) -> "PlinkFileset":
+        """Build fileset from (sample, SNP ID, chromosome, position, SNP name, REF, ALT,
+        alleles record) rows, e.g. genotypes of `vcf_uploading.models.Sample`
+        """
+        from vcf_uploading.models import Sample
+
+        sites_by_snp: Dict[int, PlinkSite] = {}
+        calls: List[Tuple[str, int, int]] = []
+
+        for sample_id, snp_id, chromosome, position, name, ref, alt, record in rows:
+            if snp_id not in sites_by_snp:
+                sites_by_snp[snp_id] = PlinkSite(
+                    chromosome=chromosome, position=position, ref=ref, alt=alt, name=name
+                )
+            genotype = (
+                alleles_record_to_genotype(record) if record else MISSING_GENOTYPE
+            )
+            calls.append((sample_id, snp_id, genotype))
+
+        samples_ids = sorted({sample_id for sample_id, _, _ in calls})
+        samples = [
+            PlinkSample(cypher=cypher, gender=gender)
+            for cypher, gender in Sample.objects.filter(cypher__in=samples_ids)
+            .order_by("cypher")
+            .values_list("cypher", "gender")
+        ]
+        sample_index = {sample.cypher: i for i, sample in enumerate(samples)}
+
+        snps_ids = sorted(
+            sites_by_snp,
+            key=lambda snp: (sites_by_snp[snp].chromosome, sites_by_snp[snp].position),
+        )
+        site_index = {snp_id: i for i, snp_id in enumerate(snps_ids)}
+
+        genotypes = np.full(
+            (len(snps_ids), len(samples)), MISSING_GENOTYPE, dtype=np.int8
+        )
+        for sample_id, snp_id, genotype in calls:
+            genotypes[site_index[snp_id], sample_index[sample_id]] = genotype
+
+        return cls(
+            samples=samples,
+            sites=[sites_by_snp[snp_id] for snp_id in snps_ids],
+            genotypes=genotypes,
+        )
+
+    def to_bed_bytes(self) -> bytes:
+        """Pack genotypes in SNP-major .bed format: 4 samples per byte"""
+        n_sites, n_samples = self.genotypes.shape
+        n_bytes_per_site = (n_samples + 3) // 4
+
+        codes = np.zeros((n_sites, n_bytes_per_site * 4), dtype=np.uint8)
+        codes[:, :n_samples] = _GENOTYPE_TO_BED_CODE[self.genotypes + 1]
+        codes = codes.reshape(n_sites, n_bytes_per_site, 4)
+
+        packed = (
+            codes[:, :, 0]
+            | (codes[:, :, 1] << 2)
+            | (codes[:, :, 2] << 4)
+            | (codes[:, :, 3] << 6)
+        )
+
+        return BED_MAGIC_NUMBER + BED_SNP_MAJOR_MODE + packed.tobytes()
+
+    def save(self, prefix: Path):
+        """Save fileset to `prefix`.bed, `prefix`.bim and `prefix`.fam"""
+        prefix = Path(prefix)
+
+        with open(prefix.with_name(prefix.name + ".bed"), "wb") as f:
+            f.write(self.to_bed_bytes())
+
+        with open(prefix.with_name(prefix.name + ".bim"), "w") as f:
+            f.writelines(site.to_bim_line() + "\n" for site in self.sites)
+
+        with open(prefix.with_name(prefix.name + ".fam"), "w") as f:
+            f.writelines(sample.to_fam_line() + "\n" for sample in self.samples)
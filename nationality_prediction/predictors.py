@@ -1,92 +1,172 @@
 import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Union
+from typing import TYPE_CHECKING, Dict, Optional, Union
 
+from asgiref.sync import async_to_sync, sync_to_async
 from django.contrib.staticfiles import finders
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils.translation import gettext_lazy as _
 from loguru import logger
-from pysam import VariantFile
 
-from nationality_prediction.command_line_tools import run_fastngsadmix, run_plink
-from nationality_prediction.constants import FAST_NGS_ADMIX_OUTPUT, VCF_FILENAME
+from nationality_prediction.command_line_tools import (
+    CommandLineToolError,
+    run_fastngsadmix,
+    run_plink,
+)
+from nationality_prediction.constants import (
+    FAST_NGS_ADMIX_OUTPUT,
+    NUMBER_OF_INDIVIDUALS_FILENAME,
+    PLINK_OUTPUT_PREFIX,
+    REFERENCE_PANEL_FILENAME,
+    VCF_FILENAME,
+)
 from vcf_uploading.vcf_processing import VCFFile
 
+if TYPE_CHECKING:
+    from pysam import VariantFile
+
+    from nationality_prediction.plink import PlinkFileset
+
+
+@lru_cache(maxsize=None)
+def find_static_file(name: str) -> Optional[str]:
+    """Return path of the static file `name`. Lookups are cached, as they scan directories"""
+    return finders.find(name)
 
-class FastNGSAdmixPredictor:
-    number_of_individuals_file = finders.find("nInd_MultiEthnic_2019_Popul.txt")
-    reference_panel_file = finders.find("refPanel_MultiEthnic_2019_Popul.txt")
 
-    def __init__(self, vcf: Union[VCFFile, InMemoryUploadedFile, VariantFile]):
+class FastNGSAdmixPredictor:
+    def __init__(
+        self, vcf: Union[VCFFile, InMemoryUploadedFile, "VariantFile", "PlinkFileset"]
+    ):
         self.vcf = vcf
+        self.number_of_individuals_file = find_static_file(NUMBER_OF_INDIVIDUALS_FILENAME)
+        self.reference_panel_file = find_static_file(REFERENCE_PANEL_FILENAME)
+        # Seconds spent in each stage of the last prediction, see `self.time_stage()`
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Measure time of the code in the `with` block and save it to `self.timings`
+
+        Stages of the prediction are "write" (saving the input to a temporary directory),
+        "conversion" (plink), "admixture" (fastNGSadmix) and "parse" (reading the result)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+            logger.debug("Stage {} took {:.3f} s", stage, self.timings[stage])
 
     def predict(self) -> Dict[str, float]:
+        """Predict nationalities from `self.vcf`. Synchronous version of `self.apredict()`
+
+        :return: dictionary, where keys are nationalities and values are their probabilities
+        """
+        return async_to_sync(self.apredict)()
+
+    async def apredict(self) -> Dict[str, float]:
         """Predict nationalities from `self.vcf`
 
         This function does the following steps:
         1. Create temporary directory
-        2. Save `self.vcf` file
+        2. Save `self.vcf` file. `PlinkFileset` is saved directly in plink binary format,
+           so conversion with plink is skipped
         3. Run command line tools with `self.run_command_line_tools()`
         4. Return result of the prediction
 
         :return: dictionary, where keys are nationalities and values are their probabilities
         """
+        from nationality_prediction.plink import PlinkFileset
+
+        self.timings = {}
+
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_dir_path = Path(tmp_dir)
-            vcf_file_path = tmp_dir_path / VCF_FILENAME
-
-            logger.info("Saving VCF")
-            if isinstance(self.vcf, VCFFile):
-                logger.info("Received VCFFile")
-                self.vcf.save(vcf_file_path)
-                predicted_nationalities = self.run_command_line_tools(tmp_dir_path)
-
-            elif isinstance(self.vcf, InMemoryUploadedFile):
-                logger.info("Received InMemoryUploadedFile")
-                with open(vcf_file_path, "w") as f:
-                    f.write(self.vcf.read().decode())
-                    predicted_nationalities = self.run_command_line_tools(tmp_dir_path)
-
-            elif isinstance(self.vcf, VariantFile):
-                # TODO: test if saved file is the same!
-                logger.info("Received VariantFile")
-                with open(vcf_file_path, "w") as temp_vcf:
-                    temp_vcf.write(str(self.vcf.header))
-                    for record in self.vcf.fetch():
-                        temp_vcf.write(str(record))
-
-                predicted_nationalities = self.run_command_line_tools(tmp_dir_path)
-                logger.debug("Last record: {}", str(record))
-
-            else:
-                raise ValueError(
-                    _(f"Type {type(self.vcf)} is not supported for VCF files")
-                )
-
-            return predicted_nationalities
-
-    def run_command_line_tools(self, directory: Path) -> Dict[str, float]:
+
+            with self.time_stage("write"):
+                if isinstance(self.vcf, PlinkFileset):
+                    logger.info("Received PlinkFileset, saving plink binary files")
+                    await sync_to_async(self.vcf.save, thread_sensitive=False)(
+                        tmp_dir_path / PLINK_OUTPUT_PREFIX
+                    )
+                    convert_vcf = False
+                else:
+                    logger.info("Saving VCF")
+                    await sync_to_async(self.save_vcf, thread_sensitive=False)(
+                        tmp_dir_path / VCF_FILENAME
+                    )
+                    convert_vcf = True
+
+            try:
+                return await self.run_command_line_tools(tmp_dir_path, convert_vcf)
+            except CommandLineToolError as e:
+                logger.error("Prediction of nationality has failed: {}", e)
+                return {"Not predicted": 0}
+
+    def save_vcf(self, vcf_file_path: Path):
+        """Write `self.vcf` to `vcf_file_path` as a plain text VCF file"""
+        from pysam import VariantFile
+
+        if isinstance(self.vcf, VCFFile):
+            logger.info("Received VCFFile")
+            self.vcf.save(vcf_file_path)
+
+        elif isinstance(self.vcf, InMemoryUploadedFile):
+            logger.info("Received InMemoryUploadedFile")
+            with open(vcf_file_path, "w") as f:
+                f.write(self.vcf.read().decode())
+
+        elif isinstance(self.vcf, VariantFile):
+            # TODO: test if saved file is the same!
+            logger.info("Received VariantFile")
+            with open(vcf_file_path, "w") as temp_vcf:
+                temp_vcf.write(str(self.vcf.header))
+                for record in self.vcf.fetch():
+                    temp_vcf.write(str(record))
+
+            logger.debug("Last record: {}", str(record))
+
+        else:
+            raise ValueError(
+                _(f"Type {type(self.vcf)} is not supported for VCF files")
+            )
+
+    async def run_command_line_tools(
+        self, directory: Path, convert_vcf: bool = True
+    ) -> Dict[str, float]:
         """Predict nationality for VCF-file in the`directory`
 
         :param directory: directory, which contains VCF file named `constants.VCF_FILENAME`
+            or plink binary files with prefix `constants.PLINK_OUTPUT_PREFIX`
+        :param convert_vcf: whether VCF file has to be converted with plink. Set to False
+            if the directory already contains plink binary files
 
         Pipeline for the prediction contains following steps:
-        1. Run plink to make .bed file from VCF
+        1. Run plink to make .bed file from VCF (if `convert_vcf` is True)
         2. Run fastNGSadmix to get .qopt file
         3. Process fastNGSadmix result and return it as a Python dictionary
 
         :return: dictionary, where keys are nationalities and values are their probabilities
         """
-        run_plink(directory)
-        run_fastngsadmix(
-            directory,
-            number_of_individuals_file=self.number_of_individuals_file,
-            ref_panel=self.reference_panel_file,
-        )
-
-        predicted_nationalities: Dict[str, float] = self.process_fastngsadmix_output(
-            directory / FAST_NGS_ADMIX_OUTPUT
-        )
+        if convert_vcf:
+            with self.time_stage("conversion"):
+                await run_plink(directory)
+
+        with self.time_stage("admixture"):
+            await run_fastngsadmix(
+                directory,
+                number_of_individuals_file=self.number_of_individuals_file,
+                ref_panel=self.reference_panel_file,
+            )
+
+        with self.time_stage("parse"):
+            predicted_nationalities: Dict[str, float] = self.process_fastngsadmix_output(
+                directory / FAST_NGS_ADMIX_OUTPUT
+            )
 
         return predicted_nationalities
 
@@ -1,3 +1,114 @@
-from django.test import TestCase
+import sys
+import tempfile
+import threading
+from pathlib import Path
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from nationality_prediction.command_line_tools import (
+    CommandLineToolError,
+    CommandLineToolTimeoutError,
+    run_command_line_tool,
+)
+from nationality_prediction.plink import PlinkFileset, PlinkSample, PlinkSite
+from vcf_uploading.models import (
+    SNP,
+    Allele,
+    AllelesRecord,
+    Chromosome,
+    Sample,
+    Variant,
+)
+
+
+class CommandLineToolsTestCase(SimpleTestCase):
+    def run_python(self, code: str, **kwargs):
+        return async_to_sync(run_command_line_tool)([sys.executable, "-c", code], **kwargs)
+
+    def test_output_is_captured(self):
+        result = self.run_python(
+            "import sys; print('out 1'); print('out 2'); print('err', file=sys.stderr)"
+        )
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "out 1\nout 2")
+        self.assertEqual(result.stderr, "err")
+
+    def test_non_zero_return_code_raises(self):
+        with self.assertRaises(CommandLineToolError):
+            self.run_python("import sys; sys.exit(3)")
+
+    def test_missing_tool_raises(self):
+        with self.assertRaises(CommandLineToolError):
+            async_to_sync(run_command_line_tool)(["surely-not-an-installed-tool"])
+
+    @override_settings(COMMAND_LINE_TOOLS_TIMEOUT=0.5)
+    def test_hung_tool_is_killed(self):
+        with self.assertRaises(CommandLineToolTimeoutError):
+            self.run_python("import time; time.sleep(30)")
+
+    @override_settings(COMMAND_LINE_TOOLS_MAX_CONCURRENCY=1)
+    def test_limit_is_shared_by_event_loops_of_threads(self):
+        intervals = []
+
+        def run():
+            # Every call of async_to_sync from a thread has its own event loop
+            result = self.run_python(
+                "import time; start = time.time(); time.sleep(0.3); "
+                "print(start, time.time())"
+            )
+            intervals.append(tuple(map(float, result.stdout.split())))
+
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        (_, first_end), (second_start, _) = sorted(intervals)
+        self.assertGreaterEqual(second_start, first_end)
+
+
+class PlinkFilesetTestCase(TestCase):
+    def test_bed_packing(self):
+        fileset = PlinkFileset(
+            samples=[PlinkSample(cypher=str(i)) for i in range(5)],
+            sites=[PlinkSite(chromosome=1, position=100, ref="A", alt="G")],
+            genotypes=[[0, 1, 2, -1, 0]],
+        )
+
+        # Magic number, SNP-major mode, then codes 11 10 00 01 | 11 from the lowest bits
+        self.assertEqual(
+            fileset.to_bed_bytes(), bytes((0x6C, 0x1B, 0x01, 0b01001011, 0b00000011))
+        )
+
+    def test_fileset_from_variants(self):
+        chromosome = Chromosome.objects.create(number=2)
+        a, g, c = (Allele.objects.create(genotype=genotype) for genotype in "AGC")
+        sample = Sample.objects.create(cypher="S1", gender=Sample.Gender.FEMALE)
+        snp_1 = SNP.objects.create(
+            name="rs1", chromosome=chromosome, position=20, reference_allele=a,
+            alternative_allele=g,
+        )
+        snp_2 = SNP.objects.create(
+            chromosome=chromosome, position=10, reference_allele=c, alternative_allele=a
+        )
+        Variant.objects.create(
+            sample=sample, snp=snp_1, alleles_record=AllelesRecord.objects.create(record="1/1")
+        )
+        Variant.objects.create(
+            sample=sample, snp=snp_2, alleles_record=AllelesRecord.objects.create(record="0/1")
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = Path(tmp_dir) / "sample"
+            sample.to_plink().save(prefix)
+
+            bim = (Path(tmp_dir) / "sample.bim").read_text()
+            fam = (Path(tmp_dir) / "sample.fam").read_text()
+            bed = (Path(tmp_dir) / "sample.bed").read_bytes()
+
+        self.assertEqual(bim, "2\t.\t0\t10\tA\tC\n2\trs1\t0\t20\tG\tA\n")
+        self.assertEqual(fam, "S1\tS1\t0\t0\t2\t-9\n")
+        self.assertEqual(bed[3:], bytes((0b10, 0b00)))
@@ -4,10 +4,11 @@ from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils.translation import gettext_lazy as _
 from loguru import logger
-from pysam import VariantFile
 
 
 def check_number_of_samples(file: InMemoryUploadedFile):
+    from pysam import VariantFile
+
     with tempfile.NamedTemporaryFile(suffix=".vcf") as f:
         f.write(file.read())
         file.seek(0)
@@ -1,10 +1,11 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 from loguru import logger
 
 from nationality_prediction.forms import VCFUploadForm
 
 
-def upload_genotype_for_prediction(
+async def upload_genotype_for_prediction(
     request,
     form_class=VCFUploadForm,
     form_template="vcf_upload.html",
@@ -17,11 +18,11 @@ def upload_genotype_for_prediction(
         form = form_class(request.POST, request.FILES)
         logger.debug("REQUEST.FILES: {}", request.FILES)
 
-        if form.is_valid():
+        if await sync_to_async(form.is_valid)():
             logger.success("Form is valid, trying to predict genotype")
             logger.debug(form)
             vcf_file = form.files["vcf_file"]
-            result = form.predict_nationality(vcf_file)
+            result = await form.predict_nationality(vcf_file)
             return render(request, result_template, {"predicted_nationalities": result})
         else:
             logger.warning("Something has failed")
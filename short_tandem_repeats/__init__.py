@@ -0,0 +1 @@
+default_app_config = "short_tandem_repeats.apps.ShortTandemRepeatsConfig"
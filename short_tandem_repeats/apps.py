@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ShortTandemRepeatsConfig(AppConfig):
     name = 'short_tandem_repeats'
+
+    def ready(self):
+        from short_tandem_repeats.versions import connect_signals
+
+        connect_signals()
@@ -5,6 +5,7 @@ from django.utils.translation import gettext_lazy as _
 from loguru import logger
 
 from short_tandem_repeats.models import STRFile, ShortTandemRepeat, STRRegion, NRepeats
+from short_tandem_repeats.types import MatchingMode
 
 
 class ListTextWidget(forms.TextInput):
@@ -34,7 +35,7 @@ class STRFileForm(ModelForm):
     class Meta:
         model = STRFile
         fields = ["file"]
-        labels = {"file": _("Excel file with short tandem repeats")}
+        labels = {"file": _("File with short tandem repeats (xlsx, csv, tsv or parquet)")}
 
 
 class STRSearchForm(forms.Form):
@@ -49,6 +50,12 @@ class STRSearchForm(forms.Form):
         required=True,
         label=_("Number of repeats"),
     )
+    tolerance = forms.FloatField(
+        min_value=0,
+        required=False,
+        initial=0,
+        label=_("Tolerance"),
+    )
 
     def __init__(self, *args, **kwargs):
         repeats_list = kwargs.pop("repeats_list", [])
@@ -57,3 +64,12 @@ class STRSearchForm(forms.Form):
 
         self.fields["n_repeats"].widget = ListTextWidget(data_list=repeats_list,
                                                          name="repeats-list")
+
+
+class STRSearchOptionsForm(forms.Form):
+    mode = forms.ChoiceField(
+        choices=MatchingMode.choices,
+        initial=MatchingMode.EXACT,
+        required=False,
+        label=_("Matching mode"),
+    )
@@ -0,0 +1,175 @@
+"""Matching of STR profiles with tolerance on a numeric matrix of repeats"""
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from short_tandem_repeats.models import ShortTandemRepeat
+
+_ALLELES_SEPARATOR = re.compile(r"[,/;\s]+")
+
+
+def parse_n_repeats(value: str) -> List[float]:
+    """Parse repeat call into numbers of repeats of its alleles
+
+    Examples: "12" -> [12.0], "9.3" (microvariant) -> [9.3], "12,14" -> [12.0, 14.0].
+    Non-numeric alleles (e.g. "X" of amelogenin) are skipped
+    """
+    alleles = []
+
+    for allele in _ALLELES_SEPARATOR.split(value.strip()):
+        try:
+            alleles.append(float(allele))
+        except ValueError:
+            continue
+
+    return alleles
+
+
+class RepeatMatrix:
+    """Numbers of repeats of samples in regions
+
+    :param samples: cyphers of samples, i.e. the first axis of `alleles`
+    :param regions: titles of regions, i.e. the second axis of `alleles`
+    :param alleles: float array of shape (samples, regions, 2) with numbers of repeats of
+        two alleles. Homozygous calls have the same number twice. Missing calls are NaN
+    :param version: version of the data the matrix was built from
+    """
+
+    def __init__(
+        self,
+        samples: List[str],
+        regions: List[str],
+        alleles: np.ndarray,
+        version: Optional[int] = None,
+    ):
+        self.samples = samples
+        self.regions = regions
+        self.region_index = {region: i for i, region in enumerate(regions)}
+        self.alleles = alleles
+        self.version = version
+
+    @classmethod
+    def build(
+        cls, repeats: Iterable[Tuple[str, str, str]], version: Optional[int] = None
+    ):
+        """Build matrix from (sample, region, number of repeats) triples
+
+        If a sample has more than two alleles in a region, the shortest and the longest
+        ones are kept
+        """
+        sample_index: Dict[str, int] = {}
+        region_index: Dict[str, int] = {}
+        calls: Dict[Tuple[int, int], List[float]] = defaultdict(list)
+
+        for sample, region, n_repeats in repeats:
+            alleles = parse_n_repeats(n_repeats)
+            if not alleles:
+                continue
+
+            sample_i = sample_index.setdefault(sample, len(sample_index))
+            region_i = region_index.setdefault(region, len(region_index))
+            calls[sample_i, region_i].extend(alleles)
+
+        matrix = np.full((len(sample_index), len(region_index), 2), np.nan, dtype=np.float32)
+        for (sample_i, region_i), alleles in calls.items():
+            matrix[sample_i, region_i] = min(alleles), max(alleles)
+
+        return cls(
+            samples=list(sample_index), regions=list(region_index), alleles=matrix, version=version
+        )
+
+    @classmethod
+    def from_db(cls) -> "RepeatMatrix":
+        from short_tandem_repeats.versions import get_db_version
+
+        version = get_db_version()
+        repeats = ShortTandemRepeat.objects.values_list(
+            "sample_id", "region_id", "n_repeats_id"
+        ).iterator(chunk_size=10000)
+
+        return cls.build(repeats, version=version)
+
+    def get_loci_scores(
+        self,
+        profile: Dict[str, List[float]],
+        tolerances: Dict[str, float],
+        mixture: bool = False,
+    ) -> np.ndarray:
+        """Calculate how well each sample matches each region of `profile`
+
+        Alleles match if their numbers of repeats differ by no more than the tolerance of
+        the region. Score of a region is:
+        * in the default mode: the fraction of `profile` alleles matched by the sample
+        * in the mixture mode: the fraction of sample's alleles found in `profile`, as any
+          contributor of a mixture has only some of its alleles
+
+        :param profile: dictionary, where keys are regions and values are numbers of repeats
+            of alleles. In the mixture mode there can be more than 2 alleles
+        :param tolerances: maximum difference of numbers of repeats for each region
+        :param mixture: whether `profile` is a mixture of several contributors
+        :return: array of shape (samples, regions of `profile`) with scores from 0 to 1.
+            Samples without a call in a region get 0
+        """
+        n_alleles = max((len(alleles) for alleles in profile.values()), default=0)
+        query = np.full((len(profile), max(n_alleles, 1)), np.nan, dtype=np.float32)
+        tolerance = np.zeros(len(profile), dtype=np.float32)
+        samples_alleles = np.full(
+            (len(self.samples), len(profile), 2), np.nan, dtype=np.float32
+        )
+
+        for i, (region, alleles) in enumerate(profile.items()):
+            query[i, : len(alleles)] = alleles
+            tolerance[i] = tolerances.get(region, 0)
+            if region in self.region_index:
+                samples_alleles[:, i] = self.alleles[:, self.region_index[region]]
+
+        # Shape: (samples, regions, query alleles, sample alleles). Comparisons with NaN
+        # are False, so missing alleles never match. A small epsilon compensates
+        # rounding of microvariants, e.g. 10 - 9.3
+        is_close = (
+            np.abs(query[None, :, :, None] - samples_alleles[:, :, None, :])
+            <= tolerance[None, :, None, None] + 1e-4
+        )
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if mixture:
+                is_sample_allele = ~np.isnan(samples_alleles)
+                scores = (is_close.any(axis=2) & is_sample_allele).sum(axis=2) / (
+                    is_sample_allele.sum(axis=2)
+                )
+            else:
+                is_query_allele = ~np.isnan(query)
+                scores = (is_close.any(axis=3) & is_query_allele).sum(axis=2) / (
+                    is_query_allele.sum(axis=1)
+                )
+
+        return np.nan_to_num(scores, nan=0.0)
+
+    def match(
+        self,
+        profile: Dict[str, List[float]],
+        tolerances: Dict[str, float],
+        mixture: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, float, List[float]]]:
+        """Rank samples by the sum of scores of `profile` regions
+
+        See `self.get_loci_scores()` for the description of parameters
+
+        :param limit: maximum number of returned samples. All matching samples by default
+        :return: list of (sample, score, scores of regions) for samples with a positive score,
+            sorted by the score in the descending order
+        """
+        loci_scores = self.get_loci_scores(profile, tolerances, mixture=mixture)
+        scores = loci_scores.sum(axis=1)
+        matched = np.flatnonzero(scores > 0)
+
+        order = matched[np.lexsort((matched, -scores[matched]))]
+        if limit is not None:
+            order = order[:limit]
+
+        return [
+            (self.samples[i], float(scores[i]), loci_scores[i].tolist()) for i in order
+        ]
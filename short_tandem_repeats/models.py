@@ -1,8 +1,13 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
 from django.core.validators import FileExtensionValidator
-from django.db import models
-import pandas as pd
+from django.db import models, transaction
 from loguru import logger
 
+from short_tandem_repeats.readers import STR_FILE_EXTENSIONS, STRTableReader
+from short_tandem_repeats.versions import increase_db_version
+
 
 class Sample(models.Model):
     cypher = models.CharField(max_length=255, primary_key=True)
@@ -23,6 +28,9 @@ class NRepeats(models.Model):
 
 
 class ShortTandemRepeat(models.Model):
+    class Meta:
+        unique_together = (("sample", "region", "n_repeats"),)
+
     sample = models.ForeignKey(to=Sample, on_delete=models.CASCADE)
     region = models.ForeignKey(to=STRRegion, on_delete=models.CASCADE)
     n_repeats = models.ForeignKey(to=NRepeats, on_delete=models.SET("-"))
@@ -31,27 +39,142 @@ class ShortTandemRepeat(models.Model):
 class STRFile(models.Model):
     file = models.FileField(
         upload_to="raw_data/str/",
-        validators=[FileExtensionValidator(allowed_extensions=["xlsx"])]
+        validators=[FileExtensionValidator(allowed_extensions=STR_FILE_EXTENSIONS)]
     )
-
-    def save_to_db(self):
-        df = pd.read_excel(self.file.path, engine="openpyxl")
-
-        logger.info("Saving df to the database")
-        logger.debug("df shape: {}", df.shape)
-
-        for idx, row in df.iterrows():
-            logger.debug("Saving row {}", idx)
-
-            db_sample, _ = Sample.objects.get_or_create(cypher=row["Sample"])
-            db_sample.save()
-
-            for region in df.columns[1:]:
-                db_region, _ = STRRegion.objects.get_or_create(title=region)
-                db_region.save()
-
-                db_n_repeats, _ = NRepeats.objects.get_or_create(n_repeats=str(row[region]))
-
-                repeat, _ = ShortTandemRepeat.objects.get_or_create(
-                    sample=db_sample, region=db_region, n_repeats=db_n_repeats)
-                repeat.save()
+    # Header of the file. Filled when the file is saved to the database
+    columns = models.JSONField(default=list, blank=True)
+    n_rows = models.IntegerField(default=0)
+
+    @property
+    def regions(self) -> List[str]:
+        return self.columns[1:]
+
+    def get_table_page(
+        self, page: int, page_size: int, regions: Optional[List[str]] = None
+    ) -> List[List[str]]:
+        """Return rows of the file from the database, as they were saved by `self.save_to_db()`
+
+        Values are read from rows of this file, so samples, which are in other files too,
+        show only values from this one. Only 1 query is made, so the time doesn't depend
+        on the size of the file
+
+        :param page: number of the page, starting from 1
+        :param page_size: number of rows on the page
+        :param regions: columns to return. By default, all the regions of the file
+        :return: rows, each of them starting with the sample's cypher and followed by numbers
+            of repeats in `regions`. Empty cells are empty strings
+        """
+        regions = self.regions if regions is None else regions
+        start = (page - 1) * page_size
+
+        rows = (
+            self.rows.filter(row__gte=start, row__lt=start + page_size)
+            .order_by("row")
+            .values_list("sample_id", "repeats")
+        )
+
+        return [
+            [cypher] + [repeats.get(region, "") for region in regions]
+            for cypher, repeats in rows
+        ]
+
+    def get_reader(self, chunk_size: int = 1000) -> STRTableReader:
+        return STRTableReader(self.file.path, chunk_size=chunk_size)
+
+    def save_to_db(self, chunk_size: int = 5000):
+        """Save repeats from the file to the database
+
+        The file is read in chunks of `chunk_size` rows. Each chunk is converted to the long
+        format (one row per sample and region) and inserted with a few bulk queries.
+        All chunks are saved in one transaction. Rows, which are already in the database,
+        are skipped, so the file can be saved again. Empty cells are not saved
+        """
+        reader = self.get_reader(chunk_size=chunk_size)
+        sample_column, *regions = reader.columns
+
+        logger.info("Saving {} to the database", self.file.name)
+        logger.debug("Regions: {}", regions)
+
+        n_repeats_saved = 0
+        n_rows = 0
+
+        with transaction.atomic():
+            STRRegion.objects.bulk_create(
+                [STRRegion(title=title) for title in regions], ignore_conflicts=True
+            )
+
+            for df in reader.iter_chunks():
+                repeats = df.melt(
+                    id_vars=[sample_column],
+                    value_vars=regions,
+                    var_name="region",
+                    value_name="n_repeats",
+                ).dropna()
+
+                Sample.objects.bulk_create(
+                    [Sample(cypher=cypher) for cypher in df[sample_column].dropna().unique()],
+                    ignore_conflicts=True,
+                )
+                NRepeats.objects.bulk_create(
+                    [NRepeats(n_repeats=n_repeats) for n_repeats in repeats["n_repeats"].unique()],
+                    ignore_conflicts=True,
+                )
+                ShortTandemRepeat.objects.bulk_create(
+                    [
+                        ShortTandemRepeat(
+                            sample_id=sample, region_id=region, n_repeats_id=n_repeats
+                        )
+                        for sample, region, n_repeats in repeats[
+                            [sample_column, "region", "n_repeats"]
+                        ].itertuples(index=False)
+                    ],
+                    ignore_conflicts=True,
+                )
+
+                samples = df[[sample_column, *regions]].dropna(subset=[sample_column])
+                STRFileRow.objects.bulk_create(
+                    [
+                        STRFileRow(
+                            str_file=self,
+                            row=row,
+                            sample_id=cypher,
+                            repeats={
+                                region: value
+                                for region, value in zip(regions, values)
+                                if value is not None
+                            },
+                        )
+                        for row, (cypher, *values) in enumerate(
+                            samples.itertuples(index=False, name=None), start=n_rows
+                        )
+                    ],
+                    ignore_conflicts=True,
+                )
+
+                n_rows += len(samples)
+                n_repeats_saved += len(repeats)
+                logger.debug("{} repeats processed", n_repeats_saved)
+
+            self.columns = reader.columns
+            self.n_rows = n_rows
+            self.save()
+            # Bulk inserts don't send signals
+            increase_db_version()
+
+        from short_tandem_repeats.search import invalidate_caches
+
+        invalidate_caches()
+        logger.info("Saved {} repeats", n_repeats_saved)
+
+
+class STRFileRow(models.Model):
+    """Sample in a row of STRFile. Allows to show the file page by page from the database"""
+
+    class Meta:
+        unique_together = (("str_file", "row"),)
+
+    str_file = models.ForeignKey(to=STRFile, on_delete=models.CASCADE, related_name="rows")
+    row = models.IntegerField()
+    sample = models.ForeignKey(to=Sample, on_delete=models.CASCADE)
+    # Numbers of repeats of the row by region. Empty cells are skipped
+    repeats = models.JSONField(default=dict, blank=True)
@@ -0,0 +1,112 @@
+"""Streaming readers of tables with short tandem repeats
+
+Tables have samples in the first column and STR regions in the other ones. Supported
+formats are Excel (.xlsx), CSV, TSV and Parquet. Rows are read in chunks, so memory usage
+doesn't depend on the size of the file
+"""
+import csv
+import math
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+STR_FILE_EXTENSIONS = ["xlsx", "csv", "tsv", "parquet"]
+
+
+def format_value(value: Any) -> Optional[str]:
+    """Convert cell value to a string. Empty cells are converted to None
+
+    Integral floats lose their fractional part, so 12 is the same whether it is stored
+    as an integer or as a float (e.g. in a column with empty cells)
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    value = str(value).strip()
+    return value or None
+
+
+class STRTableReader:
+    """Read STR table from `path` in chunks of `chunk_size` rows
+
+    All values are converted to strings with `format_value`
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 1000):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.extension = self.path.suffix.lstrip(".").lower()
+
+        if self.extension not in STR_FILE_EXTENSIONS:
+            raise ValueError(f"Files with extension {self.extension} are not supported")
+
+        self._columns: Optional[List[str]] = None
+
+    @property
+    def columns(self) -> List[str]:
+        if self._columns is None:
+            rows = self._iter_raw_rows()
+            self._columns = [format_value(column) or "" for column in next(rows, [])]
+            rows.close()
+        return self._columns
+
+    def iter_rows(self) -> Iterator[List[Optional[str]]]:
+        """Yield rows without the header. Values are formatted with `format_value`"""
+        rows = self._iter_raw_rows()
+        next(rows, None)  # Skip the header
+
+        for row in rows:
+            if any(value is not None for value in row):
+                yield [format_value(value) for value in row]
+
+    def iter_chunks(self) -> Iterator["pd.DataFrame"]:
+        """Yield data frames with `self.columns` and at most `self.chunk_size` rows"""
+        import pandas as pd
+
+        columns = self.columns
+        rows = self.iter_rows()
+
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield pd.DataFrame(
+                [row[: len(columns)] for row in chunk], columns=columns, dtype=object
+            )
+
+    def _iter_raw_rows(self) -> Iterator[list]:
+        if self.extension == "xlsx":
+            yield from self._iter_excel_rows()
+        elif self.extension == "parquet":
+            yield from self._iter_parquet_rows()
+        else:
+            yield from self._iter_csv_rows(delimiter="\t" if self.extension == "tsv" else ",")
+
+    def _iter_excel_rows(self) -> Iterator[list]:
+        from openpyxl import load_workbook
+
+        # In read only mode cells are parsed lazily, without loading the whole workbook
+        workbook = load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+
+    def _iter_csv_rows(self, delimiter: str) -> Iterator[list]:
+        with open(self.path, newline="") as f:
+            yield from csv.reader(f, delimiter=delimiter)
+
+    def _iter_parquet_rows(self) -> Iterator[list]:
+        from pyarrow.parquet import ParquetFile
+
+        parquet_file = ParquetFile(self.path)
+        yield parquet_file.schema_arrow.names
+
+        for batch in parquet_file.iter_batches(batch_size=self.chunk_size):
+            yield from zip(*(column.to_pylist() for column in batch.columns))
@@ -0,0 +1,265 @@
+"""Search of samples by STR profiles
+
+Exact search uses an in-memory inverted index, search with tolerance uses a numeric
+matrix of repeats. Both are cached in memory of the process
+"""
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from short_tandem_repeats.matching import RepeatMatrix, parse_n_repeats
+from short_tandem_repeats.models import ShortTandemRepeat
+from short_tandem_repeats.types import LocusMatch, STRMatch
+from short_tandem_repeats.versions import get_db_version
+
+Locus = Tuple[str, str]  # (region, number of repeats)
+
+
+class STRIndex:
+    """Inverted index from (region, number of repeats) to indices of samples having it
+
+    :param samples: cyphers of samples. Postings contain indices in this list
+    :param postings: dictionary, where keys are (region, number of repeats) and values
+        are sorted arrays of samples' indices
+    :param version: version of the data the index was built from
+    """
+
+    def __init__(
+        self,
+        samples: List[str],
+        postings: Dict[Locus, np.ndarray],
+        version: Optional[int],
+    ):
+        self.samples = samples
+        self.postings = postings
+        self.version = version
+
+    @classmethod
+    def build(
+        cls, repeats: Iterable[Tuple[str, str, str]], version: Optional[int] = None
+    ):
+        """Build index from (sample, region, number of repeats) triples"""
+        sample_index: Dict[str, int] = {}
+        postings: Dict[Locus, List[int]] = defaultdict(list)
+
+        for sample, region, n_repeats in repeats:
+            if sample not in sample_index:
+                sample_index[sample] = len(sample_index)
+            postings[region, n_repeats].append(sample_index[sample])
+
+        return cls(
+            samples=list(sample_index),
+            postings={
+                locus: np.unique(np.array(indices, dtype=np.int32))
+                for locus, indices in postings.items()
+            },
+            version=version,
+        )
+
+    @classmethod
+    def from_db(cls) -> "STRIndex":
+        version = get_db_version()
+        repeats = ShortTandemRepeat.objects.values_list(
+            "sample_id", "region_id", "n_repeats_id"
+        ).iterator(chunk_size=10000)
+
+        return cls.build(repeats, version=version)
+
+    def rank(
+        self, profile: Iterable[Locus], limit: Optional[int] = None
+    ) -> List[Tuple[str, int]]:
+        """Rank samples by the number of regions matching `profile`
+
+        If `profile` has several numbers of repeats for a region (e.g. a heterozygous
+        locus), the region matches when any of them matches
+
+        :param profile: list of (region, number of repeats)
+        :param limit: maximum number of returned samples. All matching samples by default
+        :return: list of (sample, number of matching regions) for samples with at least one
+            match, sorted by the number of matches in the descending order
+        """
+        values_by_region: Dict[str, set] = defaultdict(set)
+        for region, n_repeats in profile:
+            values_by_region[region].add(n_repeats)
+
+        matched_indices = []
+        for region, values in values_by_region.items():
+            region_postings = [
+                self.postings[region, value]
+                for value in values
+                if (region, value) in self.postings
+            ]
+            if len(region_postings) == 1:
+                matched_indices.append(region_postings[0])
+            elif region_postings:
+                matched_indices.append(np.unique(np.concatenate(region_postings)))
+
+        if not matched_indices:
+            return []
+
+        scores = np.bincount(np.concatenate(matched_indices), minlength=len(self.samples))
+        matched = np.flatnonzero(scores)
+
+        if limit is not None and len(matched) > limit:
+            # Select the best `limit` samples in linear time before sorting them.
+            # Ties at the boundary are broken by the position of the sample
+            threshold = -np.partition(-scores[matched], limit - 1)[limit - 1]
+            best = matched[scores[matched] > threshold]
+            tied = matched[scores[matched] == threshold][: limit - len(best)]
+            matched = np.concatenate([best, tied])
+
+        # Sort by score descending, then by the position of the sample
+        order = matched[np.lexsort((matched, -scores[matched]))]
+
+        return [(self.samples[i], int(scores[i])) for i in order]
+
+
+_caches: Dict[type, Any] = {}
+_caches_lock = threading.Lock()
+
+
+def _get_cached(cls):
+    """Return `cls.from_db()` cached in memory of the process
+
+    The cached object is rebuilt when repeats are saved or deleted, e.g. by another
+    worker, see `short_tandem_repeats.versions`. `cls` must have a `version` attribute
+    """
+    version = get_db_version()
+
+    with _caches_lock:
+        cached = _caches.get(cls)
+
+        if cached is None or cached.version != version:
+            logger.info("Building {}", cls.__name__)
+            cached = _caches[cls] = cls.from_db()
+
+        return cached
+
+
+def get_index() -> STRIndex:
+    """Return index of all repeats in the database"""
+    return _get_cached(STRIndex)
+
+
+def get_repeat_matrix() -> RepeatMatrix:
+    """Return numeric matrix of all repeats in the database"""
+    return _get_cached(RepeatMatrix)
+
+
+def invalidate_caches():
+    with _caches_lock:
+        _caches.clear()
+
+
+def get_samples_repeats(
+    samples: List[str], regions: List[str]
+) -> Dict[str, Dict[str, List[str]]]:
+    """Return numbers of repeats of `samples` in `regions` as they are stored in the database"""
+    samples_values: Dict[str, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+    repeats = (
+        ShortTandemRepeat.objects.filter(sample_id__in=samples, region_id__in=regions)
+        .order_by("n_repeats")
+        .values_list("sample_id", "region_id", "n_repeats_id")
+    )
+
+    for sample, region, n_repeats in repeats:
+        samples_values[sample][region].append(n_repeats)
+
+    return samples_values
+
+
+def get_query_values(profile: List[Locus]) -> Dict[str, List[str]]:
+    """Group numbers of repeats in `profile` by region keeping their order"""
+    query_values: Dict[str, List[str]] = defaultdict(list)
+
+    for region, n_repeats in profile:
+        if n_repeats not in query_values[region]:
+            query_values[region].append(n_repeats)
+
+    return query_values
+
+
+def search_by_profile(profile: List[Locus], max_results: int = 100) -> List[STRMatch]:
+    """Find samples with the most regions matching `profile`
+
+    :param profile: list of (region, number of repeats)
+    :param max_results: maximum number of returned samples
+    :return: matches sorted by the number of matching regions in the descending order.
+        Each of them contains numbers of repeats of the sample in the regions of `profile`
+    """
+    ranking = get_index().rank(profile, limit=max_results)
+    query_values = get_query_values(profile)
+    samples_values = get_samples_repeats(
+        [sample for sample, _ in ranking], list(query_values)
+    )
+
+    return [
+        STRMatch(
+            sample=sample,
+            n_matches=n_matches,
+            score=n_matches,
+            loci=[
+                LocusMatch(
+                    region=region,
+                    query_n_repeats=values,
+                    sample_n_repeats=samples_values[sample][region],
+                    score=float(bool(set(values) & set(samples_values[sample][region]))),
+                )
+                for region, values in query_values.items()
+            ],
+        )
+        for sample, n_matches in ranking
+    ]
+
+
+def search_with_tolerance(
+    profile: List[Locus],
+    tolerances: Optional[Dict[str, float]] = None,
+    mixture: bool = False,
+    max_results: int = 100,
+) -> List[STRMatch]:
+    """Find samples with the most similar numbers of repeats to `profile`
+
+    See `RepeatMatrix.match()` for the description of scores
+
+    :param profile: list of (region, number of repeats). Number of repeats can contain
+        several comma-separated alleles, e.g. "12,14", or microvariants, e.g. "9.3"
+    :param tolerances: maximum difference of numbers of repeats for each region.
+        Regions without tolerance must match exactly
+    :param mixture: whether `profile` is a mixture of several contributors
+    :param max_results: maximum number of returned samples
+    :return: matches sorted by the score in the descending order
+    """
+    query_values = get_query_values(profile)
+    query_alleles = {
+        region: [allele for value in values for allele in parse_n_repeats(value)]
+        for region, values in query_values.items()
+    }
+
+    ranking = get_repeat_matrix().match(
+        query_alleles, tolerances=tolerances or {}, mixture=mixture, limit=max_results
+    )
+    samples_values = get_samples_repeats(
+        [sample for sample, _, _ in ranking], list(query_values)
+    )
+
+    return [
+        STRMatch(
+            sample=sample,
+            n_matches=int(sum(score == 1 for score in loci_scores)),
+            score=round(score, 2),
+            loci=[
+                LocusMatch(
+                    region=region,
+                    query_n_repeats=values,
+                    sample_n_repeats=samples_values[sample][region],
+                    score=round(locus_score, 2),
+                )
+                for (region, values), locus_score in zip(query_values.items(), loci_scores)
+            ],
+        )
+        for sample, score, loci_scores in ranking
+    ]
@@ -1,3 +1,275 @@
-from django.test import TestCase
+from pathlib import Path
 
-# Create your tests here.
+import pandas as pd
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+
+from exome_p.testing import TemporaryMediaMixin
+from short_tandem_repeats.matching import RepeatMatrix, parse_n_repeats
+from short_tandem_repeats.models import (
+    NRepeats,
+    Sample,
+    ShortTandemRepeat,
+    STRFile,
+    STRRegion,
+)
+from short_tandem_repeats.search import (
+    STRIndex,
+    get_index,
+    get_repeat_matrix,
+    invalidate_caches,
+    search_by_profile,
+)
+from short_tandem_repeats.versions import get_db_version
+
+
+class STRFileTestCase(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        invalidate_caches()
+
+    def create_str_file(self, df: pd.DataFrame, name: str = "repeats.xlsx") -> STRFile:
+        path = Path(self.media_root) / name
+        df.to_excel(path, index=False, engine="openpyxl")
+        return STRFile.objects.create(file=name)
+
+    def test_save_to_db(self):
+        str_file = self.create_str_file(
+            pd.DataFrame(
+                {
+                    "Sample": ["S1", "S2", 3],
+                    "D3S1358": [15, 16, 15],
+                    "TH01": [9.3, 6, None],
+                }
+            )
+        )
+
+        with self.assertNumQueries(8):  # 5 inserts, 1 update, savepoint and its release
+            str_file.save_to_db()
+        str_file.save_to_db()
+
+        # The empty cell is not saved
+        self.assertEqual(ShortTandemRepeat.objects.count(), 5)
+        self.assertEqual(STRRegion.objects.count(), 2)
+        self.assertEqual(NRepeats.objects.count(), 4)
+        self.assertTrue(
+            ShortTandemRepeat.objects.filter(
+                sample_id="3", region_id="D3S1358", n_repeats_id="15"
+            ).exists()
+        )
+        self.assertTrue(
+            ShortTandemRepeat.objects.filter(
+                sample_id="S2", region_id="TH01", n_repeats_id="6"
+            ).exists()
+        )
+
+    def test_csv_file_is_read_in_chunks(self):
+        path = Path(self.media_root) / "repeats.tsv"
+        path.write_text("Sample\tD3S1358\tTH01\nS1\t15\t9.3\nS2\t16\t\nS3\t17\t7\n")
+        str_file = STRFile.objects.create(file="repeats.tsv")
+
+        reader = str_file.get_reader(chunk_size=2)
+        self.assertEqual(reader.columns, ["Sample", "D3S1358", "TH01"])
+        self.assertEqual([len(chunk) for chunk in reader.iter_chunks()], [2, 1])
+
+        str_file.save_to_db(chunk_size=2)
+        self.assertEqual(ShortTandemRepeat.objects.count(), 5)
+
+    def test_parquet_file_is_read_in_batches(self):
+        pd.DataFrame(
+            {"Sample": ["S1", "S2", "S3"], "D3S1358": [15, 16, 17], "TH01": [9.3, None, 7]}
+        ).to_parquet(Path(self.media_root) / "repeats.parquet", index=False)
+        str_file = STRFile.objects.create(file="repeats.parquet")
+
+        reader = str_file.get_reader(chunk_size=2)
+        self.assertEqual(reader.columns, ["Sample", "D3S1358", "TH01"])
+        self.assertEqual(
+            list(reader.iter_rows()),
+            [["S1", "15", "9.3"], ["S2", "16", None], ["S3", "17", "7"]],
+        )
+
+        str_file.save_to_db(chunk_size=2)
+        self.assertEqual(ShortTandemRepeat.objects.count(), 5)
+
+    def test_table_page_is_read_from_db(self):
+        path = Path(self.media_root) / "repeats.csv"
+        path.write_text("Sample,D3S1358,TH01\nS1,15,9.3\nS2,16,\nS3,17,7\n")
+        str_file = STRFile.objects.create(file="repeats.csv")
+        str_file.save_to_db()
+        path.unlink()  # The page must not depend on the file
+        # Values of S2 from another file are not shown on the page of this one
+        Path(self.media_root, "other.csv").write_text("Sample,D3S1358,TH01\nS2,18,8\n")
+        STRFile.objects.create(file="other.csv").save_to_db()
+
+        response = self.client.get(
+            reverse("str_view", args=[str_file.pk]),
+            {"page": 2, "page_size": 1, "regions": "TH01", "format": "json"},
+        )
+
+        self.assertEqual(
+            response.json(),
+            {
+                "name": "repeats.csv",
+                "columns": ["Sample", "TH01"],
+                "rows": [["S2", ""]],
+                "page": 2,
+                "n_pages": 3,
+                "n_rows": 3,
+            },
+        )
+
+        response = self.client.get(reverse("str_view", args=[str_file.pk]))
+        self.assertContains(response, "Page 1 of 1")
+
+    def test_file_is_saved_only_by_post_request(self):
+        Path(self.media_root, "repeats.csv").write_text("Sample,D3S1358\nS1,15\n")
+        str_file = STRFile.objects.create(file="repeats.csv")
+        url = reverse("str_view", args=[str_file.pk])
+        save_url = reverse("save_str_file", args=[str_file.pk])
+
+        self.assertContains(self.client.get(url), "not saved")
+        self.assertEqual(self.client.get(url, {"format": "json"}).status_code, 409)
+        self.assertEqual(self.client.get(save_url).status_code, 405)
+        self.assertFalse(ShortTandemRepeat.objects.exists())
+
+        self.assertRedirects(self.client.post(save_url), url)
+        self.assertEqual(
+            self.client.get(url, {"format": "json"}).json()["rows"], [["S1", "15"]]
+        )
+
+    def test_search_by_profile(self):
+        path = Path(self.media_root) / "repeats.csv"
+        path.write_text("Sample,D3S1358,TH01,FGA\nS1,15,9.3,22\nS2,16,6,22\nS3,15,9.3,21\n")
+        STRFile.objects.create(file="repeats.csv").save_to_db()
+
+        matches = search_by_profile([("D3S1358", "15"), ("TH01", "9.3"), ("FGA", "22")])
+
+        self.assertEqual(
+            [(match.sample, match.n_matches) for match in matches],
+            [("S1", 3), ("S3", 2), ("S2", 1)],
+        )
+        self.assertEqual(
+            [(locus.region, locus.sample_n_repeats, locus.is_matched) for locus in matches[1].loci],
+            [("D3S1358", ["15"], True), ("TH01", ["9.3"], True), ("FGA", ["21"], False)],
+        )
+
+        # The index is rebuilt when new repeats are saved
+        path.write_text("Sample,D3S1358\nS4,15\n")
+        STRFile.objects.create(file="repeats.csv").save_to_db()
+        self.assertEqual(len(search_by_profile([("D3S1358", "15")])), 3)
+
+    def test_heterozygous_region_is_counted_once(self):
+        index = STRIndex.build(
+            [("S1", "D3S1358", "15"), ("S1", "D3S1358", "16"), ("S2", "D3S1358", "16")]
+        )
+
+        self.assertEqual(
+            index.rank([("D3S1358", "15"), ("D3S1358", "16"), ("TH01", "6")]),
+            [("S1", 1), ("S2", 1)],
+        )
+
+    def test_parse_n_repeats(self):
+        self.assertEqual(parse_n_repeats("12"), [12.0])
+        self.assertEqual(parse_n_repeats("9.3"), [9.3])
+        self.assertEqual(parse_n_repeats("12, 14"), [12.0, 14.0])
+        self.assertEqual(parse_n_repeats("X/Y"), [])
+
+    def test_matching_with_tolerance(self):
+        matrix = RepeatMatrix.build(
+            [
+                ("S1", "TH01", "10"), ("S1", "FGA", "22"),
+                ("S2", "TH01", "9.3"), ("S2", "FGA", "23"),
+                ("S3", "TH01", "7"), ("S3", "FGA", "22"), ("S3", "FGA", "25"),
+            ]
+        )
+        profile = {"TH01": [10.0], "FGA": [22.0]}
+
+        self.assertEqual(
+            [(sample, score) for sample, score, _ in matrix.match(profile, tolerances={})],
+            [("S1", 2.0), ("S3", 1.0)],
+        )
+        self.assertEqual(
+            [(sample, score) for sample, score, _ in matrix.match(
+                profile, tolerances={"TH01": 0.7, "FGA": 1}
+            )],
+            [("S1", 2.0), ("S2", 2.0), ("S3", 1.0)],
+        )
+
+        # Half of alleles of a heterozygous call match
+        _, score, loci_scores = matrix.match({"FGA": [22.0, 24.0]}, tolerances={})[0]
+        self.assertEqual((score, loci_scores), (0.5, [0.5]))
+
+    def test_mixture_matching(self):
+        matrix = RepeatMatrix.build(
+            [("S1", "FGA", "22"), ("S1", "FGA", "25"), ("S2", "FGA", "22"), ("S2", "FGA", "23")]
+        )
+
+        # A mixture contains all alleles of S1, but only one allele of S2
+        self.assertEqual(
+            matrix.match({"FGA": [21.0, 22.0, 25.0]}, tolerances={}, mixture=True),
+            [("S1", 1.0, [1.0]), ("S2", 0.5, [0.5])],
+        )
+
+    def test_search_json(self):
+        path = Path(self.media_root) / "repeats.csv"
+        path.write_text("Sample,D3S1358,TH01\nS1,15,9.3\nS2,16,10\n")
+        STRFile.objects.create(file="repeats.csv").save_to_db()
+
+        response = self.client.post(
+            reverse("str_search_json"),
+            {
+                "profile": [
+                    {"region": "D3S1358", "n_repeats": "15"},
+                    {"region": "TH01", "n_repeats": "10", "tolerance": 1},
+                ],
+                "mode": "tolerant",
+            },
+            content_type="application/json",
+        )
+
+        matches = response.json()["matches"]
+        self.assertEqual([(match["sample"], match["score"]) for match in matches],
+                         [("S1", 2.0), ("S2", 1.0)])
+        self.assertEqual(matches[1]["loci"][1]["sample_n_repeats"], ["10"])
+
+        response = self.client.post(
+            reverse("str_search_json"), {"profile": [], "mode": "fuzzy"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class STRVersionTestCase(TemporaryMediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        invalidate_caches()
+
+        path = Path(self.media_root) / "repeats.csv"
+        path.write_text("Sample,D3S1358\nS1,15\nS2,15\n")
+        STRFile.objects.create(file="repeats.csv").save_to_db()
+
+    def test_caches_are_rebuilt_when_repeats_are_deleted(self):
+        version = get_db_version()
+        self.assertIn("S1", get_repeat_matrix().samples)
+        self.assertEqual(len(search_by_profile([("D3S1358", "15")])), 2)
+
+        # Checking the version doesn't query the database
+        with self.assertNumQueries(0):
+            get_index()
+            get_repeat_matrix()
+
+        Sample.objects.filter(cypher="S1").delete()
+
+        self.assertGreater(get_db_version(), version)
+        matches = search_by_profile([("D3S1358", "15")])
+        self.assertEqual([match.sample for match in matches], ["S2"])
+        self.assertNotIn("S1", get_repeat_matrix().samples)
+
+    def test_version_is_increased_when_file_is_saved(self):
+        version = get_db_version()
+
+        path = Path(self.media_root) / "other.csv"
+        path.write_text("Sample,D3S1358\nS3,16\n")
+        STRFile.objects.create(file="other.csv").save_to_db()
+
+        self.assertGreater(get_db_version(), version)
@@ -0,0 +1,31 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class MatchingMode(models.TextChoices):
+    EXACT = "exact", _("Exact")
+    TOLERANT = "tolerant", _("With tolerance")
+    MIXTURE = "mixture", _("Mixture")
+
+
+@dataclass
+class LocusMatch:
+    region: str
+    query_n_repeats: List[str]
+    sample_n_repeats: List[str]
+    score: float = 0
+
+    @property
+    def is_matched(self) -> bool:
+        return self.score > 0
+
+
+@dataclass
+class STRMatch:
+    sample: str
+    n_matches: int
+    score: float = 0
+    loci: List[LocusMatch] = field(default_factory=list)
@@ -1,33 +1,56 @@
-from django.core.exceptions import ObjectDoesNotExist
+from typing import Dict, List, Tuple
+
 from loguru import logger
 
-from short_tandem_repeats.models import Sample, ShortTandemRepeat, NRepeats, STRRegion
+from short_tandem_repeats.types import MatchingMode, STRMatch
 
 
-def find_sample(strs_formset):
-    similar_samples = []
+def get_profile_from_formset(strs_formset) -> Tuple[List[tuple], Dict[str, float]]:
+    """Return STR profile and tolerances of its regions from `strs_formset`"""
+    profile = []
+    tolerances = {}
 
     for str_form in strs_formset:
         str_region = str_form["region"].value()
         n_repeats = str_form["n_repeats"].value()
+        tolerance = str_form.cleaned_data.get("tolerance")
 
         logger.debug("Region: {}", str_region)
         logger.debug("N repeats: {}", n_repeats)
 
-        try:
-            db_region = STRRegion.objects.get(title=str_region)
-        except ObjectDoesNotExist:
-            continue
+        if str_region and n_repeats:
+            profile.append((str_region, n_repeats.strip()))
+            if tolerance:
+                tolerances[str_region] = tolerance
+
+    return profile, tolerances
+
+
+def match_profile(
+    profile: List[tuple],
+    tolerances: Dict[str, float],
+    mode: str = MatchingMode.EXACT,
+    max_results: int = 100,
+) -> List[STRMatch]:
+    """Find samples matching STR `profile` with the chosen matching `mode`
+
+    Exact matching ignores `tolerances`
+    """
+    # Search imports numpy, which is needed only when somebody searches
+    from short_tandem_repeats.search import search_by_profile, search_with_tolerance
+
+    if mode == MatchingMode.EXACT:
+        return search_by_profile(profile, max_results=max_results)
 
-        try:
-            db_n_repeats = NRepeats.objects.get(n_repeats=n_repeats)
-        except ObjectDoesNotExist:
-            continue
+    return search_with_tolerance(
+        profile,
+        tolerances=tolerances,
+        mixture=mode == MatchingMode.MIXTURE,
+        max_results=max_results,
+    )
 
-        try:
-            db_strs = ShortTandemRepeat.objects.filter(n_repeats=db_n_repeats, region=db_region)
-            similar_samples.extend([repeat.sample.cypher for repeat in db_strs])
-        except ObjectDoesNotExist:
-            continue
 
-    return similar_samples
+def find_sample(strs_formset, mode: str = MatchingMode.EXACT) -> List[STRMatch]:
+    """Find samples, which are the most similar to the STR profile in `strs_formset`"""
+    profile, tolerances = get_profile_from_formset(strs_formset)
+    return match_profile(profile, tolerances, mode=mode)
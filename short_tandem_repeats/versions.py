@@ -0,0 +1,52 @@
+"""Version of repeats in the database, shared by all workers
+
+Search caches the index and the matrix of repeats in memory of the process and rebuilds
+them when the version changes. The version is a counter in the Django cache
+`INTERNING_CACHE_ALIAS`, so checking it doesn't query the database. It is increased when
+a transaction saving or deleting repeats is committed: by `post_save` and `post_delete`
+signals, which are also sent for repeats deleted with their samples or regions, and by
+`STRFile.save_to_db()` after its bulk inserts. Repeats changed with raw SQL or
+`QuerySet.update()` bypass it
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+VERSION_KEY = "short_tandem_repeats:version"
+
+
+def get_version_cache():
+    return caches[settings.INTERNING_CACHE_ALIAS]
+
+
+def get_db_version() -> int:
+    """Return the version of repeats in the database"""
+    return get_version_cache().get(VERSION_KEY, 0)
+
+
+def increase_db_version():
+    """Increase the version of repeats when the current transaction is committed"""
+    transaction.on_commit(_increase_db_version)
+
+
+def _increase_db_version():
+    cache = get_version_cache()
+    cache.add(VERSION_KEY, 0, timeout=None)
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:  # The key was evicted meanwhile
+        cache.set(VERSION_KEY, 1, timeout=None)
+
+
+def _on_change(sender, **kwargs):
+    increase_db_version()
+
+
+def connect_signals():
+    from short_tandem_repeats.models import ShortTandemRepeat
+
+    post_save.connect(_on_change, sender=ShortTandemRepeat, dispatch_uid="str_version_save")
+    post_delete.connect(
+        _on_change, sender=ShortTandemRepeat, dispatch_uid="str_version_delete"
+    )
@@ -1,11 +1,19 @@
+import json
+import math
+from dataclasses import asdict
+from typing import List
+
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.shortcuts import render, redirect, get_object_or_404
 from django.forms import formset_factory, BaseFormSet
 from loguru import logger
-import pandas as pd
 
-from short_tandem_repeats.forms import STRFileForm, STRSearchForm
+from short_tandem_repeats.forms import STRFileForm, STRSearchForm, STRSearchOptionsForm
 from short_tandem_repeats.models import STRFile, NRepeats
-from short_tandem_repeats.utils import find_sample
+from short_tandem_repeats.types import MatchingMode, STRMatch
+from short_tandem_repeats.utils import find_sample, match_profile
 
 
 def str_file_upload(
@@ -41,27 +49,88 @@ def str_file_upload(
 def str_view(
         request,
         file_id: int,
-        result_template="short_tandem_repeats/str_table.html"
+        result_template="short_tandem_repeats/str_table.html",
+        default_page_size: int = 50,
+        max_page_size: int = 500,
 ):
+    """Show a page of STR file from the database
+
+    Query parameters:
+    * page — number of the page, starting from 1
+    * page_size — number of rows on the page
+    * regions — regions to show, comma-separated or repeated. All regions by default
+    * format — set to "json" to get the page as JSON
+    """
     logger.info("STR view received a request")
 
     str_file: STRFile = get_object_or_404(STRFile, pk=file_id)
-    logger.debug("Reading file {}", str_file.file.name)
 
-    df = pd.read_excel(str_file.file.path, engine="openpyxl")
-    columns = df.columns.tolist()
+    if not str_file.columns:
+        logger.info("Rows of file {} are not in the database", str_file.file.name)
+        if request.GET.get("format") == "json":
+            return JsonResponse({"name": str_file.file.name, "saved": False}, status=409)
+        return render(
+            request,
+            result_template,
+            {"name": str_file.file.name, "file_id": file_id, "saved": False},
+        )
+
+    try:
+        page_size = min(int(request.GET.get("page_size", default_page_size)), max_page_size)
+        page = int(request.GET.get("page", 1))
+    except ValueError:
+        return HttpResponseBadRequest("page and page_size must be integers")
+
+    n_pages = max(math.ceil(str_file.n_rows / page_size), 1) if page_size > 0 else 1
+    page = min(max(page, 1), n_pages)
+    page_size = max(page_size, 1)
+
+    requested_regions = {
+        region for value in request.GET.getlist("regions") for region in value.split(",")
+    }
+    regions = [
+        region for region in str_file.regions if region in requested_regions
+    ] or str_file.regions
+
+    page_data = {
+        "name": str_file.file.name,
+        "columns": [str_file.columns[0]] + regions,
+        "rows": str_file.get_table_page(page=page, page_size=page_size, regions=regions),
+        "page": page,
+        "n_pages": n_pages,
+        "n_rows": str_file.n_rows,
+    }
+
+    if request.GET.get("format") == "json":
+        return JsonResponse(page_data)
 
     logger.success("Returning the page")
     return render(
         request,
         result_template,
-        {"columns": columns, "rows": df.iterrows(), "name": str_file.file.name},
+        {
+            **page_data,
+            "saved": True,
+            "file_id": file_id,
+            "page_size": page_size,
+            "all_regions": str_file.regions,
+            "selected_regions": ",".join(regions),
+        },
     )
 
 
+@require_POST
+def save_str_file(request, file_id: int):
+    """Save repeats of STR file to the database, e.g. if it was uploaded in the admin"""
+    str_file: STRFile = get_object_or_404(STRFile, pk=file_id)
+    str_file.save_to_db()
+    return redirect("str_view", file_id=str_file.pk)
+
+
 def str_search_form(
     request,
     form_class=STRSearchForm,
+    options_form_class=STRSearchOptionsForm,
     form_template="short_tandem_repeats/str_search.html",
     result_template="short_tandem_repeats/str_search_result.html",
 ):
@@ -70,21 +139,65 @@ def str_search_form(
     if request.method == "POST":
         logger.info("{} received a POST request", str_search_form.__name__)
         formset = formset_class(request.POST)
+        options_form = options_form_class(request.POST, prefix="options")
 
-        if formset.is_valid():
+        if formset.is_valid() and options_form.is_valid():
             logger.success("Formset is valid, returning success")
-            samples: list = find_sample(formset)
-            return render(request, result_template, {"result": samples})
+            mode = options_form.cleaned_data["mode"] or MatchingMode.EXACT
+            samples: List[STRMatch] = find_sample(formset, mode=mode)
+            return render(
+                request,
+                result_template,
+                {"result": samples, "show_score": mode != MatchingMode.EXACT},
+            )
 
         else:
             logger.warning("Formset is not valid")
             logger.warning("Errors: {}", formset.errors)
 
-            return render(request, form_template, {"formset": formset})
+            return render(
+                request, form_template, {"formset": formset, "options_form": options_form}
+            )
 
     else:  # Request method is not post
         repeats_list = [repeat.n_repeats for repeat in NRepeats.objects.all()]
 
         formset = formset_class(form_kwargs={"repeats_list": repeats_list})
-
-    return render(request, form_template, {"formset": formset})
+        options_form = options_form_class(prefix="options")
+
+    return render(request, form_template, {"formset": formset, "options_form": options_form})
+
+
+@csrf_exempt
+@require_POST
+def str_search_json(request, max_results_limit: int = 1000):
+    """Search samples by STR profile sent as JSON
+
+    Request body: {"profile": [{"region": ..., "n_repeats": ..., "tolerance": ...}, ...],
+    "mode": "exact" | "tolerant" | "mixture", "max_results": ...}. Tolerance is optional
+    """
+    logger.info("{} received a POST request", str_search_json.__name__)
+
+    try:
+        query = json.loads(request.body)
+        profile = [
+            (str(locus["region"]), str(locus["n_repeats"]).strip())
+            for locus in query["profile"]
+        ]
+        tolerances = {
+            str(locus["region"]): float(locus["tolerance"])
+            for locus in query["profile"]
+            if locus.get("tolerance")
+        }
+        mode = MatchingMode(query.get("mode", MatchingMode.EXACT))
+        max_results = min(int(query.get("max_results", 100)), max_results_limit)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning("Invalid search query: {}", e)
+        return HttpResponseBadRequest(f"Invalid search query: {e}")
+
+    if any(tolerance < 0 for tolerance in tolerances.values()) or max_results < 1:
+        return HttpResponseBadRequest("Tolerances must be non-negative, max_results positive")
+
+    matches = match_profile(profile, tolerances, mode=mode, max_results=max_results)
+
+    return JsonResponse({"mode": mode, "matches": [asdict(match) for match in matches]})
@@ -0,0 +1 @@
+default_app_config = "vcf_uploading.apps.FilesUploadingConfig"
@@ -1,12 +1,17 @@
 from django.contrib import admin
+from django.urls import reverse
+from django.utils.html import format_html
 
 from .models import (
     SNP,
     Allele,
     AllelesRecord,
+    CallableInterval,
     Chromosome,
     MitochondriaHaplogroup,
     Nationality,
+    Profile,
+    RawVCF,
     Sample,
     Variant,
     YHaplogroup,
@@ -21,3 +26,38 @@ admin.site.register(MitochondriaHaplogroup)
 admin.site.register(YHaplogroup)
 admin.site.register(Sample)
 admin.site.register(Variant)
+admin.site.register(CallableInterval)
+
+
+@admin.register(RawVCF)
+class RawVCFAdmin(admin.ModelAdmin):
+    list_display = ("id", "file", "date_created", "saved", "n_samples", "profiling_enabled")
+    list_filter = ("saved", "profiling_enabled")
+    list_editable = ("profiling_enabled",)
+
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ("operation", "raw_vcf", "date_created", "duration", "downloads")
+    list_filter = ("operation",)
+    list_select_related = ("raw_vcf",)
+    readonly_fields = (
+        "operation",
+        "raw_vcf",
+        "date_created",
+        "duration",
+        "n_stack_samples",
+        "downloads",
+        "summary",
+    )
+    exclude = ("pstats_file", "collapsed_stacks_file")
+
+    def downloads(self, profile: Profile):
+        return format_html(
+            '<a href="{}">pstats</a> | <a href="{}">collapsed stacks</a>',
+            reverse("profile_download", args=[profile.pk, "pstats"]),
+            reverse("profile_download", args=[profile.pk, "collapsed"]),
+        )
+
+    def has_add_permission(self, request):
+        return False
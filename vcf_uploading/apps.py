@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class FilesUploadingConfig(AppConfig):
     name = "vcf_uploading"
+
+    def ready(self):
+        from vcf_uploading.interning import connect_signals
+        from vcf_uploading.models import Allele, AllelesRecord, Chromosome
+
+        connect_signals([Allele, AllelesRecord, Chromosome])
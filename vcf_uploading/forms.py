@@ -1,7 +1,10 @@
 from django import forms
+from django.core.exceptions import ValidationError
 from django.forms import ModelForm
+from django.forms.fields import CallableChoiceIterator
 from django.utils.translation import gettext_lazy as _
 
+from .interning import get_intern_cache
 from .models import Allele, Chromosome, RawVCF
 
 
@@ -12,8 +15,40 @@ class VCFFileForm(ModelForm):
         labels = {"file": _("File with genetic variants (e.g. VCF file)")}
 
 
+class InternedModelChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField, which takes choices and selected rows from the process-wide
+    cache of the model (see `vcf_uploading.interning`) instead of querying the database
+    """
+
+    def _get_choices(self):
+        return CallableChoiceIterator(self._get_interned_choices)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def _get_interned_choices(self):
+        if self.empty_label is not None:
+            yield "", self.empty_label
+
+        for row in get_intern_cache(self.queryset.model).all():
+            yield self.prepare_value(row), self.label_from_instance(row)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+
+        model = self.queryset.model
+        try:
+            return get_intern_cache(model).get(model._meta.pk.to_python(value))
+        except (ValidationError, model.DoesNotExist):
+            raise ValidationError(
+                self.error_messages["invalid_choice"],
+                code="invalid_choice",
+                params={"value": value},
+            )
+
+
 class SNPSearchForm(forms.Form):
-    chromosome = forms.ModelChoiceField(
+    chromosome = InternedModelChoiceField(
         queryset=Chromosome.objects.all(),
         empty_label=None,
         required=True,
@@ -22,15 +57,70 @@ class SNPSearchForm(forms.Form):
     position = forms.IntegerField(
         min_value=0, max_value=3.5 * 10 ** 9, required=True, label=_("Position")
     )
-    allele_1 = forms.ModelChoiceField(
+    allele_1 = InternedModelChoiceField(
         queryset=Allele.objects.all(),
         empty_label=None,
         required=True,
         label=_("The first allele"),
     )
-    allele_2 = forms.ModelChoiceField(
+    allele_2 = InternedModelChoiceField(
         queryset=Allele.objects.all(),
         empty_label=None,
         required=True,
         label=_("The second allele"),
     )
+
+
+class ListFilterForm(forms.Form):
+    """Filters of a keyset-paginated list. Subclasses define `after` field with a key of
+    the last item of the previous page and implement `filter_queryset()`
+    """
+
+    uploaded_after = forms.DateField(required=False, label=_("Uploaded after"))
+    uploaded_before = forms.DateField(required=False, label=_("Uploaded before"))
+    saved = forms.NullBooleanField(required=False, label=_("Saved"))
+    page_size = forms.IntegerField(
+        min_value=1, max_value=500, required=False, label=_("Page size")
+    )
+
+    upload_date_field = "date_created"
+    saved_field = "saved"
+
+    def filter_queryset(self, queryset):
+        """Apply filters from `self.cleaned_data` to `queryset`"""
+        data = self.cleaned_data
+
+        if data.get("uploaded_after"):
+            queryset = queryset.filter(
+                **{f"{self.upload_date_field}__date__gte": data["uploaded_after"]}
+            )
+        if data.get("uploaded_before"):
+            queryset = queryset.filter(
+                **{f"{self.upload_date_field}__date__lte": data["uploaded_before"]}
+            )
+        if data.get("saved") is not None:
+            queryset = queryset.filter(**{self.saved_field: data["saved"]})
+
+        return queryset
+
+
+class SampleFilterForm(ListFilterForm):
+    nationality = forms.CharField(max_length=255, required=False, label=_("Nationality"))
+    after = forms.CharField(max_length=255, required=False)
+
+    upload_date_field = "vcf_file__date_created"
+    saved_field = "vcf_file__saved"
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+
+        if self.cleaned_data.get("nationality"):
+            queryset = queryset.filter(
+                nationality__nationality__iexact=self.cleaned_data["nationality"]
+            )
+
+        return queryset
+
+
+class VCFFileFilterForm(ListFilterForm):
+    after = forms.IntegerField(required=False)
@@ -0,0 +1,149 @@
+"""Vectorized metrics of similarity of samples to a query genotype
+
+Genotypes are integer arrays of allele codes: the query has shape (n_sites, 2) and
+genotypes of samples have shape (n_samples, n_sites, 2). Codes are only compared for
+equality, so any numbering of alleles of a site works, e.g. 0 for the reference allele
+and 1 for the alternative one. Missing alleles are `MISSING_ALLELE`. Alleles of the
+query and of a sample are paired to share as many of them as possible, like in
+`metrics.identity_percentage`. Every metric returns one score for each sample.
+
+Metrics ignoring missing genotypes use only sites, where both the query and the sample
+have two alleles. Samples without such sites get NaN
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .metrics import DEFAULT_METRIC
+
+MISSING_ALLELE = -1
+
+Kernel = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+def _equal(alleles: np.ndarray, query_alleles: np.ndarray) -> np.ndarray:
+    return (alleles == query_alleles) & (alleles != MISSING_ALLELE)
+
+
+def get_shared_alleles(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Return boolean array of shape (n_samples, n_sites, 2): whether each allele of the
+    query is shared with the sample
+    """
+    same_order = np.stack(
+        [_equal(genotypes[..., 0], query[:, 0]), _equal(genotypes[..., 1], query[:, 1])],
+        axis=-1,
+    )
+    crossed = np.stack(
+        [_equal(genotypes[..., 1], query[:, 0]), _equal(genotypes[..., 0], query[:, 1])],
+        axis=-1,
+    )
+    is_crossed = crossed.sum(axis=-1) > same_order.sum(axis=-1)
+    return np.where(is_crossed[..., np.newaxis], crossed, same_order)
+
+
+def get_called_sites(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Return boolean array of shape (n_samples, n_sites): whether both the query and the
+    sample have two alleles at the site
+    """
+    is_query_called = (query != MISSING_ALLELE).all(axis=-1)
+    return (genotypes != MISSING_ALLELE).all(axis=-1) & is_query_called
+
+
+def _mean_over_called_sites(values: np.ndarray, called: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(called, values, 0).sum(axis=1) / called.sum(axis=1)
+
+
+def identity(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Mean share of alleles of the query found in the sample. Missing genotypes are
+    counted as sharing nothing
+    """
+    n_sites = query.shape[0]
+    if n_sites == 0:
+        return np.zeros(genotypes.shape[0])
+    return get_shared_alleles(query, genotypes).sum(axis=(1, 2)) / (2 * n_sites)
+
+
+def ibs_distance(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Mean share of alleles of the query not found in the sample (1 - IBS / 2) over called
+    sites
+    """
+    n_shared = get_shared_alleles(query, genotypes).sum(axis=-1)
+    return _mean_over_called_sites(1 - n_shared / 2, get_called_sites(query, genotypes))
+
+
+def concordance(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Share of called sites, where the sample has the same genotype as the query"""
+    n_shared = get_shared_alleles(query, genotypes).sum(axis=-1)
+    return _mean_over_called_sites(n_shared == 2, get_called_sites(query, genotypes))
+
+
+def allele_sharing_distance(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Number of alleles of the query not found in the sample. Like in PLINK --distance,
+    it is counted over called sites and scaled up to all sites
+    """
+    n_shared = get_shared_alleles(query, genotypes).sum(axis=-1)
+    return query.shape[0] * _mean_over_called_sites(
+        2 - n_shared, get_called_sites(query, genotypes)
+    )
+
+
+def rare_allele_weighted(query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+    """Share of alleles of the query found in the sample, where each allele is weighted by
+    -log of its frequency among the samples at the site
+
+    Frequencies are smoothed as (count + 1) / (number of called alleles + 2), so alleles
+    absent from the samples have finite weights. Sharing a rare allele weighs more than
+    sharing one, which almost everyone has. Missing genotypes are counted as sharing
+    nothing
+    """
+    n_called_alleles = (genotypes != MISSING_ALLELE).sum(axis=(0, 2))
+    counts = (genotypes[..., np.newaxis] == query[:, np.newaxis, :]).sum(axis=(0, 2))
+    frequencies = (counts + 1) / (n_called_alleles[:, np.newaxis] + 2)
+    weights = np.where(query != MISSING_ALLELE, -np.log(frequencies), 0)
+
+    total_weight = weights.sum()
+    if total_weight == 0:
+        return np.zeros(genotypes.shape[0])
+    shared_weights = get_shared_alleles(query, genotypes) * weights
+    return shared_weights.sum(axis=(1, 2)) / total_weight
+
+
+@dataclass(frozen=True)
+class GenotypeMetric:
+    name: str
+    kernel: Kernel
+    # Whether lower scores mean more similar genotypes
+    is_distance: bool = False
+
+    def __call__(self, query: np.ndarray, genotypes: np.ndarray) -> np.ndarray:
+        return self.kernel(np.asarray(query), np.asarray(genotypes))
+
+    def sort(self, scores: Dict[str, float]) -> List[Tuple[str, float]]:
+        """Return (sample, score) pairs from the most similar sample to the least one"""
+        return sorted(
+            scores.items(),
+            key=lambda item: item[1] if self.is_distance else -item[1],
+        )
+
+
+METRICS: Dict[str, GenotypeMetric] = {
+    metric.name: metric
+    for metric in (
+        GenotypeMetric(DEFAULT_METRIC, identity),
+        GenotypeMetric("ibs_distance", ibs_distance, is_distance=True),
+        GenotypeMetric("concordance", concordance),
+        GenotypeMetric("allele_sharing_distance", allele_sharing_distance, is_distance=True),
+        GenotypeMetric("rare_allele_weighted", rare_allele_weighted),
+    )
+}
+
+
+def get_metric(name: str) -> GenotypeMetric:
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown metric {name}. Available metrics: {', '.join(METRICS)}"
+        ) from None
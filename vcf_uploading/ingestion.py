@@ -0,0 +1,176 @@
+"""Bulk ingestion of VCF files from the file system, see `manage.py ingest_vcfs`"""
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import django
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from loguru import logger
+
+from .models import RawVCF
+from .validators import check_vcf_path
+
+VCF_SUFFIXES = (".vcf", ".vcf.gz", ".bcf", ".gz")
+
+
+@dataclass
+class IngestionResult:
+    path: str
+    status: str  # "ingested", "skipped", "failed" or "valid" in the dry run
+    n_samples: int = 0
+    n_records: int = 0
+    seconds: float = 0
+    error: Optional[str] = None
+
+    @property
+    def n_genotypes(self) -> int:
+        return self.n_samples * self.n_records
+
+
+def expand_paths(patterns: Iterable[str]) -> List[Path]:
+    """Expand glob patterns and directories into a sorted list of VCF files"""
+    paths = set()
+
+    for pattern in patterns:
+        for match in glob.glob(os.path.expanduser(pattern), recursive=True) or [pattern]:
+            path = Path(match)
+            if path.is_dir():
+                paths.update(
+                    child for child in path.rglob("*")
+                    if child.is_file() and child.name.endswith(VCF_SUFFIXES)
+                )
+            else:
+                paths.add(path)
+
+    return sorted(path.resolve() for path in paths)
+
+
+def get_storage_name(path: Path) -> str:
+    """Return name of `path` in the storage of `RawVCF.file`
+
+    Files in the upload directory are referenced as they are. Other files, including
+    the ones elsewhere in MEDIA_ROOT, get a symbolic link in the upload directory, whose
+    name depends only on the path, so the same file always has the same name. Deleting
+    expired files (`RawVCF.delete_expired`) then removes only the link
+    """
+    upload_to = RawVCF._meta.get_field("file").upload_to
+    upload_dir = (Path(settings.MEDIA_ROOT) / upload_to).resolve()
+    if path.parent == upload_dir:
+        return f"{upload_to}{path.name}"
+
+    digest = hashlib.sha1(str(path).encode()).hexdigest()[:10]
+    suffix = "".join(path.suffixes[-2:]) if path.name.endswith(".vcf.gz") else path.suffix
+    name = path.name[: -len(suffix)] if suffix else path.name
+
+    return f"{upload_to}{name}_{digest}{suffix}"
+
+
+def link_to_storage(path: Path, name: str):
+    """Make file `path` available in the storage under `name` without copying it"""
+    link = Path(settings.MEDIA_ROOT) / name
+    if link.resolve() == path:
+        return
+
+    link.parent.mkdir(parents=True, exist_ok=True)
+    if link.is_symlink():
+        link.unlink()
+    link.symlink_to(path)
+
+
+def ingest_file(path: Path, skip_existing: bool = False, dry_run: bool = False) -> IngestionResult:
+    """Validate file at `path`, register it as `RawVCF` and save its samples to the database
+
+    :param skip_existing: skip the file if it was already saved to the database
+    :param dry_run: only validate the file
+    """
+    start = time.perf_counter()
+    result = IngestionResult(path=str(path), status="failed")
+
+    try:
+        if not path.name.endswith(VCF_SUFFIXES):
+            raise ValidationError(f"Extension of {path.name} is not supported")
+        check_vcf_path(path)
+
+        name = get_storage_name(path)
+        if skip_existing and RawVCF.all_objects.filter(file=name, saved=True).exists():
+            result.status = "skipped"
+            return result
+
+        if dry_run:
+            result.status = "valid"
+            return result
+
+        link_to_storage(path, name)
+        raw_vcf = RawVCF.all_objects.filter(file=name).first() or RawVCF.objects.create(
+            file=name
+        )
+        raw_vcf.calculate_statistics()
+        raw_vcf.save_samples_to_db()
+
+        result.status = "ingested"
+        result.n_samples = raw_vcf.n_samples or 0
+        result.n_records = raw_vcf.n_records or 0
+    except Exception as e:
+        logger.exception("Ingestion of {} has failed", path)
+        result.error = str(e)
+    finally:
+        result.seconds = time.perf_counter() - start
+
+    return result
+
+
+def _setup_worker():
+    django.setup()
+
+
+def _ingest_file_in_worker(path: Path, **kwargs) -> IngestionResult:
+    try:
+        return ingest_file(path, **kwargs)
+    finally:
+        # Each thread of a pool has its own connections, close them when they are not needed
+        connections.close_all()
+
+
+def ingest_files(
+    paths: List[Path],
+    workers: int = 1,
+    use_processes: bool = True,
+    skip_existing: bool = False,
+    dry_run: bool = False,
+) -> Iterable[IngestionResult]:
+    """Ingest files with a pool of `workers`. Results are yielded as files are processed
+
+    Saving of a file is one transaction, so with SQLite, which allows only one writer,
+    files are ingested one by one
+    """
+    if workers > 1 and connections["default"].vendor == "sqlite":
+        logger.warning("SQLite doesn't support concurrent writes, using one worker")
+        workers = 1
+
+    if workers == 1:
+        for path in paths:
+            yield ingest_file(path, skip_existing=skip_existing, dry_run=dry_run)
+        return
+
+    # Connections can't be shared with forked processes
+    connections.close_all()
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    executor_kwargs = {"initializer": _setup_worker} if use_processes else {}
+
+    with executor_class(max_workers=workers, **executor_kwargs) as executor:
+        futures = [
+            executor.submit(
+                _ingest_file_in_worker, path, skip_existing=skip_existing, dry_run=dry_run
+            )
+            for path in paths
+        ]
+        for future in futures:
+            yield future.result()
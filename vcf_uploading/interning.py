@@ -0,0 +1,257 @@
+"""Process-wide caches of small tables, which primary keys are their values: alleles,
+chromosomes and alleles records
+
+Saving and searching of VCF files turn strings like "A" or "0/1" into rows of these
+tables for every genotype. With the caches it is done in memory: the first lookup loads
+up to `INTERNING_CACHE_SIZE` rows of the table with one query, and only values missing
+in the cache go to the database.
+
+Rows saved in a transaction are cached only after it is committed, so rolled back rows
+are never returned from the cache. Inside `atomic_with_interning()` blocks the thread,
+which saves them, reads them from memory before that: they are kept until the block
+ends and discarded if it is rolled back. When rows are inserted or deleted, the version
+of the table is increased in the Django cache `INTERNING_CACHE_ALIAS`. Every process
+checks it at most once in `INTERNING_CHECK_INTERVAL` seconds and clears its cache if it
+has changed. Rows created with `bulk_create()` or raw SQL bypass these signals
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+
+
+class InternCache:
+    """LRU cache of rows of `model` by their primary keys
+
+    :param model: model, which primary key is its value
+    :param max_size: maximum number of cached rows
+    """
+
+    def __init__(self, model: Type[models.Model], max_size: int):
+        self.model = model
+        self.max_size = max_size
+
+        self._rows: "OrderedDict[Any, models.Model]" = OrderedDict()
+        self._is_warm = False
+        # Whether all rows of the table are cached
+        self._is_complete = False
+        # Values saved in the current transaction of each thread
+        self._local = threading.local()
+        self._version: Optional[int] = None
+        self._checked_at = float("-inf")
+        self._lock = threading.RLock()
+
+    @property
+    def version_key(self) -> str:
+        return f"interning:{self.model._meta.label_lower}"
+
+    def get(self, value) -> models.Model:
+        """Return row with primary key `value` or raise `DoesNotExist`"""
+        row = self._get_cached(value)
+        if row is None:
+            row = _get_block_row(self.model, value)
+        if row is None:
+            row = self.model.objects.get(pk=value)
+            self._put(row)
+        return row
+
+    def get_or_create(self, value) -> models.Model:
+        """Return row with primary key `value`. It is created if it doesn't exist"""
+        row = self._get_cached(value)
+        if row is None:
+            row = _get_block_row(self.model, value)
+        if row is None:
+            row, created = self.model.objects.get_or_create(pk=value)
+            self._put(row)
+        return row
+
+    def all(self) -> List[models.Model]:
+        """Return all rows sorted by primary keys"""
+        with self._lock:
+            self._refresh()
+            if self._is_complete:
+                return sorted(self._rows.values(), key=lambda row: row.pk)
+
+        return list(self.model.objects.order_by("pk"))
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._is_warm = False
+            self._is_complete = False
+            self._checked_at = float("-inf")
+            self._local = threading.local()
+
+    def on_save(self, row: models.Model):
+        """Cache `row` when the current transaction is committed"""
+        self._get_pending().add(row.pk)
+
+        frames = _get_frames()
+        if frames:
+            frames[-1][self.model, row.pk] = row
+
+        def commit():
+            with self._lock:
+                self._put(row)
+                self._increase_version()
+
+        transaction.on_commit(commit)
+
+    def on_delete(self, row: models.Model):
+        with self._lock:
+            self._rows.pop(row.pk, None)
+        for frame in _get_frames():
+            frame.pop((self.model, row.pk), None)
+
+        def commit():
+            with self._lock:
+                self._increase_version()
+
+        transaction.on_commit(commit)
+
+    def _get_pending(self) -> Set[Any]:
+        """Return values saved in the current transaction of this thread
+
+        Other threads don't see these rows until the transaction is committed, so only
+        this thread could cache them too early. The values are dropped when there is no
+        transaction anymore: they are either committed and cached by their callbacks or
+        rolled back
+        """
+        local = self._local
+        in_transaction = transaction.get_connection().in_atomic_block
+        if not in_transaction or not hasattr(local, "pending"):
+            local.pending = set()
+        return local.pending
+
+    def _get_cached(self, value) -> Optional[models.Model]:
+        with self._lock:
+            self._refresh()
+            row = self._rows.get(value)
+            if row is not None:
+                self._rows.move_to_end(value)
+            return row
+
+    def _put(self, row: models.Model):
+        with self._lock:
+            if row.pk in self._get_pending():
+                return
+
+            self._rows[row.pk] = row
+            self._rows.move_to_end(row.pk)
+
+            if len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+                self._is_complete = False
+
+    def _refresh(self):
+        """Clear the cache if the table was changed by another process and warm it up"""
+        now = time.monotonic()
+        if now - self._checked_at >= settings.INTERNING_CHECK_INTERVAL:
+            self._checked_at = now
+            version = get_version_cache().get(self.version_key, 0)
+            if version != self._version:
+                self._rows.clear()
+                self._is_warm = False
+                self._version = version
+
+        if not self._is_warm:
+            rows = self.model.objects.exclude(pk__in=self._get_pending()).order_by("pk")
+            rows = list(rows[: self.max_size + 1])
+            self._is_complete = len(rows) <= self.max_size
+            self._rows = OrderedDict((row.pk, row) for row in rows[: self.max_size])
+            self._is_warm = True
+
+    def _increase_version(self):
+        cache = get_version_cache()
+        cache.add(self.version_key, 0, timeout=None)
+        try:
+            self._version = cache.incr(self.version_key)
+        except ValueError:  # The key was evicted meanwhile
+            cache.set(self.version_key, 1, timeout=None)
+            self._version = 1
+
+
+_caches: Dict[Type[models.Model], InternCache] = {}
+_caches_lock = threading.Lock()
+
+# Rows saved in each `atomic_with_interning()` block of the thread, from the outermost one
+_local = threading.local()
+
+
+def get_version_cache():
+    return caches[settings.INTERNING_CACHE_ALIAS]
+
+
+def get_intern_cache(model: Type[models.Model]) -> InternCache:
+    """Return the cache of `model` shared by all threads of the process"""
+    with _caches_lock:
+        if model not in _caches:
+            _caches[model] = InternCache(model, max_size=settings.INTERNING_CACHE_SIZE)
+        return _caches[model]
+
+
+@contextmanager
+def atomic_with_interning():
+    """`transaction.atomic()`, inside which rows saved by this thread are read from memory
+
+    Rows saved in the block are kept until it ends. They are discarded if it is rolled
+    back, and are passed to the enclosing block otherwise. Rows saved in plain
+    `transaction.atomic()` blocks nested in it are kept even if those are rolled back, so
+    such blocks shouldn't save interned rows
+    """
+    frames = _get_frames()
+    frame: Dict[Tuple[Type[models.Model], Any], models.Model] = {}
+    frames.append(frame)
+    try:
+        with transaction.atomic():
+            yield
+    finally:
+        frames.pop()
+
+    if frames:
+        frames[-1].update(frame)
+
+
+def _get_frames() -> List[Dict[Tuple[Type[models.Model], Any], models.Model]]:
+    if not hasattr(_local, "frames"):
+        _local.frames = []
+    return _local.frames
+
+
+def _get_block_row(model: Type[models.Model], value) -> Optional[models.Model]:
+    for frame in reversed(_get_frames()):
+        row = frame.get((model, value))
+        if row is not None:
+            return row
+    return None
+
+
+def invalidate_caches(**kwargs):
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
+
+
+def _on_save(sender, instance, **kwargs):
+    get_intern_cache(sender).on_save(instance)
+
+
+def _on_delete(sender, instance, **kwargs):
+    get_intern_cache(sender).on_delete(instance)
+
+
+def connect_signals(interned_models: List[Type[models.Model]]):
+    """Keep caches of `interned_models` up to date with the database"""
+    for model in interned_models:
+        uid = model._meta.label_lower
+        post_save.connect(_on_save, sender=model, dispatch_uid=f"intern_save_{uid}")
+        post_delete.connect(_on_delete, sender=model, dispatch_uid=f"intern_delete_{uid}")
+
+    # Tables are flushed, e.g. between tests, without deleting rows one by one
+    post_migrate.connect(invalidate_caches, dispatch_uid="intern_invalidate")
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from vcf_uploading.models import RawVCF
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete uploaded VCF files that were not saved to the database in time, "
+        "both rows and files. Run it periodically, e.g. from cron"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Number of files deleted in one transaction"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report what would be deleted"
+        )
+        parser.add_argument(
+            "--orphans",
+            action="store_true",
+            help="Also delete expired files in the upload directory that have no database row",
+        )
+
+    def handle(self, *args, **options):
+        n_rows, n_files = RawVCF.delete_expired(
+            batch_size=options["batch_size"], dry_run=options["dry_run"]
+        )
+        action = "Found" if options["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{action} {n_rows} expired VCF files"))
+
+        if options["orphans"]:
+            orphans = self.find_orphaned_files()
+            if not options["dry_run"]:
+                RawVCF.delete_files(orphans)
+            self.stdout.write(self.style.SUCCESS(f"{action} {len(orphans)} orphaned files"))
+
+    @staticmethod
+    def find_orphaned_files():
+        """Return names of files in the upload directory without a row in the database
+
+        Only files older than the lifetime of not saved uploads are returned, so files
+        that are being uploaded right now are never touched
+        """
+        field = RawVCF._meta.get_field("file")
+        storage = field.storage
+        directory = field.upload_to
+        expiration_time = RawVCF.get_expiration_time()
+
+        if not storage.exists(directory):
+            return []
+
+        known_names = set(RawVCF.all_objects.values_list("file", flat=True))
+        _, file_names = storage.listdir(directory)
+        orphans = []
+
+        for file_name in file_names:
+            name = directory + file_name
+            data_name = name
+            for extension in RawVCF.INDEX_EXTENSIONS:
+                if name.endswith(extension):
+                    data_name = name[: -len(extension)]
+
+            if data_name in known_names:
+                continue
+
+            modified_time = storage.get_modified_time(name)
+            if timezone.is_naive(modified_time):
+                modified_time = timezone.make_aware(modified_time)
+            if modified_time < expiration_time:
+                orphans.append(name)
+
+        return orphans
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from vcf_uploading.utils import cohort_to_vcf, get_cohort_samples
+from vcf_uploading.vcf_processing import bgzip, encode_lines
+
+
+class Command(BaseCommand):
+    help = "Export samples from the database to a multi-sample VCF file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path to the output file. Use .gz suffix to bgzip it")
+        parser.add_argument(
+            "--samples", nargs="+", help="Cyphers of samples. All samples by default"
+        )
+        parser.add_argument("--nationality", help="Export only samples of this nationality")
+        parser.add_argument(
+            "--block-size", type=int, default=1000, help="Number of SNPs processed at once"
+        )
+
+    def handle(self, *args, **options):
+        samples = get_cohort_samples(
+            cyphers=options["samples"], nationality=options["nationality"]
+        )
+        vcf = cohort_to_vcf(samples, block_size=options["block_size"])
+        content = encode_lines(vcf.lines())
+
+        if options["output"].endswith(".gz"):
+            content = bgzip(content)
+
+        with open(options["output"], "wb") as f:
+            f.writelines(content)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Exported {samples.count()} samples to {options['output']}")
+        )
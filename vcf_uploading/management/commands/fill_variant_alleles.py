@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from vcf_uploading.models import Variant
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy alleles of variants saved before they were stored in the variants table "
+        "from the deprecated table of alleles of variants. Copied rows are deleted, so "
+        "after the first run it does nothing"
+    )
+
+    def handle(self, *args, **options):
+        n_variants = Variant.fill_alleles()
+        self.stdout.write(f"Alleles of {n_variants} variants are copied")
@@ -0,0 +1,79 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vcf_uploading.ingestion import expand_paths, ingest_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Save VCF files from the file system to the database. Files are validated and "
+        "registered in place, without copying them to MEDIA_ROOT"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Files, directories or glob patterns")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=min(4, os.cpu_count() or 1),
+            help="Number of files ingested at the same time",
+        )
+        parser.add_argument(
+            "--threads",
+            action="store_true",
+            help="Use threads instead of processes for workers",
+        )
+        parser.add_argument(
+            "--skip-existing",
+            action="store_true",
+            help="Skip files that were already saved to the database",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only validate files and report them"
+        )
+
+    def handle(self, *args, **options):
+        paths = expand_paths(options["paths"])
+        if not paths:
+            raise CommandError("No files match the given paths")
+
+        self.stdout.write(f"Found {len(paths)} files")
+        counts = {"ingested": 0, "skipped": 0, "failed": 0, "valid": 0}
+        n_records = n_genotypes = 0
+        start = time.perf_counter()
+
+        for result in ingest_files(
+            paths,
+            workers=max(options["workers"], 1),
+            use_processes=not options["threads"],
+            skip_existing=options["skip_existing"],
+            dry_run=options["dry_run"],
+        ):
+            counts[result.status] += 1
+            n_records += result.n_records
+            n_genotypes += result.n_genotypes
+
+            message = f"{result.status:>8} {result.path} ({result.seconds:.2f} s)"
+            if result.error:
+                self.stderr.write(self.style.ERROR(f"{message}: {result.error}"))
+            else:
+                self.stdout.write(message)
+
+        seconds = time.perf_counter() - start
+
+        def per_second(count: int) -> float:
+            return count / seconds if seconds else 0.0
+
+        summary = ", ".join(f"{count} {status}" for status, count in counts.items() if count)
+        self.stdout.write(self.style.SUCCESS(f"Done in {seconds:.1f} s: {summary}"))
+        if counts["ingested"]:
+            self.stdout.write(
+                f"Throughput: {per_second(counts['ingested']):.2f} files/s, "
+                f"{per_second(n_records):.1f} records/s, "
+                f"{per_second(n_genotypes):.1f} genotypes/s"
+            )
+
+        if counts["failed"]:
+            raise CommandError(f"{counts['failed']} files have failed")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from vcf_uploading.partitioning import (
+    PartitioningError,
+    fill_chromosomes,
+    is_partitioned,
+    is_supported,
+    partition_variants,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Partition the variants table by chromosome on PostgreSQL and move existing "
+        "variants to the partitions. On other databases only chromosomes of variants are "
+        "filled. It is safe to run it after every migration"
+    )
+
+    def handle(self, *args, **options):
+        if not is_supported():
+            n_variants = fill_chromosomes()
+            self.stdout.write(
+                f"Partitioning isn't supported by {connection.vendor}, the table is kept. "
+                f"Chromosomes of {n_variants} variants are filled"
+            )
+        elif is_partitioned():
+            self.stdout.write("Variants are already partitioned")
+        else:
+            try:
+                partition_variants()
+            except PartitioningError as e:
+                raise CommandError(f"Variants aren't partitioned: {e}") from e
+            self.stdout.write(self.style.SUCCESS("Variants are partitioned by chromosome"))
@@ -1,24 +1,25 @@
-from typing import Tuple
+from collections import Counter
+from typing import Optional, Sequence
 
-from .models import Allele
+Genotype = Sequence[Optional[str]]
 
+# Metric of similarity searches, see `vcf_uploading.genotype_metrics`. It is calculated
+# by the database, other metrics are calculated in Python
+DEFAULT_METRIC = "identity"
 
-def identity_percentage(
-    reference_alleles: Tuple[Allele], alleles: Tuple[Allele]
-) -> float:
+
+def identity_percentage(reference_alleles: Genotype, alleles: Genotype) -> float:
     """Calculate the percentage of alleles that are both in `reference_alleles` and in
-    `variant_alleles`
+    `alleles`
 
-    :param reference_alleles: tuple of alleles of a Variant model. Important note: it can contain
-      only one element! E. g. if reference_alleles == ('C', ), than Variant genotype is actually
-      ('C', 'C')
-    :param alleles: tuple of some alleles for comparison with `reference_alleles`
-    """
-    if len(reference_alleles) == 1 and all(
-        allele in reference_alleles for allele in alleles
-    ):
-        return 1
+    Genotypes are compared as multisets, so ("C", "C") and ("C", "T") share one allele
+    of two. Missing alleles (None) are never shared
 
-    common_elements = set(reference_alleles) & set(alleles)
+    :param reference_alleles: alleles of a Variant, e.g. ("C", "T")
+    :param alleles: some alleles for comparison with `reference_alleles`
+    """
+    common_alleles = Counter(filter(None, reference_alleles)) & Counter(
+        filter(None, alleles)
+    )
 
-    return len(common_elements) / 2
+    return sum(common_alleles.values()) / 2
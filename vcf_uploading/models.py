@@ -1,18 +1,30 @@
+import asyncio
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, ContextManager, Dict, Iterator, List, Optional, Tuple
 
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.core.validators import FileExtensionValidator
 from django.db import models, transaction
-from django.db.models import Q
+from django.db.models import Case, Exists, F, OuterRef, Q, Subquery, Value, When
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from loguru import logger
-from pysam.libcbcf import VariantFile, VariantRecord, VariantRecordSample
 
-from nationality_prediction.predictors import FastNGSAdmixPredictor
-from vcf_uploading.vcf_processing import VCFFile, VCFRecord
+from vcf_uploading.interning import atomic_with_interning, get_intern_cache
+from vcf_uploading.metrics import DEFAULT_METRIC
+from vcf_uploading.profiling import profiled
+from vcf_uploading.progress import ProgressTracker, get_progress_key, track_progress
+from vcf_uploading.vcf_processing import Region, VCFFile, VCFRecord, parse_region
+
+if TYPE_CHECKING:
+    # pysam and numpy are imported on the first use, so they don't slow down the start of
+    # every management command and worker
+    from pysam import VariantFile, VariantRecord, VariantRecordSample
+
+    from nationality_prediction.plink import PlinkFileset
 
 
 def get_deleted_sample():
@@ -21,28 +33,16 @@ def get_deleted_sample():
 
 class RawVCF(models.Model):
     class VCFTimeCheckingManager(models.Manager):
-        _TIME_THRESHOLD = timedelta(minutes=45)
-
         def get_queryset(self):
-            """Return only files that were uploaded recently or are already saved
+            """Return only files that are saved or were uploaded recently
 
-            Files that were uploaded earlier that current time - `self._TIME_THRESHOLD`
-            are deleted in this query
+            Expired files are only hidden here. They are deleted by
+            `RawVCF.delete_expired()`, e.g. with `manage.py delete_expired_vcfs`
             """
-            keep_files_after = timezone.now() - self._TIME_THRESHOLD
-
-            not_saved_vcfs = (
-                super()
-                .get_queryset()
-                .filter(date_created__lt=keep_files_after, saved=False)
-            )
-            deletion_log = not_saved_vcfs.delete()
-            logger.info("Deleted not saved VCF: {}", deletion_log)
-
             return (
                 super()
                 .get_queryset()
-                .filter(Q(saved=True) | Q(date_created__gte=keep_files_after))
+                .filter(Q(saved=True) | Q(date_created__gte=RawVCF.get_expiration_time()))
             )
 
     from .validators import check_vcf_format
@@ -54,13 +54,92 @@ class RawVCF(models.Model):
             FileExtensionValidator(allowed_extensions=["vcf", "vcf.gz", "bcf", "gz"]),
         ],
     )
-    date_created = models.DateTimeField(auto_now_add=True)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
     saved = models.BooleanField(default=False)
     n_samples = models.IntegerField(blank=True, null=True)
+    n_records = models.IntegerField(blank=True, null=True)
     n_refs = models.IntegerField(blank=True, null=True)
     n_alts = models.IntegerField(blank=True, null=True)
     n_missing_genotypes = models.IntegerField(blank=True, null=True)
+    profiling_enabled = models.BooleanField(
+        default=False,
+        help_text=_("Profile saving of the file and search of similar samples"),
+    )
     objects = VCFTimeCheckingManager()
+    all_objects = models.Manager()
+
+    INDEX_EXTENSIONS = (".tbi", ".csi")
+
+    @staticmethod
+    def get_expiration_time() -> datetime:
+        """Return time before which not saved files are expired"""
+        return timezone.now() - timedelta(minutes=settings.UNSAVED_VCF_LIFETIME_MINUTES)
+
+    @classmethod
+    def expired(cls) -> models.QuerySet:
+        """Return files that were not saved to the database in time"""
+        return cls.all_objects.filter(saved=False, date_created__lt=cls.get_expiration_time())
+
+    @classmethod
+    def delete_expired(cls, batch_size: int = 500, dry_run: bool = False) -> Tuple[int, int]:
+        """Delete expired files from the database and the storage in batches
+
+        Each batch is deleted in its own short transaction, so the cleanup doesn't hold
+        locks for long. Rows locked by another transaction (e.g. a file being saved right
+        now) are skipped. Files are unlinked after the transaction is committed
+
+        :param batch_size: number of files deleted in one transaction
+        :param dry_run: only count expired files without deleting them
+        :return: number of deleted (or, in the dry run, expired) rows and unlinked files
+        """
+        n_rows = n_files = 0
+        last_id = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    cls.expired()
+                    .filter(pk__gt=last_id)
+                    .order_by("pk")
+                    .select_for_update(skip_locked=True)
+                    .values_list("pk", "file")[:batch_size]
+                )
+                if not batch:
+                    break
+
+                last_id = batch[-1][0]
+                n_rows += len(batch)
+
+                if dry_run:
+                    continue
+
+                cls.all_objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+                file_names = [name for _, name in batch if name]
+                transaction.on_commit(lambda names=file_names: cls.delete_files(names))
+                n_files += len(file_names)
+
+            logger.info("Deleted {} expired VCF files", n_rows)
+
+        return n_rows, n_files
+
+    @classmethod
+    def delete_files(cls, names: List[str]):
+        """Delete files `names` and their indices from the storage"""
+        storage = cls._meta.get_field("file").storage
+
+        for name in names:
+            for path in [name] + [name + extension for extension in cls.INDEX_EXTENSIONS]:
+                if storage.exists(path):
+                    storage.delete(path)
+
+    def track_progress(self, operation: str) -> ContextManager[ProgressTracker]:
+        """Return context manager publishing progress of `operation` with this file
+
+        The total number of records is known after `self.calculate_statistics()`
+        """
+        return track_progress(
+            get_progress_key(self.pk, operation), operation, total=self.n_records
+        )
 
     def calculate_statistics(self):
         """Calculate statistics of VCF file
@@ -77,6 +156,8 @@ class RawVCF(models.Model):
           * n_alts: int — number of alleles that are not identical to a reference
           * n_missing: int — number of alleles with unknown genotype
         """
+        from pysam import VariantFile
+
         from vcf_uploading.types import SampleStatistics
 
         logger.info("Trying to read VCF file with pysam")
@@ -122,9 +203,26 @@ class RawVCF(models.Model):
 
         return samples_statistics
 
+    @profiled("save_samples_to_db")
     def save_samples_to_db(self):
+        """Save samples of the file and their variants to the database
+
+        With `SPARSE_VARIANTS` homozygous reference genotypes aren't saved. Instead,
+        records of the file are joined into callable intervals of the samples
+        """
+        from pysam import VariantFile
+
         from vcf_uploading.types import SamplesDict
-        from vcf_uploading.utils import are_samples_empty, parse_samples, save_record_to_db
+        from vcf_uploading.utils import (
+            add_to_intervals,
+            are_samples_empty,
+            create_callable_intervals,
+            parse_samples,
+            save_record_to_db,
+        )
+
+        sparse: bool = settings.SPARSE_VARIANTS
+        intervals: List[List[int]] = []
 
         with transaction.atomic():
             self.saved = True
@@ -133,13 +231,12 @@ class RawVCF(models.Model):
             logger.info("Trying to read VCF file with pysam")
             vcf: VariantFile = VariantFile(self.file.path)
 
-            with transaction.atomic():
+            with atomic_with_interning(), self.track_progress(
+                "save_samples_to_db"
+            ) as progress:
                 first_iteration = True
 
                 for i, record in enumerate(vcf.fetch()):
-                    if i % 100 == 1:
-                        logger.debug("{} records processed", i)
-
                     if first_iteration:
                         if are_samples_empty(record):
                             break
@@ -149,12 +246,88 @@ class RawVCF(models.Model):
                             break
                         first_iteration = False
 
-                    save_record_to_db(record=record, samples=samples)
+                    snp = save_record_to_db(record=record, samples=samples, sparse=sparse)
+                    if sparse and snp is not None:
+                        add_to_intervals(
+                            intervals,
+                            snp.chromosome_id,
+                            snp.position,
+                            max(snp.position, record.stop),
+                            max_gap=settings.CALLABLE_INTERVAL_MAX_GAP,
+                        )
+                    progress.update(i + 1)
+
+                if intervals:
+                    create_callable_intervals(
+                        samples.values(),
+                        intervals,
+                        max_gap=settings.CALLABLE_INTERVAL_MAX_GAP,
+                    )
 
                 logger.info("File is saved to the database")
                 logger.debug("File.saved: {}", self.saved)
 
+    def iter_region_lines(
+        self, region: Optional[str] = None, samples: Optional[List[str]] = None
+    ) -> Iterator[str]:
+        """Return iterator over lines of `self.file` restricted to `region` and `samples`
+
+        Records are fetched through the tabix/CSI index of the file if it has one.
+        Otherwise, the whole file is scanned. In both cases records are read one by one,
+        so memory usage doesn't depend on the file size
+
+        :param region: region in samtools format, e.g. "chr1:1-1000000". Whole file by default
+        :param samples: names of samples to keep. All samples by default
+        :raises ValueError: if `region` has a wrong format or some of `samples`
+            are not in the file
+        """
+        from pysam import VariantFile
+
+        parsed_region: Optional[Region] = parse_region(region) if region else None
+
+        vcf: VariantFile = VariantFile(self.file.path)
+        try:
+            if samples:
+                vcf.subset_samples(samples)
+
+            if parsed_region is None:
+                records = vcf.fetch()
+            elif vcf.index is not None:
+                contig = next(
+                    (
+                        alias
+                        for alias in parsed_region.contig_aliases()
+                        if alias in vcf.index
+                    ),
+                    None,
+                )
+                records = (
+                    vcf.fetch(contig, parsed_region.start, parsed_region.end)
+                    if contig is not None
+                    else iter(())
+                )
+            else:
+                logger.info("File {} has no index, scanning it", self.file.name)
+                records = (
+                    record
+                    for record in vcf.fetch()
+                    if parsed_region.contains(record.chrom, record.pos)
+                )
+        except ValueError:
+            vcf.close()
+            raise
+
+        def lines():
+            with vcf:
+                yield str(vcf.header)
+                for record in records:
+                    yield str(record)
+
+        return lines()
+
     def get_samples(self) -> List[str]:
+        from pysam import VariantFile
+
         vcf_file_path = Path(self.file.path)
 
         pysam_vcf: VariantFile = VariantFile(vcf_file_path)
@@ -166,66 +339,163 @@ class RawVCF(models.Model):
         return samples
 
     def predict_nationality(self) -> Dict[str, Dict[str, float]]:
+        """Synchronous version of `self.apredict_nationality()`"""
+        return async_to_sync(self.apredict_nationality)()
+
+    async def apredict_nationality(self) -> Dict[str, Dict[str, float]]:
         """Predict nationalities for each sample in `self.file`
 
+        Predictions for different samples are run concurrently, at most
+        `settings.COMMAND_LINE_TOOLS_MAX_CONCURRENCY` of them at once
+
         :return samples_nationalities: Dict[str, Dict[str, float]] - a dictionary,
             where the keys are the samples, and the values are the prediction of
             nationalities. In the predictions, keys are nationalities, and values
             are their probabilities
         """
-        logger.info("Predicting nationality for RawVCF")
+        from pysam import VariantFile
 
-        predictions = {}
+        from nationality_prediction.predictors import FastNGSAdmixPredictor
 
-        for sample in self.get_samples():
-            logger.info("Predicting nationality for sample {}", sample)
-            sample_vcf: VariantFile = VariantFile(self.file.path)
-            sample_vcf.subset_samples([sample])
+        logger.info("Predicting nationality for RawVCF")
 
-            predictor = FastNGSAdmixPredictor(sample_vcf)
-            predictions[sample] = predictor.predict()
+        samples = self.get_samples()
+        # Files and temporary directories of a sample are opened only when its turn comes
+        semaphore = asyncio.Semaphore(settings.COMMAND_LINE_TOOLS_MAX_CONCURRENCY)
+
+        async def predict(sample: str) -> Dict[str, float]:
+            async with semaphore:
+                logger.info("Predicting nationality for sample {}", sample)
+                sample_vcf: VariantFile = VariantFile(self.file.path)
+                try:
+                    sample_vcf.subset_samples([sample])
+                    return await FastNGSAdmixPredictor(sample_vcf).apredict()
+                finally:
+                    sample_vcf.close()
+
+        samples_predictions = await asyncio.gather(
+            *(predict(sample) for sample in samples)
+        )
 
-            sample_vcf.close()
+        predictions = dict(zip(samples, samples_predictions))
 
         logger.info("Returning nationality predictions")
         logger.debug("Predictions: {}", predictions)
         return predictions
 
-    def find_similar_samples_in_db(self):
-        from .utils import get_average_similarities
+    @profiled("find_similar_samples_in_db")
+    def find_similar_samples_in_db(
+        self, metric: str = DEFAULT_METRIC
+    ) -> Dict[str, Dict[str, float]]:
+        """Find similarities of samples of the file to samples in the database
+
+        With the default identity metric, average similarities are summed by the
+        database for blocks of records, see `vcf_uploading.similarity`. Records without
+        SNPs in the database have similarity 0 to all samples, and missing genotypes of
+        the file are skipped. Other metrics are calculated for all records of a sample at
+        once, and records without SNPs are skipped by them
+
+        :param metric: name of a metric from `vcf_uploading.genotype_metrics.METRICS`
+        :return: dictionary, where keys are samples of the file, and values are their
+            similarities to each sample in the database
+        """
+        from pysam import VariantFile
+
+        from .genotype_metrics import get_metric
+        from .similarity import (
+            BLOCK_SIZE,
+            GenotypeQuery,
+            score_samples,
+            score_samples_by_metric,
+        )
+
+        get_metric(metric)  # Unknown metrics fail before the file is read
+        is_scored_by_database = metric == DEFAULT_METRIC
+
         logger.info("Trying to find similar samples in the DB for file {}", self.file.name)
-        similar_samples: Dict[str, Dict[str, List[float]]] = {}
 
         samples = self.get_samples()
+        queries: Dict[str, List[GenotypeQuery]] = {sample: [] for sample in samples}
+        n_sites: Dict[str, int] = dict.fromkeys(samples, 0)
+        sums: Dict[str, Dict[str, float]] = {
+            sample: defaultdict(float) for sample in samples
+        }
 
-        for sample in samples:
-            similar_samples[sample] = defaultdict(list)
+        def score(sample: str):
+            for db_sample, sample_score in score_samples(queries[sample]).items():
+                sums[sample][db_sample] += sample_score.similarity
+            queries[sample].clear()
 
         vcf: VariantFile = VariantFile(self.file.path)
-        # TODO: this can be done MUCH faster
-        # We can check for a few tens of SNPs from file. If a database
-        # sample has different genotypes in most of them, we can exclude it
-        # from the further checks
-        for i, record in enumerate(vcf):
-            if i % 100 == 1:
-                logger.info("{} records processed", i)
-            snp = SNP.from_record(record)
-
-            for sample_name, sample in record.samples.items():
-                if snp is None:
-                    for db_sample in Sample.objects.all():
-                        similar_samples[sample_name][db_sample.cypher].append(0)
-                else:
-                    if all(allele is None for allele in sample.alleles):
-                        continue
-                    db_samples_similarity = SNP.calculate_similarity_to_each_sample(
-                        snp, sample.alleles
-                    )
-                    for db_sample, similarity in db_samples_similarity.items():
-                        similar_samples[sample_name][db_sample].append(similarity)
 
-        similarities: Dict[str, Dict[str, float]] = get_average_similarities(similar_samples)
-        return similarities
+        with self.track_progress("find_similar_samples_in_db") as progress:
+            for i, record in enumerate(vcf):
+                snp = SNP.from_record(record)
+
+                for sample_name, sample in record.samples.items():
+                    if snp is None:
+                        n_sites[sample_name] += 1
+                    elif any(allele is not None for allele in sample.alleles):
+                        n_sites[sample_name] += 1
+                        queries[sample_name].append(
+                            GenotypeQuery.from_snp(snp, sample.alleles)
+                        )
+                        if (
+                            is_scored_by_database
+                            and len(queries[sample_name]) >= BLOCK_SIZE
+                        ):
+                            score(sample_name)
+
+                progress.update(i + 1)
+
+            if is_scored_by_database:
+                for sample in samples:
+                    score(sample)
+            else:
+                scores = {
+                    sample: score_samples_by_metric(queries[sample], metric)
+                    for sample in samples
+                }
+
+        vcf.close()
+
+        if not is_scored_by_database:
+            return {
+                sample: {
+                    db_sample: round(sample_score, 2)
+                    for db_sample, sample_score in scores[sample].items()
+                }
+                for sample in samples
+            }
+
+        db_samples = list(Sample.objects.values_list("cypher", flat=True))
+        return {
+            sample: {
+                db_sample: round(sums[sample][db_sample] / n_sites[sample], 2)
+                for db_sample in db_samples
+            }
+            if n_sites[sample]
+            else {}
+            for sample in samples
+        }
+
+
+class Profile(models.Model):
+    """Result of profiling an operation, see `vcf_uploading.profiling`"""
+
+    operation = models.CharField(max_length=255)
+    raw_vcf = models.ForeignKey(
+        to=RawVCF, on_delete=models.SET_NULL, null=True, blank=True, related_name="profiles"
+    )
+    date_created = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField()
+    n_stack_samples = models.IntegerField(default=0)
+    pstats_file = models.FileField(upload_to="profiles/")
+    collapsed_stacks_file = models.FileField(upload_to="profiles/")
+    summary = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.operation} ({self.duration:.1f} s, {self.date_created:%Y-%m-%d %H:%M})"
 
 
 class Allele(models.Model):
@@ -233,22 +503,17 @@ class Allele(models.Model):
 
     @classmethod
     def from_str(cls, genotype: str):
-        allele, created = cls.objects.get_or_create(genotype=genotype)
-        return allele
+        return get_intern_cache(cls).get_or_create(genotype)
 
     @classmethod
-    def ref_from_record(cls, record: VariantRecord):
-        allele, created = cls.objects.get_or_create(genotype=record.ref)
-        return allele
+    def ref_from_record(cls, record: "VariantRecord"):
+        return cls.from_str(record.ref)
 
     @classmethod
-    def alt_from_record(cls, record: VariantRecord):
+    def alt_from_record(cls, record: "VariantRecord"):
         if len(record.alts) > 1:
             logger.warning("Multiple alternative alleles!")
-        alt = record.alts[0]
-        allele, created = cls.objects.get_or_create(genotype=alt)
-
-        return allele
+        return cls.from_str(record.alts[0])
 
     def __str__(self):
         return str(self.genotype)
@@ -259,10 +524,10 @@ class Chromosome(models.Model):
     number = models.SmallIntegerField(primary_key=True)
 
     @classmethod
-    def from_record(cls, record: VariantRecord):
+    def from_record(cls, record: "VariantRecord"):
         try:
-            chromosome, created = cls.objects.get_or_create(
-                number=cls.NamesMapper.name_to_number(name=record.chrom)
+            chromosome = get_intern_cache(cls).get_or_create(
+                cls.NamesMapper.name_to_number(name=record.chrom)
             )
 
         except KeyError as e:  # Maybe chromosome is written as a number
@@ -274,9 +539,7 @@ class Chromosome(models.Model):
                 ) from value_error
 
             if chromosome_number in cls.NamesMapper.numbers_to_name_map.keys():
-                chromosome, created = cls.objects.get_or_create(
-                    number=chromosome_number
-                )
+                chromosome = get_intern_cache(cls).get_or_create(chromosome_number)
             else:
                 raise ValueError(
                     _(f"{record.chrom} is not a valid chromosome name")
@@ -319,6 +582,8 @@ class Chromosome(models.Model):
 
 
 class AllelesRecord(models.Model):
+    REFERENCE = "0/0"
+
     record = models.CharField(max_length=15, blank=False, primary_key=True)
 
     @staticmethod
@@ -331,11 +596,8 @@ class AllelesRecord(models.Model):
         return "/".join(map(str, alleles))
 
     @classmethod
-    def from_sample(cls, sample: VariantRecordSample):
-        alleles_record, created = cls.objects.get_or_create(
-            record=cls.from_tuple(sample.allele_indices)
-        )
-        return alleles_record
+    def from_sample(cls, sample: "VariantRecordSample"):
+        return get_intern_cache(cls).get_or_create(cls.from_tuple(sample.allele_indices))
 
     def __str__(self):
         return self.record
@@ -400,27 +662,98 @@ class Sample(models.Model):
     def __str__(self):
         return self.cypher
 
-    def to_vcf(self) -> VCFFile:
-        vcf_file = VCFFile(sample=str(self))
-
-        variants = Variant.objects.filter(sample=self).select_related("snp")
-
-        for variant in variants:
-            vcf_record = VCFRecord(
-                chromosome=str(variant.snp.chromosome),
-                position=variant.snp.position,
-                sample=str(self),
-                sample_indexes=variant.alleles_record,
-                ref=str(variant.snp.reference_allele),
-                alts=[str(variant.snp.alternative_allele)],
-                id_=variant.snp.name,
+    def get_genotypes(self) -> models.QuerySet:
+        """Return genotypes of the sample sorted by genomic position
+
+        Rows are (SNP ID, chromosome, position, SNP name, REF, ALT, alleles record).
+        Besides stored variants, they include homozygous reference genotypes at SNPs in
+        callable intervals of the sample, see `CallableInterval`. Alleles and genotypes
+        are primary keys of their tables, so they are taken from the SNP and Variant rows
+        without extra queries
+        """
+        variants = Variant.objects.filter(sample=self, snp__isnull=False).values_list(
+            "snp_id",
+            "snp__chromosome_id",
+            "snp__position",
+            "snp__name",
+            "snp__reference_allele_id",
+            "snp__alternative_allele_id",
+            "alleles_record_id",
+        )
+        references = (
+            SNP.objects.filter(
+                chromosome__callable_intervals__sample=self,
+                position__gte=F("chromosome__callable_intervals__start"),
+                position__lte=F("chromosome__callable_intervals__end"),
+            )
+            .filter(
+                ~Exists(
+                    Variant.objects.filter(
+                        sample=self,
+                        snp=OuterRef("pk"),
+                        chromosome_id=OuterRef("chromosome_id"),
+                    )
+                )
+            )
+            .annotate(
+                alleles_record=Value(
+                    AllelesRecord.REFERENCE, output_field=models.CharField()
+                )
+            )
+            .values_list(
+                "id",
+                "chromosome_id",
+                "position",
+                "name",
+                "reference_allele_id",
+                "alternative_allele_id",
+                "alleles_record",
+            )
+        )
+
+        return variants.union(references, all=True).order_by(
+            "snp__chromosome_id", "snp__position"
+        )
+
+    def iter_vcf_records(self, chunk_size: int = 2000) -> Iterator[VCFRecord]:
+        """Yield VCF records of the sample sorted by genomic position
+
+        Genotypes are read with a single query in chunks of `chunk_size` rows, so memory
+        usage doesn't depend on the number of variants
+
+        :param chunk_size: number of rows fetched from the database at once
+        """
+        genotypes = self.get_genotypes()
+        sample = str(self)
+
+        for _, chromosome, position, name, ref, alt, alleles_record in genotypes.iterator(
+            chunk_size=chunk_size
+        ):
+            yield VCFRecord(
+                chromosome=Chromosome.NamesMapper.number_to_name(chromosome),
+                position=position,
+                sample=sample,
+                sample_indexes=alleles_record or "./.",
+                ref=ref,
+                alts=[alt],
+                id_=name or ".",
             )
-            vcf_file.add_record(vcf_record)
 
-        return vcf_file
+    def to_vcf(self) -> VCFFile:
+        """Return VCF file of the sample. Its records are read lazily, when it is written"""
+        return VCFFile(sample=str(self), records=self.iter_vcf_records())
+
+    def to_plink(self) -> "PlinkFileset":
+        from nationality_prediction.plink import PlinkFileset
+
+        return PlinkFileset.from_calls(
+            (self.cypher, *genotype) for genotype in self.get_genotypes()
+        )
 
     def predict_nationality(self):
-        predictor = FastNGSAdmixPredictor(self.to_vcf())
+        from nationality_prediction.predictors import FastNGSAdmixPredictor
+
+        predictor = FastNGSAdmixPredictor(self.to_plink())
         return predictor.predict()
 
 
@@ -446,13 +779,53 @@ class SNP(models.Model):
             f"REF: {self.reference_allele} ALT: {self.alternative_allele}"
         )
 
+    def get_variants(self) -> models.QuerySet:
+        """Return variants of the SNP. They are read from one partition of the table"""
+        return Variant.objects.filter(snp=self, chromosome_id=self.chromosome_id)
+
+    def get_callable_intervals(self) -> models.QuerySet:
+        """Return callable intervals containing the SNP"""
+        return CallableInterval.objects.filter(
+            chromosome_id=self.chromosome_id,
+            start__lte=self.position,
+            end__gte=self.position,
+        )
+
+    def get_reference_variant(self, sample_id: str) -> "Variant":
+        """Return not saved variant of the sample with homozygous reference genotype"""
+        return Variant(
+            sample_id=sample_id,
+            snp=self,
+            chromosome_id=self.chromosome_id,
+            alleles_record_id=AllelesRecord.REFERENCE,
+            allele_1_id=self.reference_allele_id,
+            allele_2_id=self.reference_allele_id,
+        )
+
+    def iter_variants(self) -> Iterator["Variant"]:
+        """Yield variants of the SNP including not stored homozygous reference ones
+
+        Samples saved with `SPARSE_VARIANTS` have no variants with homozygous reference
+        genotypes. For such samples, whose callable intervals contain the SNP, not saved
+        variants are yielded. Variants are read with two queries
+        """
+        yield from self.get_variants()
+
+        reference_samples = (
+            self.get_callable_intervals()
+            .filter(~Exists(self.get_variants().filter(sample=OuterRef("sample_id"))))
+            .values_list("sample_id", flat=True)
+        )
+        for sample_id in reference_samples:
+            yield self.get_reference_variant(sample_id)
+
     def get_samples(self) -> List[Sample]:
-        variants_with_snp = Variant.objects.filter(snp=self).select_related("sample")
+        variants_with_snp = self.get_variants().select_related("sample")
         samples = [v.sample for v in variants_with_snp]
         return samples
 
     @classmethod
-    def from_record(cls, record: VariantRecord) -> Optional["SNP"]:
+    def from_record(cls, record: "VariantRecord") -> Optional["SNP"]:
         position = record.pos
         chromosome = Chromosome.from_record(record)
         ref_allele = Allele.ref_from_record(record)
@@ -468,26 +841,22 @@ class SNP(models.Model):
             return None
 
     def calculate_similarity_to_each_sample(self, alleles: Tuple[str]):
-        from .utils import get_genotype
-        variants_with_snp = Variant.objects.filter(snp=self).select_related("sample")
-        all_samples = {sample.cypher for sample in Sample.objects.all()}
-        checked_samples = set()
+        """Return similarities of genotypes of all samples at the SNP to `alleles`
 
-        similarities: Dict[str, float] = {}
+        They are calculated by the database, see `vcf_uploading.similarity`. Samples
+        without genotypes have similarity 0
+        """
+        from .similarity import GenotypeQuery, score_samples
 
-        for variant in variants_with_snp:
-            sample = variant.sample.cypher
-            if all(allele is None for allele in alleles):
-                similarity = 0
-            else:
-                genotype = get_genotype(*alleles)
-                similarity = variant.calculate_similarity(genotype)
+        samples = Sample.objects.values_list("cypher", flat=True)
+        similarities: Dict[str, float] = dict.fromkeys(samples, 0)
 
-            similarities[sample] = similarity
-            checked_samples.add(sample)
+        if all(allele is None for allele in alleles):
+            return similarities
 
-        for sample_without_variant in all_samples - checked_samples:
-            similarities[sample_without_variant] = 0
+        scores = score_samples([GenotypeQuery.from_snp(self, alleles)])
+        for sample, score in scores.items():
+            similarities[sample] = score.similarity
 
         return similarities
 
@@ -495,21 +864,56 @@ class SNP(models.Model):
 class Variant(models.Model):
     from .metrics import identity_percentage
 
+    class Meta:
+        indexes = [models.Index(fields=["snp", "sample"], name="variant_snp_sample_idx")]
+
     alleles_record = models.ForeignKey(
         to=AllelesRecord, on_delete=models.SET_NULL, null=True, blank=True
     )
     sample = models.ForeignKey(to=Sample, on_delete=models.CASCADE)
     snp = models.ForeignKey(to=SNP, on_delete=models.SET_NULL, null=True, blank=True)
+    # Copy of `snp.chromosome`. On PostgreSQL the table is partitioned by it, see
+    # vcf_uploading/partitioning.py. Filter by it to read only one partition
+    chromosome = models.ForeignKey(
+        to=Chromosome, on_delete=models.CASCADE, null=True, blank=True, db_index=False
+    )
+    # Alleles of the genotype in the order of the VCF record, None if an allele is
+    # missing. Primary keys of alleles are the alleles themselves, so they are read
+    # without joins
+    allele_1 = models.ForeignKey(
+        to=Allele,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_index=False,
+        related_name="+",
+    )
+    allele_2 = models.ForeignKey(
+        to=Allele,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_index=False,
+        related_name="+",
+    )
+    # Deprecated: alleles of variants saved before `allele_1` and `allele_2`. The
+    # fill_variant_alleles command copies them to these columns and empties the table.
+    # The field will be removed in the next release, after all databases are filled
     alleles = models.ManyToManyField(to=Allele)
 
-    def get_genotype_string(self):
-        alleles = self.alleles.all()
+    def save(self, *args, **kwargs):
+        if self.chromosome_id is None and self.snp_id is not None:
+            self.chromosome_id = self.snp.chromosome_id
+        super().save(*args, **kwargs)
 
-        if len(alleles) == 1:
-            genotype = f"{alleles[0]}, {alleles[0]}"
-        else:
-            genotype = ", ".join(str(allele) for allele in alleles) or "unknown"
-        return genotype
+    @property
+    def genotype(self) -> Tuple[Optional[str], Optional[str]]:
+        return self.allele_1_id, self.allele_2_id
+
+    def get_genotype_string(self):
+        if all(allele is None for allele in self.genotype):
+            return "unknown"
+        return ", ".join(allele or "." for allele in self.genotype)
 
     def __str__(self):
         return (
@@ -518,11 +922,93 @@ class Variant(models.Model):
         )
 
     def calculate_similarity(
-        self, alleles: Tuple[Allele], metric=identity_percentage
+        self, alleles: Tuple[Optional[str], ...], metric=identity_percentage
     ) -> float:
-        variant_alleles = self.alleles.all()
-
-        if all(allele is None for allele in variant_alleles):
+        if all(allele is None for allele in self.genotype):
             return 0
 
-        return metric(variant_alleles, alleles)
+        return metric(self.genotype, alleles)
+
+    @classmethod
+    def fill_alleles(cls, batch_size: int = 10000) -> int:
+        """Copy alleles of variants saved before `allele_1` and `allele_2` from the
+        deprecated `alleles` table to these columns
+
+        The table doesn't keep the order of alleles and stores a homozygous genotype as
+        one allele, so the second allele is taken from the alleles record: it is missing
+        for haploid and partially missing genotypes. Copied rows are deleted from the
+        table, so the next runs make one query
+
+        :param batch_size: number of variants updated in one transaction
+        :return: number of updated variants
+        """
+        links = cls.alleles.through.objects
+        one_allele_records = AllelesRecord.objects.filter(
+            Q(record__contains=".")
+            | Q(record__contains="None")
+            | ~Q(record__contains="/")
+        ).values("pk")
+        n_variants = 0
+
+        while True:
+            variant_ids = list(
+                links.order_by("variant_id")
+                .values_list("variant_id", flat=True)
+                .distinct()[:batch_size]
+            )
+            if not variant_ids:
+                return n_variants
+
+            with transaction.atomic():
+                variants = cls.objects.filter(pk__in=variant_ids)
+                variant_links = links.filter(variant_id=OuterRef("pk")).order_by("pk")
+                n_variants += variants.update(
+                    allele_1=Subquery(variant_links.values("allele_id")[:1])
+                )
+
+                other_links = variant_links.exclude(allele_id=OuterRef("allele_1"))
+                variants.update(
+                    allele_2=Case(
+                        When(
+                            Exists(other_links),
+                            then=Subquery(other_links.values("allele_id")[:1]),
+                        ),
+                        When(
+                            Q(alleles_record__isnull=True)
+                            | Q(alleles_record__in=one_allele_records),
+                            then=Value(None),
+                        ),
+                        default=F("allele_1"),
+                        output_field=models.CharField(),
+                    )
+                )
+                links.filter(variant_id__in=variant_ids).delete()
+
+
+class CallableInterval(models.Model):
+    """Region of a chromosome, where genotypes of a sample were called
+
+    Samples saved with `SPARSE_VARIANTS` have variants only for non-reference and
+    missing genotypes. Their SNPs without variants are homozygous reference if they are
+    inside one of the callable intervals of the sample, and missing otherwise
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chromosome", "start"], name="callable_interval_idx")
+        ]
+
+    sample = models.ForeignKey(
+        to=Sample, on_delete=models.CASCADE, related_name="callable_intervals"
+    )
+    chromosome = models.ForeignKey(
+        to=Chromosome,
+        on_delete=models.CASCADE,
+        db_index=False,
+        related_name="callable_intervals",
+    )
+    start = models.IntegerField()
+    end = models.IntegerField()  # Inclusive
+
+    def __str__(self):
+        return f"{self.sample_id} chr{self.chromosome_id}:{self.start}-{self.end}"
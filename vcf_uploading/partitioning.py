@@ -0,0 +1,309 @@
+"""Partitioning of the `Variant` table by chromosome
+
+On PostgreSQL the table is converted to a table partitioned by the list of chromosome
+numbers: one partition for each chromosome and a default partition for other chromosomes.
+Indexes and foreign keys of the table, e.g. created by migrations, are created on every
+partition, and queries filtering by `Variant.chromosome` read only matching partitions.
+
+PostgreSQL requires unique constraints of a partitioned table to contain the partition
+key, so the primary key of the partitioned table is (id, chromosome), and the chromosome
+of a variant can't be NULL there. Variants, which have neither a chromosome nor a SNP,
+aren't moved to partitions. For the same reason other tables can't have foreign keys
+referencing variants: the table isn't converted if they have. The only exception is the
+deprecated table of alleles of variants, which is emptied before the conversion.
+Migrations changing the primary key of `Variant` won't work on the partitioned table.
+
+Other databases don't support partitioning, there the table is kept as it is
+"""
+from typing import Iterable, List, Optional, Tuple
+
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+from loguru import logger
+
+from vcf_uploading.models import SNP, Chromosome, Variant
+from vcf_uploading.utils import split_into_blocks
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def is_supported() -> bool:
+    return connection.vendor == "postgresql"
+
+
+def get_partition_name(chromosome: Optional[int]) -> str:
+    """Return table name of the partition of `chromosome` or the default partition"""
+    suffix = "default" if chromosome is None else f"chr{chromosome}"
+    return f"{Variant._meta.db_table}_{suffix}"
+
+
+def is_partitioned() -> bool:
+    if not is_supported():
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS "
+            "(SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+            [Variant._meta.db_table],
+        )
+        return cursor.fetchone()[0]
+
+
+def fill_chromosomes() -> int:
+    """Copy chromosomes of SNPs to variants, which don't have them
+
+    :return: number of updated variants
+    """
+    return Variant.objects.filter(chromosome__isnull=True, snp__isnull=False).update(
+        chromosome=Subquery(
+            SNP.objects.filter(pk=OuterRef("snp_id")).values("chromosome_id")[:1]
+        )
+    )
+
+
+def _get_index_definitions(cursor, table: str) -> List[str]:
+    """Return CREATE INDEX statements of not unique indexes of `table`"""
+    cursor.execute(
+        "SELECT pg_get_indexdef(indexrelid) FROM pg_index "
+        "WHERE indrelid = to_regclass(%s) AND NOT indisunique",
+        [table],
+    )
+    return [definition for definition, in cursor.fetchall()]
+
+
+def _get_constraints(cursor, table: str, constraint_type: str) -> List[Tuple[str, str]]:
+    """Return names and definitions of constraints of `table`
+
+    :param constraint_type: "f" for foreign keys, "p" for the primary key
+    """
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype = %s",
+        [table, constraint_type],
+    )
+    return cursor.fetchall()
+
+
+def _get_referencing_foreign_keys(cursor, table: str) -> List[Tuple[str, str]]:
+    """Return tables and names of foreign keys referencing `table`"""
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE confrelid = to_regclass(%s) AND contype = 'f'",
+        [table],
+    )
+    return cursor.fetchall()
+
+
+def partition_variants() -> bool:
+    """Convert the Variant table to a partitioned one and move variants to partitions
+
+    Chromosomes of variants are filled from their SNPs on the way. Alleles are copied
+    from the deprecated table first, see `Variant.fill_alleles`. The conversion is made
+    in one transaction, and the table is locked until it ends
+
+    :return: whether the table was converted. It isn't converted if the database doesn't
+        support partitioning or the table is already partitioned
+    :raise PartitioningError: if other tables have foreign keys referencing variants
+    """
+    if not is_supported() or is_partitioned():
+        return False
+
+    qn = connection.ops.quote_name
+    table = Variant._meta.db_table
+    old_table = f"{table}_unpartitioned"
+    alleles_table = Variant.alleles.through._meta.db_table
+    pk_column = Variant._meta.pk.column
+    snp_column = Variant._meta.get_field("snp").column
+    chromosome_column = Variant._meta.get_field("chromosome").column
+    columns = [field.column for field in Variant._meta.local_concrete_fields]
+    chromosome_expression = (
+        f"COALESCE(v.{qn(chromosome_column)}, "
+        f"s.{qn(SNP._meta.get_field('chromosome').column)})"
+    )
+    selected_columns = [
+        chromosome_expression if column == chromosome_column else f"v.{qn(column)}"
+        for column in columns
+    ]
+
+    n_copied = Variant.fill_alleles()
+    logger.info("Alleles of {} variants are copied", n_copied)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+
+        index_definitions = _get_index_definitions(cursor, table)
+        foreign_keys = _get_constraints(cursor, table, "f")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, pk_column])
+        sequence = cursor.fetchone()[0]
+
+        for referencing_table, name in _get_referencing_foreign_keys(cursor, table):
+            if referencing_table.strip('"') != alleles_table:
+                raise PartitioningError(
+                    f"Foreign key {name} of {referencing_table} references variants"
+                )
+            cursor.execute(f"LOCK TABLE {qn(alleles_table)} IN ACCESS EXCLUSIVE MODE")
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {qn(alleles_table)})")
+            if cursor.fetchone()[0]:
+                raise PartitioningError(
+                    f"Alleles of variants in {alleles_table} aren't copied"
+                )
+            logger.info("Dropping foreign key {} of {}", name, referencing_table)
+            cursor.execute(f"ALTER TABLE {referencing_table} DROP CONSTRAINT {qn(name)}")
+
+        cursor.execute(f"ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}")
+        cursor.execute(
+            f"CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS) "
+            f"PARTITION BY LIST ({qn(chromosome_column)})"
+        )
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} ALTER COLUMN {qn(chromosome_column)} SET NOT NULL"
+        )
+        for chromosome in Chromosome.NamesMapper.numbers_to_name_map:
+            cursor.execute(
+                f"CREATE TABLE {qn(get_partition_name(chromosome))} "
+                f"PARTITION OF {qn(table)} FOR VALUES IN (%s)",
+                [chromosome],
+            )
+        cursor.execute(
+            f"CREATE TABLE {qn(get_partition_name(None))} PARTITION OF {qn(table)} DEFAULT"
+        )
+
+        logger.info("Moving variants to partitions")
+        cursor.execute(
+            f"INSERT INTO {qn(table)} ({', '.join(qn(column) for column in columns)}) "
+            f"SELECT {', '.join(selected_columns)} FROM {qn(old_table)} v "
+            f"LEFT JOIN {qn(SNP._meta.db_table)} s "
+            f"ON s.{qn(SNP._meta.pk.column)} = v.{qn(snp_column)} "
+            f"WHERE {chromosome_expression} IS NOT NULL"
+        )
+        n_moved = cursor.rowcount
+        logger.info("{} variants are moved", n_moved)
+        cursor.execute(f"SELECT COUNT(*) FROM {qn(old_table)}")
+        n_dropped = cursor.fetchone()[0] - n_moved
+        if n_dropped:
+            logger.warning(
+                "{} variants without chromosome and SNP are dropped", n_dropped
+            )
+
+        if sequence:
+            cursor.execute(
+                f"ALTER SEQUENCE {sequence} OWNED BY {qn(table)}.{qn(pk_column)}"
+            )
+        cursor.execute(f"DROP TABLE {qn(old_table)}")
+
+        # Names of indexes and constraints are kept, so migrations can still alter them
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(f'{table}_pkey')} "
+            f"PRIMARY KEY ({qn(pk_column)}, {qn(chromosome_column)})"
+        )
+        for name, definition in foreign_keys:
+            cursor.execute(
+                f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {definition}"
+            )
+        for definition in index_definitions:
+            cursor.execute(definition)
+
+    return True
+
+
+def replace_chromosome_variants(
+    chromosome: int, variants: Iterable[Variant], batch_size: int = 1000
+) -> int:
+    """Replace all variants of `chromosome` with not saved `variants`
+
+    On the partitioned table, `variants` are written to a new table, which then replaces
+    the partition of the chromosome. Until that, readers see the old variants, and the old
+    rows are dropped at once instead of being deleted one by one. The primary key, foreign
+    keys and indexes of the partition are created on the new table before the swap, so
+    it doesn't build them while the table is locked. On other databases the variants are
+    deleted and created in a transaction
+
+    :param chromosome: number of the chromosome
+    :param variants: new variants of the chromosome
+    :param batch_size: number of variants inserted with one query
+    :return: number of inserted variants
+    """
+    if not is_partitioned():
+        with transaction.atomic():
+            Variant.objects.filter(chromosome_id=chromosome).delete()
+            variants = list(variants)
+            for variant in variants:
+                variant.chromosome_id = chromosome
+            Variant.objects.bulk_create(variants, batch_size=batch_size)
+        return len(variants)
+
+    qn = connection.ops.quote_name
+    table = Variant._meta.db_table
+    partition = get_partition_name(chromosome)
+    new_partition = f"{partition}_new"
+    check = f"{new_partition}_check"
+    chromosome_column = qn(Variant._meta.get_field("chromosome").column)
+    fields = [
+        field for field in Variant._meta.local_concrete_fields if not field.primary_key
+    ]
+    insert = (
+        f"INSERT INTO {qn(new_partition)} "
+        f"({', '.join(qn(field.column) for field in fields)}) "
+        f"VALUES ({', '.join(['%s'] * len(fields))})"
+    )
+    n_variants = 0
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {qn(new_partition)}")
+        cursor.execute(
+            f"CREATE TABLE {qn(new_partition)} (LIKE {qn(table)} INCLUDING DEFAULTS)"
+        )
+        # With this constraint the table is attached without checking all its rows
+        cursor.execute(
+            f"ALTER TABLE {qn(new_partition)} ADD CONSTRAINT {qn(check)} "
+            f"CHECK ({chromosome_column} IS NOT NULL AND {chromosome_column} = %s)",
+            [chromosome],
+        )
+
+        for batch in split_into_blocks(iter(variants), batch_size):
+            rows = []
+            for variant in batch:
+                variant.chromosome_id = chromosome
+                rows.append(
+                    [
+                        field.get_db_prep_save(getattr(variant, field.attname), connection)
+                        for field in fields
+                    ]
+                )
+            cursor.executemany(insert, rows)
+            n_variants += len(rows)
+
+        # Attaching the table reuses matching constraints and indexes instead of creating
+        # them. Names are generated, as names of the partition are still taken
+        for constraint_type in ("p", "f"):
+            for _, definition in _get_constraints(cursor, table, constraint_type):
+                cursor.execute(f"ALTER TABLE {qn(new_partition)} ADD {definition}")
+        for definition in _get_index_definitions(cursor, table):
+            _, columns = definition.split(" USING ", 1)
+            cursor.execute(f"CREATE INDEX ON {qn(new_partition)} USING {columns}")
+
+        _delete_alleles_links(chromosome)
+        cursor.execute(f"ALTER TABLE {qn(table)} DETACH PARTITION {qn(partition)}")
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(new_partition)} "
+            f"FOR VALUES IN (%s)",
+            [chromosome],
+        )
+        cursor.execute(f"DROP TABLE {qn(partition)}")
+        cursor.execute(f"ALTER TABLE {qn(new_partition)} RENAME TO {qn(partition)}")
+        cursor.execute(f"ALTER TABLE {qn(partition)} DROP CONSTRAINT {qn(check)}")
+
+    logger.info("Partition {} is replaced with {} variants", partition, n_variants)
+    return n_variants
+
+
+def _delete_alleles_links(chromosome: int):
+    """Delete rows of the deprecated table of alleles of variants of `chromosome`
+
+    Foreign keys referencing the partitioned table are dropped, so they aren't deleted
+    with the partition
+    """
+    Variant.alleles.through.objects.filter(variant__chromosome_id=chromosome).delete()
@@ -0,0 +1,152 @@
+"""Opt-in profiling of long-running operations with VCF files
+
+A profiled operation is run under cProfile and a sampler of its call stacks. Results are
+saved as a `Profile` with a pstats file (open it with `python -m pstats` or snakeviz) and
+collapsed stacks (render them with flamegraph.pl or speedscope)
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+
+from django.core.files.base import ContentFile
+from loguru import logger
+
+PROFILE_HEADER = "X-Profile"
+
+
+def is_profiling_requested(request) -> bool:
+    """Check if `request` has the profiling header and is sent by a staff member"""
+    user = getattr(request, "user", None)
+    return bool(
+        request.headers.get(PROFILE_HEADER)
+        and user is not None
+        and user.is_active
+        and user.is_staff
+    )
+
+
+class StackSampler:
+    """Sample call stacks of a thread in a background thread
+
+    :param thread_id: identifier of the sampled thread
+    :param interval: number of seconds between samples
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def get_frame_name(frame) -> str:
+        return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                stack.append(self.get_frame_name(frame))
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def to_collapsed(self) -> str:
+        """Return stacks in the collapsed format: "root;caller;callee count" per line"""
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+
+def get_summary(profiler: cProfile.Profile, n_lines: int = 40) -> str:
+    """Return the top `n_lines` functions of `profiler` by cumulative time as text"""
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(n_lines)
+    return stream.getvalue()
+
+
+@contextmanager
+def profile_operation(operation: str, raw_vcf=None, enabled: bool = True):
+    """Profile code in the `with` block and save the result as a `Profile`
+
+    The profile is saved even if the code raises an exception
+
+    :param operation: name of the operation, e.g. "save_samples_to_db"
+    :param raw_vcf: file the operation works with
+    :param enabled: if False, the code is run without profiling
+    """
+    if not enabled:
+        yield
+        return
+
+    from vcf_uploading.models import Profile
+
+    logger.info("Profiling {}", operation)
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+
+    start = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        duration = time.perf_counter() - start
+
+        profile: Profile = Profile(
+            operation=operation,
+            raw_vcf=raw_vcf,
+            duration=duration,
+            n_stack_samples=sum(sampler.stacks.values()),
+            summary=get_summary(profiler),
+        )
+        name = f"{operation}_{time.strftime('%Y%m%d_%H%M%S')}"
+        profile.pstats_file.save(
+            f"{name}.pstats",
+            ContentFile(marshal.dumps(pstats.Stats(profiler).stats)),
+            save=False,
+        )
+        profile.collapsed_stacks_file.save(
+            f"{name}.collapsed", ContentFile(sampler.to_collapsed().encode()), save=False
+        )
+        profile.save()
+        logger.info("Profile of {} is saved: {}", operation, profile.pstats_file.name)
+
+
+def profiled(operation: str):
+    """Decorate a method of `RawVCF` to profile it if `profile=True` is passed to it or
+    if profiling is enabled for the file
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, profile: Optional[bool] = False, **kwargs):
+            enabled = bool(profile or getattr(self, "profiling_enabled", False))
+
+            with profile_operation(operation, raw_vcf=self, enabled=enabled):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
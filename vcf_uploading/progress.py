@@ -0,0 +1,281 @@
+"""Progress of long operations with VCF files
+
+Operations publish their progress to the Django cache, so it is visible to other worker
+processes if the cache is shared between them (e.g. set CACHE_URL to Redis or
+Memcached). A database cache doesn't work: operations publish progress inside their
+transactions, so other workers see it only after the operation ends.
+
+Progress is streamed to the browser as server-sent events by
+`vcf_uploading.views.progress_events` and, under ASGI, by `ProgressEventsApp`
+"""
+import asyncio
+import json
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from loguru import logger
+
+PROGRESS_OPERATIONS = ("save_samples_to_db", "find_similar_samples_in_db")
+PROGRESS_EVENTS_PATH = re.compile(
+    r"^/file/vcf/(?P<file_id>\d+)/progress/(?P<operation>[a-z_]+)/events$"
+)
+
+
+def get_cache():
+    return caches[settings.PROGRESS_CACHE_ALIAS]
+
+
+def get_progress_key(file_id: int, operation: str) -> str:
+    return f"progress:vcf:{file_id}:{operation}"
+
+
+@dataclass
+class Progress:
+    operation: str
+    done: int = 0
+    total: Optional[int] = None
+    started: float = 0
+    updated: float = 0
+    status: str = "running"  # "running", "finished" or "failed"
+    error: Optional[str] = None
+
+    @property
+    def throughput(self) -> float:
+        """Number of records processed per second"""
+        elapsed = self.updated - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def percent(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return min(100.0, 100 * self.done / self.total)
+
+    def to_dict(self) -> dict:
+        return {
+            **asdict(self),
+            "throughput": round(self.throughput, 1),
+            "percent": None if self.percent is None else round(self.percent, 1),
+        }
+
+
+class ProgressTracker:
+    """Publish progress of an operation
+
+    Progress is written to the cache at most once per `interval` seconds, so updating it
+    for every record is cheap
+
+    :param key: cache key, see `get_progress_key()`
+    :param operation: name of the operation
+    :param total: expected number of records, if known
+    :param interval: minimal number of seconds between writes to the cache
+    """
+
+    def __init__(
+        self, key: str, operation: str, total: Optional[int] = None, interval: float = 0.5
+    ):
+        self.key = key
+        self.interval = interval
+        now = time.time()
+        self.progress = Progress(operation=operation, total=total, started=now, updated=now)
+        self._last_publication = 0.0
+        self.publish()
+
+    def publish(self):
+        self._last_publication = time.monotonic()
+        get_cache().set(self.key, self.progress.to_dict(), settings.PROGRESS_TTL)
+
+    def update(self, done: int):
+        self.progress.done = done
+
+        if time.monotonic() - self._last_publication >= self.interval:
+            self.progress.updated = time.time()
+            logger.debug(
+                "{}: {} records processed ({:.1f} records/s)",
+                self.progress.operation,
+                done,
+                self.progress.throughput,
+            )
+            self.publish()
+
+    def finish(self):
+        self.progress.status = "finished"
+        self.progress.updated = time.time()
+        self.publish()
+
+    def fail(self, error: str):
+        self.progress.status = "failed"
+        self.progress.error = error
+        self.progress.updated = time.time()
+        self.publish()
+
+
+@contextmanager
+def track_progress(key: str, operation: str, total: Optional[int] = None):
+    """Return `ProgressTracker`, which is finished on exit or failed on exception"""
+    tracker = ProgressTracker(key, operation, total=total)
+    try:
+        yield tracker
+    except Exception as e:
+        tracker.fail(str(e) or type(e).__name__)
+        raise
+    tracker.finish()
+
+
+def get_progress(key: str) -> Optional[dict]:
+    return get_cache().get(key)
+
+
+def parse_since(query: Dict[str, List[str]]) -> Optional[float]:
+    """Return "since" timestamp from parsed query string or None if it is missing or wrong"""
+    try:
+        return float(query["since"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def format_event(data: Optional[dict], event: str = "progress") -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _next_event(progress: Optional[dict], last_progress: Optional[dict]) -> Optional[str]:
+    """Return event for `progress` if it has changed since `last_progress`"""
+    if progress is None or progress == last_progress:
+        return None
+    return format_event(progress)
+
+
+def get_progress_since(key: str, since: Optional[float] = None) -> Optional[dict]:
+    """Return progress at `key` if the operation was started after `since` (a timestamp)
+
+    It allows to ignore the progress of a previous run of the operation
+    """
+    progress = get_progress(key)
+    if progress is not None and since is not None and progress["started"] < since:
+        return None
+    return progress
+
+
+def _is_expired(opened: float, has_started: bool) -> bool:
+    """Check whether a stream opened at `opened` (monotonic time) has to be closed
+
+    Streams are closed after `PROGRESS_EVENTS_TIMEOUT` seconds, the browser reopens them.
+    If the operation hasn't started in `PROGRESS_EVENTS_START_TIMEOUT` seconds, the stream
+    is closed with the "timeout" event, after which the browser doesn't reopen it
+    """
+    elapsed = time.monotonic() - opened
+    return elapsed >= settings.PROGRESS_EVENTS_TIMEOUT or (
+        not has_started and elapsed >= settings.PROGRESS_EVENTS_START_TIMEOUT
+    )
+
+
+def iter_progress_events(key: str, since: Optional[float] = None) -> Iterator[str]:
+    """Yield server-sent events with progress at `key` until the operation ends
+
+    Comments are sent when nothing changes, so proxies don't close the connection. Under
+    WSGI the stream occupies a thread, so it is closed early, see `_is_expired()`
+
+    :param key: cache key, see `get_progress_key()`
+    :param since: ignore operations started before this timestamp
+    """
+    last_progress = None
+    has_started = False
+    opened = time.monotonic()
+
+    while True:
+        progress = get_progress_since(key, since)
+        yield _next_event(progress, last_progress) or ": keep-alive\n\n"
+        last_progress = progress
+        has_started = has_started or progress is not None
+
+        if progress is not None and progress["status"] != "running":
+            yield format_event(progress, event="end")
+            return
+        if _is_expired(opened, has_started):
+            if not has_started:
+                yield format_event(None, event="timeout")
+            return
+
+        time.sleep(settings.PROGRESS_EVENTS_INTERVAL)
+
+
+async def aiter_progress_events(
+    key: str, since: Optional[float] = None
+) -> AsyncIterator[str]:
+    """Asynchronous version of `iter_progress_events()`"""
+    last_progress = None
+    has_started = False
+    opened = time.monotonic()
+
+    while True:
+        progress = await sync_to_async(get_progress_since, thread_sensitive=False)(
+            key, since
+        )
+        yield _next_event(progress, last_progress) or ": keep-alive\n\n"
+        last_progress = progress
+        has_started = has_started or progress is not None
+
+        if progress is not None and progress["status"] != "running":
+            yield format_event(progress, event="end")
+            return
+        if _is_expired(opened, has_started):
+            if not has_started:
+                yield format_event(None, event="timeout")
+            return
+
+        await asyncio.sleep(settings.PROGRESS_EVENTS_INTERVAL)
+
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+class ProgressEventsApp:
+    """ASGI application streaming progress events without blocking Django workers
+
+    Django 3 can't stream responses asynchronously, so requests to the progress events
+    URL are served here and all other requests are passed to `app`
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        match = (
+            PROGRESS_EVENTS_PATH.match(scope["path"]) if scope["type"] == "http" else None
+        )
+        if match is None or match["operation"] not in PROGRESS_OPERATIONS:
+            return await self.app(scope, receive, send)
+
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+
+        key = get_progress_key(int(match["file_id"]), match["operation"])
+        since = parse_since(parse_qs(scope["query_string"].decode("latin-1")))
+        events = aiter_progress_events(key, since=since)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+
+        try:
+            async for event in events:
+                if disconnected.done():
+                    break
+                await send(
+                    {"type": "http.response.body", "body": event.encode(), "more_body": True}
+                )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def _wait_for_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
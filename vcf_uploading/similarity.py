@@ -0,0 +1,284 @@
+"""Similarity of samples in the database to query genotypes calculated by the database
+
+Query genotypes are sent as a VALUES list and joined to SNPs at their positions and to
+genotypes of samples there. Genotypes are compared like `metrics.identity_percentage`:
+the similarity is the number of shared alleles divided by 2. Homozygous reference
+genotypes of samples saved sparsely are taken from their callable intervals.
+
+Other metrics of `vcf_uploading.genotype_metrics` are calculated in Python: genotypes of
+all samples at the sites are loaded into arrays of allele codes.
+
+SQL is the same for SQLite and PostgreSQL
+"""
+import math
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from django.db import connection
+
+from vcf_uploading.models import SNP, CallableInterval, Variant
+from vcf_uploading.utils import split_into_blocks
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Number of queries sent to the database at once
+BLOCK_SIZE = 100
+
+
+class GenotypeQuery(NamedTuple):
+    chromosome: int
+    position: int
+    allele_1: Optional[str]
+    allele_2: Optional[str]
+    # If set, only the SNP with these alleles is matched. Otherwise all SNPs at the
+    # position are matched
+    ref: Optional[str] = None
+    alt: Optional[str] = None
+
+    @classmethod
+    def from_snp(cls, snp: SNP, alleles: Tuple[Optional[str], ...]) -> "GenotypeQuery":
+        """Return query of `alleles` at `snp`. Haploid genotypes have one allele"""
+        allele_1, allele_2 = (tuple(alleles) + (None, None))[:2]
+        return cls(
+            chromosome=snp.chromosome_id,
+            position=snp.position,
+            allele_1=allele_1,
+            allele_2=allele_2,
+            ref=snp.reference_allele_id,
+            alt=snp.alternative_allele_id,
+        )
+
+
+@dataclass
+class SampleScore:
+    similarity: float = 0  # Sum of similarities at all sites
+    n_sites: int = 0  # Number of sites, where the sample has a genotype
+    n_matched_sites: int = 0  # Number of sites with similarity above 0
+
+
+@dataclass
+class GenotypeArrays:
+    """Allele codes of queries of shape (n_queries, 2) and of `samples` of shape
+    (n_samples, n_queries, 2)
+    """
+
+    samples: List[str]
+    query: "np.ndarray"
+    genotypes: "np.ndarray"
+
+
+MatchedGenotype = Tuple[int, str, Optional[str], Optional[str], float]
+
+
+def _get_similarities_sql(n_queries: int) -> str:
+    """Return SQL selecting (index of the query, sample, allele 1, allele 2, similarity)
+    for genotypes of all samples at the sites of `n_queries` queries
+    """
+    qn = connection.ops.quote_name
+    snp = qn(SNP._meta.db_table)
+    variant = qn(Variant._meta.db_table)
+    interval = qn(CallableInterval._meta.db_table)
+
+    def column(model, field: str) -> str:
+        return qn(model._meta.get_field(field).column)
+
+    def equals(allele: str, query_allele: str) -> str:
+        # Missing alleles are NULL, and they never match
+        return f"CASE WHEN {allele} = {query_allele} THEN 1 ELSE 0 END"
+
+    values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * n_queries)
+    same_order = f"{equals('allele_1', 'query_1')} + {equals('allele_2', 'query_2')}"
+    crossed = f"{equals('allele_1', 'query_2')} + {equals('allele_2', 'query_1')}"
+    interval_sample = f"i.{column(CallableInterval, 'sample')}"
+    variant_site = (
+        f"v.{column(Variant, 'snp')} = t.snp_id "
+        f"AND v.{column(Variant, 'chromosome')} = t.chromosome"
+    )
+
+    return f"""
+        WITH query_genotypes
+            (query_index, chromosome, position, query_1, query_2, ref, alt)
+        AS (VALUES {values}),
+        sites AS (
+            SELECT q.query_index, q.query_1, q.query_2,
+                s.{qn(SNP._meta.pk.column)} AS snp_id,
+                s.{column(SNP, 'chromosome')} AS chromosome,
+                s.{column(SNP, 'position')} AS position,
+                s.{column(SNP, 'reference_allele')} AS ref
+            FROM query_genotypes q
+            JOIN {snp} s ON s.{column(SNP, 'chromosome')} = q.chromosome
+                AND s.{column(SNP, 'position')} = q.position
+                AND (q.ref IS NULL OR s.{column(SNP, 'reference_allele')} = q.ref)
+                AND (q.alt IS NULL OR s.{column(SNP, 'alternative_allele')} = q.alt)
+        ),
+        genotypes AS (
+            SELECT t.query_index, v.{column(Variant, 'sample')} AS sample,
+                v.{column(Variant, 'allele_1')} AS allele_1,
+                v.{column(Variant, 'allele_2')} AS allele_2,
+                t.query_1, t.query_2
+            FROM sites t
+            JOIN {variant} v ON {variant_site}
+            UNION ALL
+            SELECT t.query_index, {interval_sample}, t.ref, t.ref,
+                t.query_1, t.query_2
+            FROM sites t
+            JOIN {interval} i ON i.{column(CallableInterval, 'chromosome')} = t.chromosome
+                AND t.position >= i.{column(CallableInterval, 'start')}
+                AND t.position <= i.{column(CallableInterval, 'end')}
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {variant} v WHERE {variant_site}
+                    AND v.{column(Variant, 'sample')} = {interval_sample}
+            )
+        ),
+        matches AS (
+            SELECT query_index, sample, allele_1, allele_2,
+                {same_order} AS same_order, {crossed} AS crossed
+            FROM genotypes
+        ),
+        similarities AS (
+            SELECT query_index, sample, allele_1, allele_2,
+                0.5 * CASE WHEN same_order >= crossed THEN same_order ELSE crossed END
+                    AS similarity
+            FROM matches
+        )
+    """
+
+
+def _get_params(queries: List[Tuple[int, GenotypeQuery]]) -> list:
+    return [value for index, query in queries for value in (index, *query)]
+
+
+def score_samples(
+    queries: List[GenotypeQuery], block_size: int = BLOCK_SIZE
+) -> Dict[str, SampleScore]:
+    """Sum similarities of samples to `queries` with one query per block of them
+
+    :param queries: genotypes at sites
+    :param block_size: number of queries sent to the database at once
+    :return: dictionary, where keys are samples, which have genotypes at any of the
+        sites, and values are their scores
+    """
+    scores: Dict[str, SampleScore] = {}
+
+    for block in split_into_blocks(enumerate(queries), block_size):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""{_get_similarities_sql(len(block))}
+                SELECT sample, SUM(similarity), COUNT(*),
+                    SUM(CASE WHEN similarity > 0 THEN 1 ELSE 0 END)
+                FROM similarities
+                GROUP BY sample
+                """,
+                _get_params(block),
+            )
+            for sample, similarity, n_sites, n_matched_sites in cursor.fetchall():
+                score = scores.setdefault(sample, SampleScore())
+                score.similarity += float(similarity)
+                score.n_sites += n_sites
+                score.n_matched_sites += n_matched_sites
+
+    return scores
+
+
+def iter_matched_genotypes(
+    queries: List[GenotypeQuery], block_size: int = BLOCK_SIZE
+) -> Iterator[MatchedGenotype]:
+    """Yield genotypes of samples with similarity above 0 to `queries`
+
+    :return: iterator over (index of the query, sample, allele 1, allele 2, similarity)
+        sorted by the index and then by the similarity in the descending order
+    """
+    for block in split_into_blocks(enumerate(queries), block_size):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""{_get_similarities_sql(len(block))}
+                SELECT query_index, sample, allele_1, allele_2, similarity
+                FROM similarities
+                WHERE similarity > 0
+                ORDER BY query_index, similarity DESC, sample
+                """,
+                _get_params(block),
+            )
+            for index, sample, allele_1, allele_2, similarity in cursor.fetchall():
+                yield index, sample, allele_1, allele_2, float(similarity)
+
+
+def get_genotype_arrays(
+    queries: List[GenotypeQuery], block_size: int = BLOCK_SIZE
+) -> GenotypeArrays:
+    """Load genotypes of samples at the sites of `queries` into arrays of allele codes
+
+    Alleles are numbered separately for each query, starting with alleles of the query.
+    Samples without a genotype at a site have missing alleles there. If a query matches
+    several SNPs, the sample gets one of its genotypes at them
+
+    :return: arrays of samples, which have genotypes at any of the sites
+    """
+    import numpy as np
+
+    from .genotype_metrics import MISSING_ALLELE
+
+    codes: List[Dict[str, int]] = [{} for _ in queries]
+
+    def encode(index: int, allele: Optional[str]) -> int:
+        if allele is None:
+            return MISSING_ALLELE
+        return codes[index].setdefault(allele, len(codes[index]))
+
+    query = np.array(
+        [
+            [encode(i, query.allele_1), encode(i, query.allele_2)]
+            for i, query in enumerate(queries)
+        ],
+        dtype=np.int16,
+    ).reshape(len(queries), 2)
+
+    samples: Dict[str, int] = {}
+    rows: List[Tuple[int, int, int, int]] = []
+    for block in split_into_blocks(enumerate(queries), block_size):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""{_get_similarities_sql(len(block))}
+                SELECT query_index, sample, allele_1, allele_2 FROM genotypes
+                """,
+                _get_params(block),
+            )
+            for index, sample, allele_1, allele_2 in cursor.fetchall():
+                rows.append(
+                    (
+                        samples.setdefault(sample, len(samples)),
+                        index,
+                        encode(index, allele_1),
+                        encode(index, allele_2),
+                    )
+                )
+
+    genotypes = np.full((len(samples), len(queries), 2), MISSING_ALLELE, dtype=np.int16)
+    if rows:
+        sample_indexes, query_indexes, *alleles = zip(*rows)
+        genotypes[sample_indexes, query_indexes] = np.column_stack(alleles)
+
+    return GenotypeArrays(samples=list(samples), query=query, genotypes=genotypes)
+
+
+def score_samples_by_metric(
+    queries: List[GenotypeQuery], metric: str, block_size: int = BLOCK_SIZE
+) -> Dict[str, float]:
+    """Score samples by their genotypes at the sites of `queries` with `metric`
+
+    :param metric: name of a metric from `vcf_uploading.genotype_metrics.METRICS`
+    :return: dictionary, where keys are samples, which have genotypes at any of the
+        sites, and values are their scores. Samples with NaN scores are skipped
+    """
+    from .genotype_metrics import get_metric
+
+    calculate = get_metric(metric)
+    arrays = get_genotype_arrays(queries, block_size)
+    scores = calculate(arrays.query, arrays.genotypes)
+
+    return {
+        sample: float(score)
+        for sample, score in zip(arrays.samples, scores)
+        if not math.isnan(score)
+    }
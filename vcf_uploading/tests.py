@@ -1,32 +1,1153 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import itertools
+import marshal
+import math
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from typing import Tuple
+from unittest import mock, skipUnless
 
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from pysam import TabixFile, tabix_index
+
+from exome_p.testing import TemporaryMediaMixin
+from vcf_uploading.forms import SNPSearchForm
+from vcf_uploading.genotype_metrics import METRICS, get_metric
+from vcf_uploading.ingestion import ingest_file
+from vcf_uploading.interning import (
+    atomic_with_interning,
+    get_intern_cache,
+    get_version_cache,
+)
 from vcf_uploading.metrics import identity_percentage
-from vcf_uploading.models import Allele
+from vcf_uploading.models import (
+    SNP,
+    Allele,
+    AllelesRecord,
+    CallableInterval,
+    Chromosome,
+    Nationality,
+    Profile,
+    RawVCF,
+    Sample,
+    Variant,
+)
+from vcf_uploading.partitioning import (
+    get_partition_name,
+    is_partitioned,
+    partition_variants,
+    replace_chromosome_variants,
+)
+from vcf_uploading.progress import (
+    ProgressEventsApp,
+    ProgressTracker,
+    get_progress,
+    get_progress_key,
+)
+from vcf_uploading.similarity import (
+    GenotypeQuery,
+    get_genotype_arrays,
+    score_samples,
+    score_samples_by_metric,
+)
+from vcf_uploading.utils import (
+    cohort_to_vcf,
+    get_cohort_samples,
+    get_similar_samples_from_snp,
+)
+from vcf_uploading.vcf_processing import bgzip
 
 
 class MetricsTestCase(TestCase):
+    def test_identity_percentage_metric(self):
+        self.assertEqual(identity_percentage(("C", "C"), ("T", "C")), 0.5)
+        self.assertEqual(identity_percentage(("C", "T"), ("T", "C")), 1)
+        self.assertEqual(identity_percentage(("C", "T"), ("C", "T")), 1)
+        self.assertEqual(identity_percentage(("C", "T"), ("A", "G")), 0)
+        self.assertEqual(identity_percentage(("C", "C"), ("A", "A")), 0)
+        self.assertEqual(identity_percentage(("G", "G"), ("G", "G")), 1)
+        self.assertEqual(identity_percentage(("A", "G"), ("T", "A")), 0.5)
+        self.assertEqual(identity_percentage(("A", "G"), ("A", "T")), 0.5)
+        self.assertEqual(identity_percentage(("C", "T"), ("C", "C")), 0.5)
+        self.assertEqual(identity_percentage(("C", None), ("C", "C")), 0.5)
+        self.assertEqual(identity_percentage((None, None), (None, None)), 0)
+
+
+class GenotypeTestCase(TestCase):
     def setUp(self):
-        Allele.objects.bulk_create(
-            [
-                Allele(genotype="A"),
-                Allele(genotype="T"),
-                Allele(genotype="G"),
-                Allele(genotype="C"),
-            ]
+        self.alleles = {
+            genotype: Allele.objects.create(genotype=genotype) for genotype in "AG"
+        }
+        self.snp = SNP.objects.create(
+            chromosome=Chromosome.objects.get_or_create(number=1)[0],
+            position=100,
+            reference_allele=self.alleles["A"],
+            alternative_allele=self.alleles["G"],
         )
+        genotypes = (("S1", "A", "G"), ("S2", "G", "G"), ("S3", None, None))
+        for cypher, allele_1, allele_2 in genotypes:
+            Variant.objects.create(
+                sample=Sample.objects.create(cypher=cypher),
+                snp=self.snp,
+                allele_1=self.alleles.get(allele_1),
+                allele_2=self.alleles.get(allele_2),
+            )
 
-    def test_identity_percentage_metric(self):
-        a = Allele.objects.get(genotype="A")
-        t = Allele.objects.get(genotype="T")
-        g = Allele.objects.get(genotype="G")
-        c = Allele.objects.get(genotype="C")
-
-        self.assertEqual(identity_percentage((c,), (t, c)), 0.5)
-        self.assertEqual(identity_percentage((c, t), (t, c)), 1)
-        self.assertEqual(identity_percentage((c, t), (c, t)), 1)
-        self.assertEqual(identity_percentage((c, t), (a, g)), 0)
-        self.assertEqual(identity_percentage((c,), (a, a)), 0)
-        self.assertEqual(identity_percentage((g,), (g, g)), 1)
-        self.assertEqual(identity_percentage((a, g), (t, a)), 0.5)
-        self.assertEqual(identity_percentage((a, g), (a, t)), 0.5)
-        self.assertEqual(identity_percentage((c, t), (c, c)), 0.5)
+    def test_genotype_strings(self):
+        genotypes = {
+            variant.sample_id: variant.get_genotype_string()
+            for variant in Variant.objects.all()
+        }
+        self.assertEqual(genotypes, {"S1": "A, G", "S2": "G, G", "S3": "unknown"})
+
+    def test_similarities_are_calculated_without_queries_per_variant(self):
+        with self.assertNumQueries(2):
+            similarities = self.snp.calculate_similarity_to_each_sample(("G", "G"))
+
+        self.assertEqual(similarities, {"S1": 0.5, "S2": 1, "S3": 0})
+
+    def test_alleles_are_copied_from_deprecated_table(self):
+        self.alleles["C"] = Allele.objects.create(genotype="C")
+        for cypher, record, alleles in (
+            ("S1", "1/2", "GC"),
+            ("S2", "1/1", "G"),
+            ("S3", "1", "G"),
+            ("S4", "None/1", "G"),
+        ):
+            variant = Variant.objects.update_or_create(
+                sample=Sample.objects.get_or_create(cypher=cypher)[0],
+                defaults=dict(
+                    snp=self.snp,
+                    allele_1=None,
+                    allele_2=None,
+                    alleles_record=AllelesRecord.objects.get_or_create(record=record)[0],
+                ),
+            )[0]
+            variant.alleles.set([self.alleles[allele] for allele in alleles])
+
+        stdout = StringIO()
+        call_command("fill_variant_alleles", stdout=stdout)
+
+        self.assertIn("Alleles of 4 variants are copied", stdout.getvalue())
+        genotypes = {
+            sample: (allele_1, allele_2)
+            for sample, allele_1, allele_2 in Variant.objects.values_list(
+                "sample", "allele_1", "allele_2"
+            )
+        }
+        # The table doesn't keep the order of alleles of heterozygous genotypes
+        self.assertEqual(sorted(genotypes.pop("S1")), ["C", "G"])
+        self.assertEqual(
+            genotypes, {"S2": ("G", "G"), "S3": ("G", None), "S4": ("G", None)}
+        )
+        self.assertFalse(Variant.alleles.through.objects.exists())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Variant.fill_alleles(), 0)
+
+
+class SampleExportTestCase(TestCase):
+    def setUp(self):
+        alleles = {genotype: Allele.objects.create(genotype=genotype) for genotype in "ACGT"}
+        self.sample = Sample.objects.create(cypher="S1")
+
+        for chromosome_number, position, ref, alt, record in (
+            (2, 300, "A", "G", "0/1"),
+            (1, 200, "C", "T", "1/1"),
+            (1, 100, "G", "A", "./."),
+        ):
+            snp = SNP.objects.create(
+                chromosome=Chromosome.objects.get_or_create(number=chromosome_number)[0],
+                position=position,
+                reference_allele=alleles[ref],
+                alternative_allele=alleles[alt],
+            )
+            Variant.objects.create(
+                sample=self.sample,
+                snp=snp,
+                alleles_record=AllelesRecord.objects.get_or_create(record=record)[0],
+            )
+
+    def test_records_are_sorted_and_read_in_one_query(self):
+        with self.assertNumQueries(1):
+            lines = list(self.sample.to_vcf().lines())
+
+        records = [line.split("\t") for line in lines if not line.startswith("#")]
+
+        self.assertEqual(
+            [(record[0], record[1], record[3], record[4]) for record in records],
+            [("1", "100", "G", "A"), ("1", "200", "C", "T"), ("2", "300", "A", "G")],
+        )
+        self.assertEqual([record[-1] for record in records], ["./.\n", "1/1\n", "0/1\n"])
+
+    def test_bgzipped_download_is_readable(self):
+        response = self.client.get(
+            reverse("sample_vcf_download", args=[self.sample.cypher]), {"bgzip": 1}
+        )
+        content = b"".join(response.streaming_content)
+
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertEqual(
+            gzip.decompress(content).decode(), "".join(self.sample.to_vcf().lines())
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vcf_path = Path(tmp_dir) / "sample.vcf.gz"
+            vcf_path.write_bytes(content)
+
+            # Only BGZF-compressed files can be indexed
+            tabix_index(str(vcf_path), preset="vcf")
+
+            with TabixFile(str(vcf_path)) as vcf:
+                self.assertEqual(len(list(vcf.fetch("1"))), 2)
+
+    def test_cohort_export(self):
+        sample_2 = Sample.objects.create(cypher="S2")
+        snp = SNP.objects.get(position=200)
+        Variant.objects.create(
+            sample=sample_2,
+            snp=snp,
+            alleles_record=AllelesRecord.objects.get_or_create(record="0/0")[0],
+        )
+        Sample.objects.create(cypher="S3")
+
+        vcf = cohort_to_vcf(get_cohort_samples(cyphers=["S2", "S1"]), block_size=2)
+        lines = "".join(vcf.lines()).splitlines()
+        records = [line.split("\t") for line in lines if not line.startswith("##")]
+
+        self.assertEqual(records[0][9:], ["S1", "S2"])
+        self.assertEqual(
+            [(record[0], record[1], record[9], record[10]) for record in records[1:]],
+            [("1", "100", "./.", "./."), ("1", "200", "1/1", "0/0"), ("2", "300", "0/1", "./.")],
+        )
+
+
+VCF_CONTENT = """##fileformat=VCFv4.2
+##contig=<ID=1>
+##contig=<ID=2>
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tA\tB\tC
+1\t100\t.\tA\tG\t.\t.\t.\tGT\t0/1\t1/1\t0/0
+1\t200\t.\tC\tT\t.\t.\t.\tGT\t0/0\t0/1\t./.
+2\t300\t.\tG\tA\t.\t.\t.\tGT\t1/1\t0/0\t0/1
+"""
+
+
+class VCFMediaMixin(TemporaryMediaMixin):
+    def create_vcf(self, content: str = VCF_CONTENT, name: str = "test.vcf", **fields):
+        """Create `RawVCF` with a file `name` in the temporary MEDIA_ROOT"""
+        return RawVCF.objects.create(file=ContentFile(content, name=name), **fields)
+
+
+class VCFFileDownloadTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.vcf = self.create_vcf()
+
+    def test_missing_file_is_404(self):
+        response = self.client.get(reverse("vcf_file", args=[self.vcf.pk + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_range_request(self):
+        url = reverse("vcf_file", args=[self.vcf.pk])
+
+        response = self.client.get(url)
+        self.assertEqual(b"".join(response.streaming_content).decode(), VCF_CONTENT)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=2-12")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content).decode(), VCF_CONTENT[2:13])
+        self.assertEqual(response["Content-Range"], f"bytes 2-12/{len(VCF_CONTENT)}")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content).decode(), VCF_CONTENT[-5:])
+
+        response = self.client.get(url, HTTP_RANGE=f"bytes={len(VCF_CONTENT)}-")
+        self.assertEqual(response.status_code, 416)
+
+        for invalid_range in ("bytes=5-2", "bytes=-", "bytes=1-2,4-5"):
+            response = self.client.get(url, HTTP_RANGE=invalid_range)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content).decode(), VCF_CONTENT)
+
+    def test_deleted_file_is_404(self):
+        url = reverse("vcf_file", args=[self.vcf.pk])
+        os.remove(self.vcf.file.path)
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_RANGE="bytes=2-12").status_code, 404)
+        self.assertEqual(self.client.get(url, {"region": "1:1-1000"}).status_code, 404)
+
+    def test_region_slice(self):
+        url = reverse("vcf_file", args=[self.vcf.pk])
+
+        response = self.client.get(url, {"region": "chr1:150-1000", "samples": "C,A"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+
+        self.assertTrue(lines[-2].endswith("\tA\tC"))
+        self.assertEqual(lines[-1].split("\t")[:2], ["1", "200"])
+        self.assertEqual(lines[-1].split("\t")[9:], ["0/0", "./."])
+
+        response = self.client.get(url, {"samples": "D"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_region_is_fetched_through_index(self):
+        vcf_path = Path(self.media_root) / "raw_data" / "vcf" / "indexed.vcf.gz"
+        vcf_path.write_bytes(b"".join(bgzip([VCF_CONTENT.encode()])))
+        tabix_index(str(vcf_path), preset="vcf")
+        vcf = RawVCF.objects.create(file="raw_data/vcf/indexed.vcf.gz")
+        url = reverse("vcf_file", args=[vcf.pk])
+
+        with mock.patch("vcf_uploading.models.logger") as models_logger:
+            response = self.client.get(url, {"region": "chr1:150-1000"})
+            lines = b"".join(response.streaming_content).decode().splitlines()
+
+        self.assertTrue(lines[-2].startswith("#CHROM"))
+        self.assertEqual(lines[-1].split("\t")[:2], ["1", "200"])
+        models_logger.info.assert_not_called()
+
+        response = self.client.get(url, {"region": "chr3:1-1000"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertTrue(lines[-1].startswith("#CHROM"))
+
+
+class ASGIExportTestCase(VCFMediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_vcf().save_samples_to_db()
+
+    def get(self, path: str, query_string: bytes = b"") -> Tuple[int, str]:
+        """Send GET request to the ASGI application and return status and body"""
+        from exome_p.asgi import application
+
+        sent = []
+        requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "path": path,
+            "root_path": "",
+            "query_string": query_string,
+            "headers": [],
+            "server": ("testserver", 80),
+        }
+        async_to_sync(application)(scope, receive, send)
+
+        body = b"".join(message.get("body", b"") for message in sent[1:]).decode()
+        return sent[0]["status"], body
+
+    def test_vcf_exports_query_database_while_streaming(self):
+        status, body = self.get(reverse("sample_vcf_download", args=["A"]))
+        self.assertEqual(status, 200)
+        records = [line.split("\t") for line in body.splitlines() if line[0] != "#"]
+        self.assertEqual([record[-1] for record in records], ["0/1", "0/0", "1/1"])
+
+        status, body = self.get(reverse("cohort_vcf_download"), b"samples=A,B")
+        self.assertEqual(status, 200)
+        self.assertIn("\tA\tB", body)
+
+        status, _ = self.get(reverse("sample_vcf_download", args=["D"]))
+        self.assertEqual(status, 404)
+
+class ListViewsTestCase(TestCase):
+    def setUp(self):
+        self.russian = Nationality.objects.create(nationality="Russian")
+        self.vcf = RawVCF.objects.create(file="raw_data/vcf/test.vcf", saved=True)
+
+        for i in range(5):
+            Sample.objects.create(
+                cypher=f"S{i}",
+                nationality=self.russian if i % 2 == 0 else None,
+                vcf_file=self.vcf,
+            )
+
+    def test_samples_are_paginated_by_key(self):
+        url = reverse("samples_list")
+        pages = []
+        after = ""
+
+        while True:
+            with self.assertNumQueries(1):
+                response = self.client.get(
+                    url, {"format": "json", "page_size": 2, "after": after}
+                )
+            data = response.json()
+            pages.append([sample["cypher"] for sample in data["items"]])
+
+            if data["next"] is None:
+                break
+            after = data["next"]
+
+        self.assertEqual(pages, [["S0", "S1"], ["S2", "S3"], ["S4"]])
+
+    def test_samples_filters(self):
+        response = self.client.get(
+            reverse("samples_list"), {"format": "json", "nationality": "russian"}
+        )
+        self.assertEqual(
+            [sample["cypher"] for sample in response.json()["items"]], ["S0", "S2", "S4"]
+        )
+
+        response = self.client.get(
+            reverse("samples_list"),
+            {"format": "json", "saved": "true", "uploaded_before": "2000-01-01"},
+        )
+        self.assertEqual(response.json()["items"], [])
+
+        response = self.client.get(reverse("samples_list"), {"uploaded_after": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_html_list_links_to_next_page(self):
+        response = self.client.get(reverse("samples_list"), {"page_size": 3, "saved": "true"})
+
+        self.assertContains(response, "S2")
+        self.assertNotContains(response, "S3")
+        self.assertEqual(response.context["next_query"], "page_size=3&saved=true&after=S2")
+
+    def test_vcf_files_are_listed_newest_first(self):
+        newer_vcf = RawVCF.objects.create(file="raw_data/vcf/newer.vcf", saved=True)
+
+        response = self.client.get(reverse("vcf_list"), {"format": "json", "page_size": 1})
+        self.assertEqual([file["id"] for file in response.json()["items"]], [newer_vcf.id])
+
+        response = self.client.get(
+            reverse("vcf_list"), {"format": "json", "after": response.json()["next"]}
+        )
+        self.assertEqual([file["id"] for file in response.json()["items"]], [self.vcf.id])
+
+
+class ExpiredVCFCleanupTestCase(VCFMediaMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+
+        long_ago = timezone.now() - timedelta(days=1)
+        self.expired = self.create_vcf(name="old.vcf")
+        self.saved = self.create_vcf(name="saved.vcf", saved=True)
+        self.recent = self.create_vcf(name="new.vcf")
+        RawVCF.all_objects.filter(pk__in=[self.expired.pk, self.saved.pk]).update(
+            date_created=long_ago
+        )
+
+    def test_reading_does_not_delete(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                set(RawVCF.objects.values_list("pk", flat=True)), {self.saved.pk, self.recent.pk}
+            )
+
+        self.assertEqual(RawVCF.all_objects.count(), 3)
+        self.assertTrue(Path(self.expired.file.path).exists())
+
+    def test_command_deletes_rows_and_files(self):
+        index_path = Path(self.expired.file.path + ".tbi")
+        index_path.write_bytes(b"index")
+        orphan_path = Path(self.media_root) / "raw_data" / "vcf" / "orphan.vcf"
+        orphan_path.write_text(VCF_CONTENT)
+        old_time = (timezone.now() - timedelta(days=1)).timestamp()
+        os.utime(orphan_path, (old_time, old_time))
+
+        out = StringIO()
+        call_command("delete_expired_vcfs", "--dry-run", "--orphans", stdout=out)
+        self.assertIn("Found 1 expired VCF files", out.getvalue())
+        self.assertIn("Found 1 orphaned files", out.getvalue())
+        self.assertEqual(RawVCF.all_objects.count(), 3)
+
+        call_command("delete_expired_vcfs", "--orphans", "--batch-size=1", stdout=StringIO())
+
+        self.assertEqual(
+            set(RawVCF.all_objects.values_list("pk", flat=True)),
+            {self.saved.pk, self.recent.pk},
+        )
+        self.assertFalse(Path(self.expired.file.path).exists())
+        self.assertFalse(index_path.exists())
+        self.assertFalse(orphan_path.exists())
+        self.assertTrue(Path(self.recent.file.path).exists())
+
+    def test_files_of_failed_ingestion_are_not_deleted(self):
+        path = Path(self.media_root) / "runs" / "run_1.vcf"
+        path.parent.mkdir()
+        path.write_text(VCF_CONTENT)
+
+        with mock.patch.object(RawVCF, "save_samples_to_db", side_effect=ValueError):
+            self.assertEqual(ingest_file(path).status, "failed")
+        raw_vcf = RawVCF.all_objects.get(file__contains="run_1")
+        self.assertTrue(Path(raw_vcf.file.path).is_symlink())
+
+        RawVCF.all_objects.filter(pk=raw_vcf.pk).update(
+            date_created=timezone.now() - timedelta(days=1)
+        )
+        call_command("delete_expired_vcfs", "--orphans", stdout=StringIO())
+
+        self.assertFalse(RawVCF.all_objects.filter(pk=raw_vcf.pk).exists())
+        self.assertFalse(os.path.lexists(raw_vcf.file.path))
+        self.assertEqual(path.read_text(), VCF_CONTENT)
+
+
+class ProfilingTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.vcf = self.create_vcf()
+        self.url = reverse("find_similar_samples_in_db", args=[self.vcf.pk])
+
+    def test_staff_header_enables_profiling(self):
+        user = User.objects.create_user("user", password="password")
+        self.client.force_login(user)
+        self.client.get(self.url, HTTP_X_PROFILE="1")
+        self.assertFalse(Profile.objects.exists())
+
+        user.is_staff = True
+        user.save()
+        self.client.get(self.url)
+        self.assertFalse(Profile.objects.exists())
+
+        self.client.get(self.url, HTTP_X_PROFILE="1")
+        profile = Profile.objects.get()
+
+        self.assertEqual(
+            (profile.operation, profile.raw_vcf), ("find_similar_samples_in_db", self.vcf)
+        )
+        self.assertIn("find_similar_samples_in_db", profile.summary)
+
+        response = self.client.get(reverse("profile_download", args=[profile.pk, "pstats"]))
+        stats = marshal.loads(b"".join(response.streaming_content))
+        self.assertTrue(
+            any(function == "find_similar_samples_in_db" for _, _, function in stats)
+        )
+
+    def test_per_file_flag_enables_profiling(self):
+        self.vcf.profiling_enabled = True
+        self.vcf.save()
+
+        self.vcf.save_samples_to_db()
+
+        profile = Profile.objects.get()
+        self.assertEqual(profile.operation, "save_samples_to_db")
+        self.assertTrue(profile.collapsed_stacks_file.name.endswith(".collapsed"))
+
+        # Profiles are downloaded only by staff members
+        response = self.client.get(reverse("profile_download", args=[profile.pk, "pstats"]))
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(PROGRESS_EVENTS_INTERVAL=0.01, PROGRESS_EVENTS_TIMEOUT=5)
+class ProgressTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        self.vcf = self.create_vcf()
+        self.vcf.calculate_statistics()
+        self.key = get_progress_key(self.vcf.pk, "save_samples_to_db")
+
+    def test_operation_publishes_progress(self):
+        self.vcf.save_samples_to_db()
+
+        progress = get_progress(self.key)
+        self.assertEqual(progress["status"], "finished")
+        self.assertEqual((progress["done"], progress["total"]), (3, 3))
+        self.assertEqual(progress["percent"], 100)
+
+    def test_failed_operation(self):
+        with mock.patch.object(SNP, "from_record", side_effect=ValueError("Wrong record")):
+            with self.assertRaises(ValueError):
+                self.vcf.find_similar_samples_in_db()
+
+        progress = get_progress(get_progress_key(self.vcf.pk, "find_similar_samples_in_db"))
+        self.assertEqual((progress["status"], progress["error"]), ("failed", "Wrong record"))
+
+    def test_events_stream(self):
+        self.vcf.save_samples_to_db()
+        url = reverse("progress_events", args=[self.vcf.pk, "save_samples_to_db"])
+
+        response = self.client.get(url)
+        events = b"".join(response.streaming_content).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(events.startswith("event: progress\n"))
+        self.assertIn('event: end\ndata: {"operation": "save_samples_to_db"', events)
+
+        # Finished operation started before "since" is ignored, and the stream is
+        # closed, when no operation starts in time
+        with override_settings(PROGRESS_EVENTS_START_TIMEOUT=0.05):
+            response = self.client.get(url, {"since": 2 ** 40})
+            events = b"".join(response.streaming_content).decode()
+        self.assertIn(": keep-alive", events)
+        self.assertEqual(events.count("event:"), 1)
+        self.assertTrue(events.endswith("event: timeout\ndata: null\n\n"))
+
+        # A running operation is streamed until the timeout, then the browser reconnects
+        ProgressTracker(self.key, "save_samples_to_db")
+        with override_settings(PROGRESS_EVENTS_TIMEOUT=0.05):
+            events = b"".join(self.client.get(url).streaming_content).decode()
+        self.assertEqual(events.count("event:"), 1)
+        self.assertTrue(events.startswith("event: progress\n"))
+
+        self.assertEqual(
+            self.client.get(
+                reverse("progress_events", args=[self.vcf.pk, "unknown"])
+            ).status_code,
+            404,
+        )
+
+    def test_asgi_app_streams_events(self):
+        self.vcf.save_samples_to_db()
+        sent = []
+
+        requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait()  # The client doesn't disconnect
+
+        async def send(message):
+            sent.append(message)
+
+        async def django_app(scope, receive, send):
+            raise AssertionError("Progress events must not be passed to Django")
+
+        scope = {
+            "type": "http",
+            "path": f"/file/vcf/{self.vcf.pk}/progress/save_samples_to_db/events",
+            "query_string": b"",
+        }
+        async_to_sync(ProgressEventsApp(django_app))(scope, receive, send)
+
+        self.assertEqual(sent[0]["status"], 200)
+        body = b"".join(message.get("body", b"") for message in sent[1:]).decode()
+        self.assertIn("event: end", body)
+
+
+@override_settings(SPARSE_VARIANTS=True)
+class SparseVariantsTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.vcf = self.create_vcf()
+        self.vcf.save_samples_to_db()
+
+    def test_only_not_reference_genotypes_are_stored(self):
+        self.assertEqual(Variant.objects.count(), 6)
+        self.assertFalse(Variant.objects.filter(alleles_record="0/0").exists())
+        self.assertEqual(
+            sorted(
+                CallableInterval.objects.filter(sample="A").values_list(
+                    "chromosome", "start", "end"
+                )
+            ),
+            [(1, 100, 100), (1, 200, 200), (2, 300, 300)],
+        )
+
+    def test_reference_genotypes_are_restored(self):
+        sample = Sample.objects.get(cypher="A")
+        with self.assertNumQueries(1):
+            lines = list(sample.to_vcf().lines())
+        records = [line.split("\t") for line in lines if not line.startswith("#")]
+        self.assertEqual([record[-1] for record in records], ["0/1\n", "0/0\n", "1/1\n"])
+
+        vcf = cohort_to_vcf(get_cohort_samples(), block_size=2)
+        lines = "".join(vcf.lines()).splitlines()
+        self.assertEqual(
+            [line.split("\t")[9:] for line in lines if not line.startswith("#")],
+            [["0/1", "1/1", "0/0"], ["0/0", "0/1", "./."], ["1/1", "0/0", "0/1"]],
+        )
+
+        self.assertEqual(
+            Sample.objects.get(cypher="C").to_plink().genotypes.ravel().tolist(),
+            [0, -1, 1],
+        )
+
+    def test_similarity_of_reference_genotypes(self):
+        snp = SNP.objects.get(position=100)
+
+        self.assertEqual(
+            snp.calculate_similarity_to_each_sample(("A", "A")),
+            {"A": 0.5, "B": 0, "C": 1},
+        )
+        self.assertEqual(self.vcf.find_similar_samples_in_db()["B"]["B"], 1)
+
+    def test_snps_of_other_files_between_records_are_missing(self):
+        other_vcf = self.create_vcf(
+            "##fileformat=VCFv4.2\n"
+            "##contig=<ID=1>\n"
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tD\n"
+            "1\t150\t.\tT\tC\t.\t.\t.\tGT\t0/1\n",
+            name="other.vcf",
+        )
+        other_vcf.save_samples_to_db()
+
+        snp = SNP.objects.get(position=150)
+        self.assertEqual(
+            snp.calculate_similarity_to_each_sample(("T", "T")),
+            {"A": 0, "B": 0, "C": 0, "D": 0.5},
+        )
+        lines = list(Sample.objects.get(cypher="A").to_vcf().lines())
+        records = [line.split("\t") for line in lines if not line.startswith("#")]
+        self.assertEqual(
+            [(record[1], record[-1]) for record in records],
+            [("100", "0/1\n"), ("200", "0/0\n"), ("300", "1/1\n")],
+        )
+
+    @override_settings(CALLABLE_INTERVAL_MAX_GAP=100)
+    def test_records_closer_than_max_gap_are_joined(self):
+        vcf = self.create_vcf(VCF_CONTENT.replace("\tA\tB\tC", "\tD\tE\tF"), name="a.vcf")
+        vcf.save_samples_to_db()
+
+        self.assertEqual(
+            sorted(
+                CallableInterval.objects.filter(sample="D").values_list(
+                    "chromosome", "start", "end"
+                )
+            ),
+            [(1, 100, 200), (2, 300, 300)],
+        )
+
+
+class SimilarityTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.vcf = self.create_vcf()
+        self.vcf.save_samples_to_db()
+
+    def test_database_scores_match_identity_percentage(self):
+        genotypes = [("A", "G"), ("G", "A"), ("G", "G"), ("A", None), (None, None)]
+        snps = list(SNP.objects.order_by("chromosome", "position"))
+        expected = defaultdict(float)
+        queries = []
+        for snp, genotype in itertools.product(snps, genotypes):
+            queries.append(GenotypeQuery.from_snp(snp, genotype))
+            for variant in snp.get_variants():
+                similarity = identity_percentage(variant.genotype, genotype)
+                expected[variant.sample_id] += similarity
+
+        scores = score_samples(queries, block_size=4)
+
+        self.assertEqual(
+            {sample: score.n_sites for sample, score in scores.items()},
+            {"A": 15, "B": 15, "C": 15},
+        )
+        for sample, score in scores.items():
+            self.assertAlmostEqual(score.similarity, expected[sample])
+
+    def test_search_by_snps(self):
+        forms = [
+            SNPSearchForm(
+                data=dict(
+                    chromosome=chromosome,
+                    position=position,
+                    allele_1=allele_1,
+                    allele_2=allele_2,
+                )
+            )
+            for chromosome, position, allele_1, allele_2 in (
+                ("1", "100", "G", "G"),
+                ("2", "300", "A", "G"),
+            )
+        ]
+        result = get_similar_samples_from_snp(forms)
+
+        self.assertEqual(result.samples.content, [("B", 0.75), ("A", 0.5), ("C", 0.5)])
+        self.assertEqual(
+            result.snp_queries[0].similarity_table.content,
+            [("B", "G, G", 1), ("A", "A, G", 0.5)],
+        )
+
+    def test_similar_samples_of_file(self):
+        similarities = self.vcf.find_similar_samples_in_db()
+
+        self.assertEqual(similarities["A"], {"A": 1, "B": 0.33, "C": 0.33})
+
+    def test_identity_of_arrays_matches_database_scores(self):
+        genotypes = [("A", "G"), ("G", "G"), ("C", None), (None, None)]
+        snps = list(SNP.objects.order_by("chromosome", "position"))
+        queries = [
+            GenotypeQuery.from_snp(snp, genotype)
+            for snp, genotype in itertools.product(snps, genotypes)
+        ]
+
+        arrays = get_genotype_arrays(queries, block_size=5)
+        self.assertEqual(sorted(arrays.samples), ["A", "B", "C"])
+        self.assertEqual(arrays.genotypes.shape, (3, len(queries), 2))
+
+        scores = score_samples_by_metric(queries, "identity", block_size=5)
+        for sample, score in score_samples(queries).items():
+            self.assertAlmostEqual(scores[sample], score.similarity / len(queries))
+
+    def test_metric_is_chosen_by_name(self):
+        similarities = self.vcf.find_similar_samples_in_db(metric="ibs_distance")
+        self.assertEqual(similarities["A"], {"A": 0, "B": 0.67, "C": 0.5})
+
+        forms = [
+            SNPSearchForm(
+                data=dict(chromosome="1", position="100", allele_1="G", allele_2="G")
+            ),
+            SNPSearchForm(
+                data=dict(chromosome="2", position="300", allele_1="A", allele_2="G")
+            ),
+        ]
+        result = get_similar_samples_from_snp(forms, metric="ibs_distance")
+        content = result.samples.content
+        self.assertEqual(content[0], ("B", 0.25))
+        self.assertEqual(dict(content), {"A": 0.5, "B": 0.25, "C": 0.5})
+
+        url = reverse("find_similar_samples_in_db", args=[self.vcf.pk])
+        response = self.client.get(url, {"metric": "concordance"})
+        self.assertEqual(
+            response.context["similar_samples"]["A"], {"A": 1, "B": 0, "C": 0}
+        )
+        self.assertEqual(self.client.get(url, {"metric": "unknown"}).status_code, 400)
+
+
+class GenotypeMetricsTestCase(SimpleTestCase):
+    query = [[0, 1], [0, 0], [1, 1], [-1, -1]]
+    genotypes = [
+        [[1, 0], [0, 0], [1, 1], [0, 0]],
+        [[0, 0], [0, 1], [-1, -1], [1, 1]],
+        [[-1, -1], [-1, -1], [-1, -1], [-1, -1]],
+    ]
+
+    def score(self, metric: str) -> list:
+        return get_metric(metric)(self.query, self.genotypes).tolist()
+
+    def test_identity_matches_identity_percentage(self):
+        alleles = ["A", "G", None]
+        genotypes = list(itertools.product(alleles, repeat=2))
+        codes = {"A": 0, "G": 1, None: -1}
+        for query in genotypes:
+            scores = get_metric("identity")(
+                [[codes[allele] for allele in query]],
+                [[[codes[allele] for allele in genotype]] for genotype in genotypes],
+            )
+            expected = [identity_percentage(query, genotype) for genotype in genotypes]
+            self.assertEqual(scores.tolist(), expected)
+
+    def test_metrics(self):
+        self.assertEqual(self.score("identity"), [0.75, 0.25, 0])
+
+        nan = float("nan")
+        for metric, expected in (
+            ("ibs_distance", [0, 0.5, nan]),
+            ("concordance", [1, 0, nan]),
+            ("allele_sharing_distance", [0, 4, nan]),
+        ):
+            with self.subTest(metric=metric):
+                np.testing.assert_equal(self.score(metric), expected)
+
+    def test_rare_alleles_weigh_more(self):
+        weights = [
+            -math.log(frequency)
+            for frequency in (4 / 6, 2 / 6, 4 / 6, 4 / 6, 3 / 4, 3 / 4)
+        ]
+        expected = (weights[0] + weights[2]) / sum(weights)
+
+        scores = self.score("rare_allele_weighted")
+        self.assertEqual(scores[0], 1)
+        self.assertAlmostEqual(scores[1], expected)
+        self.assertEqual(scores[2], 0)
+
+    def test_metrics_are_sorted_and_looked_up_by_name(self):
+        scores = {"A": 0.5, "B": 0.1, "C": 0.9}
+        self.assertEqual(
+            [sample for sample, _ in METRICS["identity"].sort(scores)], list("CAB")
+        )
+        self.assertEqual(
+            [sample for sample, _ in METRICS["ibs_distance"].sort(scores)], list("BAC")
+        )
+        with self.assertRaisesMessage(ValueError, "Unknown metric euclidean"):
+            get_metric("euclidean")
+
+
+class IngestVCFsTestCase(VCFMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.input_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.input_dir)
+        (self.input_dir / "run_1.vcf").write_text(VCF_CONTENT)
+        (self.input_dir / "run_2.vcf").write_text(
+            VCF_CONTENT.replace("\tA\tB\tC\n", "\tD\tE\tF\n")
+        )
+
+    def ingest(self, *args):
+        out = StringIO()
+        call_command("ingest_vcfs", *args, "--workers=1", stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_files_are_ingested_in_place(self):
+        output = self.ingest(str(self.input_dir / "*.vcf"), "--dry-run")
+        self.assertIn("2 valid", output)
+        self.assertFalse(RawVCF.all_objects.exists())
+
+        output = self.ingest(str(self.input_dir))
+        self.assertIn("2 ingested", output)
+        self.assertIn("genotypes/s", output)
+        self.assertEqual(
+            set(Sample.objects.values_list("cypher", flat=True)), set("ABCDEF")
+        )
+
+        raw_vcf = RawVCF.objects.get(file__contains="run_1")
+        self.assertTrue(raw_vcf.saved)
+        path = Path(raw_vcf.file.path)
+        self.assertTrue(path.is_symlink())
+        self.assertEqual(path.resolve(), (self.input_dir / "run_1.vcf").resolve())
+
+        output = self.ingest(str(self.input_dir / "*.vcf"), "--skip-existing")
+        self.assertIn("2 skipped", output)
+        self.assertEqual(RawVCF.all_objects.count(), 2)
+
+    def test_invalid_file_fails(self):
+        (self.input_dir / "broken.vcf").write_text("not a VCF")
+
+        with self.assertRaises(CommandError):
+            self.ingest(str(self.input_dir / "broken.vcf"))
+
+
+class PartitioningTestCase(TestCase):
+    def setUp(self):
+        a, g = Allele.objects.create(genotype="A"), Allele.objects.create(genotype="G")
+        self.sample = Sample.objects.create(cypher="S1")
+        self.snps = [
+            SNP.objects.create(
+                chromosome=Chromosome.objects.get_or_create(number=number)[0],
+                position=position,
+                reference_allele=a,
+                alternative_allele=g,
+            )
+            for number, position in ((1, 100), (1, 200), (2, 300))
+        ]
+        for snp in self.snps:
+            Variant.objects.create(sample=self.sample, snp=snp)
+
+    def test_chromosome_is_copied_from_snp(self):
+        self.assertEqual(
+            list(
+                Variant.objects.order_by("snp__position").values_list("chromosome", flat=True)
+            ),
+            [1, 1, 2],
+        )
+        self.assertEqual(self.snps[2].get_variants().get().sample, self.sample)
+
+    def test_command_fills_chromosomes_on_sqlite(self):
+        Variant.objects.update(chromosome=None)
+        stdout = StringIO()
+        call_command("partition_variants", stdout=stdout)
+
+        self.assertFalse(is_partitioned())
+        self.assertIn("Chromosomes of 3 variants are filled", stdout.getvalue())
+        self.assertFalse(Variant.objects.filter(chromosome__isnull=True).exists())
+
+    def test_chromosome_variants_are_replaced(self):
+        sample_2 = Sample.objects.create(cypher="S2")
+        n_variants = replace_chromosome_variants(
+            1, (Variant(sample=sample_2, snp=snp) for snp in self.snps[:2])
+        )
+
+        self.assertEqual(n_variants, 2)
+        self.assertEqual(
+            sorted(Variant.objects.values_list("sample", "chromosome")),
+            [("S1", 2), ("S2", 1), ("S2", 1)],
+        )
+
+
+
+@skipUnless(connection.vendor == "postgresql", "Partitioning requires PostgreSQL")
+class PostgreSQLPartitioningTestCase(TestCase):
+    def setUp(self):
+        a, g = Allele.objects.create(genotype="A"), Allele.objects.create(genotype="G")
+        self.sample = Sample.objects.create(cypher="S1")
+        self.snps = [
+            SNP.objects.create(
+                chromosome=Chromosome.objects.get_or_create(number=number)[0],
+                position=position,
+                reference_allele=a,
+                alternative_allele=g,
+            )
+            for number, position in ((1, 100), (1, 200), (2, 300))
+        ]
+        for snp in self.snps:
+            Variant.objects.create(sample=self.sample, snp=snp)
+        Variant.objects.filter(snp=self.snps[2]).update(chromosome=None)
+        Variant.objects.create(sample=self.sample).alleles.set([a])
+        Variant.objects.create(sample=self.sample, snp=self.snps[0]).alleles.set([g])
+        # Pending checks of deferred foreign keys don't let the table be altered
+        connection.check_constraints()
+
+        self.assertTrue(partition_variants())
+
+    def query(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def get_constraint_types(self, table):
+        return sorted(
+            contype
+            for contype, in self.query(
+                "SELECT contype FROM pg_constraint WHERE conrelid = to_regclass(%s)",
+                [table],
+            )
+        )
+
+    def get_index_count(self, table):
+        return self.query("SELECT COUNT(*) FROM pg_indexes WHERE tablename = %s", [table])
+
+    def test_variants_are_moved_to_partitions(self):
+        table = Variant._meta.db_table
+        self.assertTrue(is_partitioned())
+        self.assertFalse(partition_variants())
+
+        for chromosome, n_variants in ((1, 3), (2, 1)):
+            self.assertEqual(
+                self.query(f"SELECT COUNT(*) FROM {get_partition_name(chromosome)}"),
+                [(n_variants,)],
+            )
+        # The variant without a chromosome and a SNP is dropped
+        self.assertEqual(Variant.objects.count(), 4)
+        self.assertEqual(
+            Variant.objects.filter(allele_1__isnull=False).get().allele_1_id, "G"
+        )
+        self.assertFalse(Variant.alleles.through.objects.exists())
+
+        # Primary key and foreign keys to alleles, alleles records, chromosomes, samples
+        # and SNPs
+        self.assertEqual(self.get_constraint_types(table), ["f"] * 6 + ["p"])
+        self.assertEqual(
+            self.get_constraint_types(get_partition_name(1)), ["f"] * 6 + ["p"]
+        )
+        self.assertEqual(self.get_index_count(get_partition_name(1)), [(2,)])
+
+    def test_queries_read_only_partition_of_chromosome(self):
+        plan = self.snps[0].get_variants().explain()
+
+        self.assertIn(get_partition_name(1), plan)
+        self.assertNotIn(get_partition_name(2), plan)
+        self.assertNotIn(get_partition_name(None), plan)
+
+    def test_partition_is_replaced(self):
+        sample_2 = Sample.objects.create(cypher="S2")
+        partition = get_partition_name(1)
+        constraint_types = self.get_constraint_types(partition)
+        index_count = self.get_index_count(partition)
+
+        n_variants = replace_chromosome_variants(
+            1, (Variant(sample=sample_2, snp=snp) for snp in self.snps[:2])
+        )
+
+        self.assertEqual(n_variants, 2)
+        self.assertEqual(
+            sorted(Variant.objects.values_list("sample", "chromosome")),
+            [("S1", 2), ("S2", 1), ("S2", 1)],
+        )
+        self.assertEqual(self.get_constraint_types(partition), constraint_types)
+        self.assertEqual(self.get_index_count(partition), index_count)
+        self.assertEqual(
+            self.query("SELECT to_regclass(%s)", [f"{partition}_new"]), [(None,)]
+        )
+
+@override_settings(INTERNING_CHECK_INTERVAL=0)
+class InterningTestCase(TransactionTestCase):
+    def setUp(self):
+        for genotype in "ACGT":
+            Allele.objects.create(genotype=genotype)
+        Chromosome.objects.create(number=1)
+
+    def test_cached_rows_are_read_without_queries(self):
+        # The first lookups load whole tables
+        Allele.from_str("A")
+        get_intern_cache(Chromosome).get(1)
+        data = {"chromosome": "1", "position": "100", "allele_1": "A", "allele_2": "C"}
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Allele.from_str("G").genotype, "G")
+            form = SNPSearchForm(data=data)
+            self.assertTrue(form.is_valid())
+            self.assertEqual(
+                [value for value, _ in form.fields["allele_1"].choices], list("ACGT")
+            )
+
+        form = SNPSearchForm(data={**data, "allele_1": "N"})
+        self.assertEqual(list(form.errors), ["allele_1"])
+
+    def test_rolled_back_rows_are_not_cached(self):
+        Allele.from_str("A")
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            Allele.from_str("AT")
+            with self.assertNumQueries(1):  # It isn't cached before commit
+                Allele.from_str("AT")
+            raise ValueError()
+
+        self.assertFalse(Allele.objects.filter(genotype="AT").exists())
+        Allele.from_str("AT")
+        self.assertTrue(Allele.objects.filter(genotype="AT").exists())
+        with self.assertNumQueries(0):
+            Allele.from_str("AT")
+
+    def test_rows_saved_in_atomic_block_are_read_without_queries(self):
+        Allele.from_str("A")
+
+        with atomic_with_interning():
+            with self.assertNumQueries(4):  # SELECT, INSERT and a savepoint around it
+                Allele.from_str("AT")
+            with self.assertNumQueries(0):
+                for _ in range(5):
+                    self.assertEqual(Allele.from_str("AT").genotype, "AT")
+
+            with self.assertRaises(ValueError), atomic_with_interning():
+                Allele.from_str("AC")
+                Allele.from_str("AG")
+                raise ValueError()
+
+            with atomic_with_interning():
+                Allele.from_str("AG")
+
+            # Rows of the rolled back block are discarded, the others are kept
+            with self.assertNumQueries(0):
+                Allele.from_str("AT")
+                Allele.from_str("AG")
+            with self.assertNumQueries(4):
+                Allele.from_str("AC")
+            self.assertTrue(Allele.objects.filter(genotype="AC").exists())
+
+        with self.assertNumQueries(0):
+            Allele.from_str("AT")
+            Allele.from_str("AC")
+            Allele.from_str("AG")
+
+    def test_cache_is_cleared_when_other_process_changes_table(self):
+        Allele.from_str("A")
+        Allele.objects.filter(genotype="A").update(genotype="N")
+        get_version_cache().incr(get_intern_cache(Allele).version_key)
+
+        with self.assertNumQueries(1):
+            alleles = get_intern_cache(Allele).all()
+        self.assertEqual([allele.pk for allele in alleles], list("CGNT"))
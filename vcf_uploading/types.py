@@ -1,7 +1,7 @@
 from collections import namedtuple
 from dataclasses import dataclass
 from enum import Enum
-from typing import Dict, List, Tuple, TypedDict, cast
+from typing import Any, Dict, List, Optional, Tuple, TypedDict, cast
 
 from django.utils.translation import gettext_lazy as _
 
@@ -97,3 +97,13 @@ class SamplesStatisticsTable(Table):
         ]
 
         return cls(content)
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    next_cursor: Optional[Any] = None
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
@@ -1,14 +1,26 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from operator import itemgetter
-from typing import Dict, List, Optional, Tuple
+from itertools import islice
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
 
+from django.db.models import Exists, OuterRef, QuerySet
 from django.http import QueryDict
 from loguru import logger
-from pysam import VariantRecord
 
-from .models import SNP, Allele, AllelesRecord, Chromosome, RawVCF, Sample, Variant
+from .metrics import DEFAULT_METRIC
+from .models import (
+    SNP,
+    Allele,
+    AllelesRecord,
+    CallableInterval,
+    Chromosome,
+    RawVCF,
+    Sample,
+    Variant,
+)
 from .types import (
     GenotypesSimilarityTable,
+    KeysetPage,
     SamplesDict,
     SamplesSearchResult,
     SamplesSimilarityTable,
@@ -16,9 +28,13 @@ from .types import (
     VariantDict,
     VariantSimilarity,
 )
+from .vcf_processing import VCFFile, VCFRecord
+
+if TYPE_CHECKING:
+    from pysam import VariantRecord
 
 
-def are_samples_empty(record: VariantRecord) -> bool:
+def are_samples_empty(record: "VariantRecord") -> bool:
     if not record.samples.items():
         logger.warning("No samples detected")
         logger.info("Finishing reading the file")
@@ -26,7 +42,7 @@ def are_samples_empty(record: VariantRecord) -> bool:
     return False
 
 
-def parse_samples(record: VariantRecord, vcf_file: RawVCF) -> Optional[SamplesDict]:
+def parse_samples(record: "VariantRecord", vcf_file: RawVCF) -> Optional[SamplesDict]:
     samples: Optional[SamplesDict] = {}
 
     for sample_name, sample in record.samples.items():
@@ -47,7 +63,7 @@ def parse_samples(record: VariantRecord, vcf_file: RawVCF) -> Optional[SamplesDi
 
 
 def create_snp(
-    chromosome: Chromosome, record: VariantRecord, ref: Allele, alt: Allele
+    chromosome: Chromosome, record: "VariantRecord", ref: Allele, alt: Allele
 ) -> SNP:
     snp, created = SNP.objects.get_or_create(
         chromosome=chromosome,
@@ -68,23 +84,42 @@ def create_snp(
     return snp
 
 
-def create_variants_from_record(record: VariantRecord, snp: SNP, samples: SamplesDict):
+def is_reference_genotype(allele_indices: Tuple[Optional[int], ...]) -> bool:
+    return bool(allele_indices) and all(index == 0 for index in allele_indices)
+
+
+def create_variants_from_record(
+    record: "VariantRecord", snp: SNP, samples: SamplesDict, sparse: bool = False
+):
+    """Save genotypes of `samples` in `record` as variants of `snp`
+
+    :param sparse: whether to skip homozygous reference genotypes
+    """
     for sample_name, sample in record.samples.items():
         if sample_name not in samples:
             continue
+        if sparse and is_reference_genotype(sample.allele_indices):
+            continue
 
         alleles_record: AllelesRecord = AllelesRecord.from_sample(sample)
 
-        sample_db_record = samples[sample_name]
-        variant = Variant.objects.create(
-            alleles_record=alleles_record, snp=snp, sample=sample_db_record
+        alleles = [
+            None if allele is None else Allele.from_str(allele)
+            for allele in sample.alleles
+        ]
+        alleles += [None] * (2 - len(alleles))  # Haploid genotypes have one allele
+
+        Variant.objects.create(
+            alleles_record=alleles_record,
+            snp=snp,
+            chromosome_id=snp.chromosome_id,
+            sample=samples[sample_name],
+            allele_1=alleles[0],
+            allele_2=alleles[1],
         )
 
-        for allele in sample.alleles:
-            variant.alleles.add(Allele.from_str(allele or "."))
-
 
-def is_record_incomplete(record: VariantRecord) -> bool:
+def is_record_incomplete(record: "VariantRecord") -> bool:
     """Check if `record` is missing a required field: e.g chromosome, alleles or position"""
     return any(
         field is None or not field
@@ -92,9 +127,16 @@ def is_record_incomplete(record: VariantRecord) -> bool:
     )
 
 
-def save_record_to_db(record: VariantRecord, samples: SamplesDict):
+def save_record_to_db(
+    record: "VariantRecord", samples: SamplesDict, sparse: bool = False
+) -> Optional[SNP]:
+    """Save SNP of `record` and genotypes of `samples` in it
+
+    :param sparse: whether to skip homozygous reference genotypes
+    :return: SNP of the record or None if the record is incomplete
+    """
     if is_record_incomplete(record):
-        return
+        return None
 
     chromosome: Chromosome = Chromosome.from_record(record)
     reference_allele: Allele = Allele.ref_from_record(record)
@@ -105,61 +147,128 @@ def save_record_to_db(record: VariantRecord, samples: SamplesDict):
         alt=alternative_allele,
         ref=reference_allele,
     )
-    create_variants_from_record(record=record, snp=snp, samples=samples)
+    create_variants_from_record(record=record, snp=snp, samples=samples, sparse=sparse)
+    return snp
 
 
-def get_genotype(allele_1: str, allele_2: str) -> Tuple[Allele]:
-    return Allele.objects.get(genotype=allele_1), Allele.objects.get(genotype=allele_2)
+def add_to_intervals(
+    intervals: List[List[int]], chromosome: int, start: int, end: int, max_gap: int
+):
+    """Extend the last of [chromosome, start, end] `intervals` to `end` or start a new
+    interval if `start` is further than `max_gap` bases from it
 
+    `end` is greater than `start` for records spanning several bases, e.g. reference
+    blocks of gVCF files (the END field)
+    """
+    if intervals:
+        last_chromosome, last_start, last_end = intervals[-1]
+        if last_chromosome == chromosome and last_start <= start <= last_end + max_gap:
+            intervals[-1][2] = max(last_end, end)
+            return
 
-def get_similar_samples_from_snp(snps_formset) -> SamplesSearchResult:
-    similar_samples: Dict[str, float]
-    results: List[SNPSearchResult] = []
-    samples_similarity: Dict[str, float] = defaultdict(float)
+    intervals.append([chromosome, start, end])
 
-    for snp_form in snps_formset:
 
-        genotype: Tuple[Allele] = get_genotype(
-            snp_form["allele_1"].data, snp_form["allele_2"].data
-        )
+def merge_intervals(intervals: Iterable[List[int]], max_gap: int = 0) -> List[List[int]]:
+    """Sort [chromosome, start, end] intervals and join the ones overlapping or closer
+    than `max_gap` bases
+    """
+    merged: List[List[int]] = []
 
-        snps = SNP.objects.filter(
-            chromosome=snp_form["chromosome"].data,
-            position=snp_form["position"].data,
-        )
+    for chromosome, start, end in sorted(intervals):
+        if merged and merged[-1][0] == chromosome and start <= merged[-1][2] + max_gap:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chromosome, start, end])
+
+    return merged
+
+
+def create_callable_intervals(
+    samples: Iterable[Sample], intervals: List[List[int]], max_gap: int = 0
+) -> int:
+    """Save [chromosome, start, end] `intervals` as callable intervals of each sample
+
+    Intervals are merged first, so records of not sorted files don't produce
+    overlapping intervals
+
+    :return: number of created intervals
+    """
+    intervals = merge_intervals(intervals, max_gap=max_gap)
+    created = CallableInterval.objects.bulk_create(
+        [
+            CallableInterval(
+                sample=sample, chromosome_id=chromosome, start=start, end=end
+            )
+            for sample in samples
+            for chromosome, start, end in intervals
+        ],
+        batch_size=1000,
+    )
+    return len(created)
+
+
+def get_similar_samples_from_snp(
+    snps_formset, metric: str = DEFAULT_METRIC
+) -> SamplesSearchResult:
+    """Find samples with genotypes similar to the ones in `snps_formset`
+
+    Similarities are calculated by the database, see `vcf_uploading.similarity`: one
+    query sums them for each sample, and another one returns matching genotypes. Samples
+    are ranked by `metric`, other metrics than the default one are calculated in Python
+
+    :param metric: name of a metric from `vcf_uploading.genotype_metrics.METRICS`
+    """
+    from .genotype_metrics import get_metric
+    from .similarity import (
+        GenotypeQuery,
+        iter_matched_genotypes,
+        score_samples,
+        score_samples_by_metric,
+    )
+
+    genotype_metric = get_metric(metric)
 
-        snp_search_results: List[VariantSimilarity] = []
-
-        for snp in snps:
-            variants = Variant.objects.filter(snp=snp).select_related("sample")
-            for variant in variants:
-                similarity = variant.calculate_similarity(genotype)
-                if similarity > 0:
-                    sample = str(variant.sample)
-                    samples_similarity[sample] += similarity
-                    snp_search_results.append(
-                        VariantSimilarity(
-                            sample=sample,
-                            genotype=variant.get_genotype_string(),
-                            similarity=similarity,
-                        )
-                    )
-
-        snp_search_results.sort(key=itemgetter(2), reverse=True)
-
-        samples = GenotypesSimilarityTable(content=snp_search_results)
-        snp_query = get_snp_from_snp_search_form(snp_form)
-
-        snp_search_result = SNPSearchResult(
-            snp_query=snp_query, similarity_table=samples
+    queries = [
+        GenotypeQuery(
+            chromosome=int(snp_form["chromosome"].data),
+            position=int(snp_form["position"].data),
+            allele_1=snp_form["allele_1"].data,
+            allele_2=snp_form["allele_2"].data,
+        )
+        for snp_form in snps_formset
+    ]
+
+    snps_search_results: Dict[int, List[VariantSimilarity]] = defaultdict(list)
+    for index, sample, allele_1, allele_2, similarity in iter_matched_genotypes(queries):
+        variant = Variant(allele_1_id=allele_1, allele_2_id=allele_2)
+        genotype = variant.get_genotype_string()
+        snps_search_results[index].append(
+            VariantSimilarity(sample=sample, genotype=genotype, similarity=similarity)
         )
-        results.append(snp_search_result)
 
-    for sample in samples_similarity.keys():
-        samples_similarity[sample] = round(samples_similarity[sample] / len(results), 4)
+    results: List[SNPSearchResult] = [
+        SNPSearchResult(
+            snp_query=get_snp_from_snp_search_form(snp_form),
+            similarity_table=GenotypesSimilarityTable(content=snps_search_results[i]),
+        )
+        for i, snp_form in enumerate(snps_formset)
+    ]
+
+    if metric == DEFAULT_METRIC:
+        samples_similarity: Dict[str, float] = {
+            sample: round(score.similarity / len(results), 4)
+            for sample, score in score_samples(queries).items()
+            if score.n_matched_sites
+        }
+    else:
+        samples_similarity = {
+            sample: round(score, 4)
+            for sample, score in score_samples_by_metric(queries, metric).items()
+        }
 
     samples_table = SamplesSimilarityTable(
-        content=sorted(samples_similarity.items(), key=itemgetter(1), reverse=True)
+        content=genotype_metric.sort(samples_similarity)
     )
 
     search_result = SamplesSearchResult(samples=samples_table, snp_queries=results)
@@ -180,17 +289,153 @@ def get_snp_from_snp_search_form(request_dict: QueryDict) -> VariantDict:
     return snp_dict
 
 
-def get_average_similarities(
-        similar_samples: Dict[str, Dict[str, List[float]]]
-) -> Dict[str, Dict[str, float]]:
-    samples_similarity: Dict[str, Dict[str, float]] = {}
+def get_cohort_samples(
+    cyphers: Optional[List[str]] = None, nationality: Optional[str] = None
+) -> QuerySet:
+    """Select samples by their cyphers and/or nationality. All samples are selected by default"""
+    samples = Sample.objects.all()
+
+    if cyphers:
+        samples = samples.filter(cypher__in=cyphers)
+    if nationality:
+        samples = samples.filter(nationality__nationality=nationality)
+
+    return samples.order_by("cypher")
+
+
+def split_into_blocks(iterable: Iterable, block_size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+
+    while True:
+        block = list(islice(iterator, block_size))
+        if not block:
+            return
+        yield block
+
+
+def iter_cohort_vcf_records(
+    samples: QuerySet, cyphers: List[str], block_size: int = 1000
+) -> Iterator[VCFRecord]:
+    """Yield multi-sample VCF records of `samples` sorted by genomic position
+
+    SNPs are read in blocks of `block_size`, and genotypes of all the samples for a block
+    are read with one query. So, memory usage is limited by the block size and doesn't
+    depend on the number of SNPs. Sites, which none of the samples has, are skipped.
+    If a sample has no variant at a site, its genotype is homozygous reference when the
+    site is in a callable interval of the sample, and missing otherwise
+
+    :param samples: queryset of samples to export
+    :param cyphers: cyphers of `samples` in the order of VCF columns
+    :param block_size: number of SNPs processed at once
+    """
+    sample_index = {cypher: i for i, cypher in enumerate(cyphers)}
+
+    callable_intervals = CallableInterval.objects.filter(sample__in=samples)
+    snps = (
+        SNP.objects.filter(
+            Exists(Variant.objects.filter(snp=OuterRef("pk"), sample__in=samples))
+            | Exists(
+                callable_intervals.filter(
+                    chromosome_id=OuterRef("chromosome_id"),
+                    start__lte=OuterRef("position"),
+                    end__gte=OuterRef("position"),
+                )
+            )
+        )
+        .order_by("chromosome_id", "position", "id")
+        .values_list(
+            "id",
+            "chromosome_id",
+            "position",
+            "name",
+            "reference_allele_id",
+            "alternative_allele_id",
+        )
+    )
+
+    for block in split_into_blocks(snps.iterator(chunk_size=block_size), block_size):
+        genotypes: Dict[int, List[str]] = {
+            snp_id: ["./."] * len(cyphers) for snp_id, *_ in block
+        }
+        chromosomes = {chromosome for _, chromosome, *_ in block}
+
+        # Positions and IDs of SNPs of each chromosome, sorted by position
+        block_positions: Dict[int, List[int]] = defaultdict(list)
+        block_snps: Dict[int, List[int]] = defaultdict(list)
+        for snp_id, chromosome, position, *_ in block:
+            block_positions[chromosome].append(position)
+            block_snps[chromosome].append(snp_id)
+
+        intervals = callable_intervals.filter(
+            chromosome_id__in=chromosomes,
+            start__lte=max(position for _, _, position, *_ in block),
+            end__gte=min(position for _, _, position, *_ in block),
+        ).values_list("sample_id", "chromosome_id", "start", "end")
+
+        for cypher, chromosome, start, end in intervals:
+            positions = block_positions[chromosome]
+            for snp_id in block_snps[chromosome][
+                bisect_left(positions, start) : bisect_right(positions, end)
+            ]:
+                genotypes[snp_id][sample_index[cypher]] = AllelesRecord.REFERENCE
+
+        # SNPs are sorted by chromosome, so a block touches one or two partitions
+        variants = Variant.objects.filter(
+            chromosome_id__in=chromosomes,
+            snp_id__in=genotypes.keys(),
+            sample__in=samples,
+        ).values_list("snp_id", "sample_id", "alleles_record_id")
+
+        for snp_id, cypher, alleles_record in variants:
+            genotypes[snp_id][sample_index[cypher]] = alleles_record or "./."
+
+        for snp_id, chromosome, position, name, ref, alt in block:
+            yield VCFRecord(
+                chromosome=Chromosome.NamesMapper.number_to_name(chromosome),
+                position=position,
+                sample=None,
+                sample_indexes="\t".join(genotypes[snp_id]),
+                ref=ref,
+                alts=[alt],
+                id_=name or ".",
+            )
+
+
+def cohort_to_vcf(samples: QuerySet, block_size: int = 1000) -> VCFFile:
+    """Return multi-sample VCF file of `samples`. Its records are read lazily"""
+    cyphers: List[str] = list(samples.values_list("cypher", flat=True))
+
+    return VCFFile(
+        sample=cyphers,
+        records=iter_cohort_vcf_records(samples, cyphers, block_size=block_size),
+    )
+
+
+def keyset_paginate(
+    queryset: QuerySet, key: str, after=None, page_size: int = 50
+) -> KeysetPage:
+    """Return a page of `queryset` ordered by a unique field `key`
+
+    Instead of OFFSET, the page starts right after the item with `key` equal to `after`,
+    so the database reads only `page_size` rows from the index whatever the page number is
 
-    for sample in similar_samples.keys():
-        samples_similarity[sample] = {}
+    :param queryset: queryset to paginate
+    :param key: name of a unique field. Prefix it with "-" for the descending order
+    :param after: value of `key` of the last item of the previous page. None for the first page
+    :param page_size: maximum number of items on the page
+    :return: KeysetPage with items and the cursor of the next page, if there is one
+    """
+    field = key.lstrip("-")
+    queryset = queryset.order_by(key)
 
-    for sample, db_samples_similarities in similar_samples.items():
-        for db_sample, similarities in db_samples_similarities.items():
+    if after is not None and after != "":
+        lookup = "lt" if key.startswith("-") else "gt"
+        queryset = queryset.filter(**{f"{field}__{lookup}": after})
 
-            samples_similarity[sample][db_sample] = round(sum(similarities) / len(similarities), 2)
+    # One extra item tells whether there is a next page without a COUNT query
+    items = list(queryset[: page_size + 1])
+    if len(items) <= page_size:
+        return KeysetPage(items=items)
 
-    return samples_similarity
+    items = items[:page_size]
+    return KeysetPage(items=items, next_cursor=getattr(items[-1], field))
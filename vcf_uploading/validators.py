@@ -1,10 +1,10 @@
 import tempfile
+from pathlib import Path
 
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils.translation import gettext_lazy as _
 from loguru import logger
-from pysam import VariantFile
 
 
 def check_vcf_format(file: InMemoryUploadedFile):
@@ -15,12 +15,19 @@ def check_vcf_format(file: InMemoryUploadedFile):
         logger.info("Saved VCF to the temporary file {}", f.name)
         logger.debug("Is file readable: {}", f.readable())
 
-        try:
-            VariantFile(f.name)
-        except (ValueError, OSError) as e:
-            raise ValidationError(
-                _(
-                    "Reading of the file has failed. Probably, the file has a wrong format"
-                ),
-                code="format.invalid",
-            ) from e
+        check_vcf_path(Path(f.name))
+
+
+def check_vcf_path(path: Path):
+    """Check that file at `path` can be read as VCF/BCF without copying it"""
+    from pysam import VariantFile
+
+    try:
+        VariantFile(str(path)).close()
+    except (ValueError, OSError) as e:
+        raise ValidationError(
+            _(
+                "Reading of the file has failed. Probably, the file has a wrong format"
+            ),
+            code="format.invalid",
+        ) from e
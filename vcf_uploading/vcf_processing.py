@@ -1,5 +1,56 @@
+import re
+import struct
+import zlib
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union
+
+# Maximum size of uncompressed data in one BGZF block, the same as in htslib
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+class Region(NamedTuple):
+    contig: str
+    start: Optional[int] = None  # 0-based, inclusive
+    end: Optional[int] = None  # 0-based, exclusive
+
+    def contig_aliases(self) -> List[str]:
+        """Return possible names of the contig, e.g. "chr1" for "1" and vice versa"""
+        if self.contig.startswith("chr"):
+            return [self.contig, self.contig[len("chr"):]]
+        return [self.contig, f"chr{self.contig}"]
+
+    def contains(self, contig: str, position: int) -> bool:
+        """Check if 1-based `position` on `contig` is in the region"""
+        return (
+            contig in self.contig_aliases()
+            and (self.start is None or position > self.start)
+            and (self.end is None or position <= self.end)
+        )
+
+
+_REGION_PATTERN = re.compile(r"^(?P<contig>[^:]+)(:(?P<start>[\d,]+)?(-(?P<end>[\d,]+))?)?$")
+
+
+def parse_region(region: str) -> Region:
+    """Parse region in samtools format, e.g. "chr1", "chr1:1000" or "chr1:1,000-2,000"
+
+    Positions in `region` are 1-based and inclusive
+
+    :raises ValueError: if `region` has a wrong format
+    """
+    match = _REGION_PATTERN.match(region.strip())
+    if match is None:
+        raise ValueError(f"{region} is not a valid region")
+
+    start = match.group("start")
+    end = match.group("end")
+
+    return Region(
+        contig=match.group("contig"),
+        start=int(start.replace(",", "")) - 1 if start else None,
+        end=int(end.replace(",", "")) if end else None,
+    )
 
 
 class VCFRecord:
@@ -45,16 +96,108 @@ class VCFFile:
     )
     columns = ("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT")
 
-    def __init__(self, sample):
-        self.columns_string = "\t".join(self.columns) + "\t" + sample
-        self.records = []
+    def __init__(
+        self,
+        sample: Union[str, Sequence[str]],
+        records: Optional[Iterable[VCFRecord]] = None,
+    ):
+        """
+        :param sample: name of the sample or names of samples for multi-sample files.
+            In the latter case `sample_indexes` of each record must contain tab-separated
+            genotypes of all the samples
+        :param records: records of the file. Can be a generator, then records are
+            produced only when the file is written and are not kept in memory
+        """
+        samples = [sample] if isinstance(sample, str) else list(sample)
+        self.columns_string = "\t".join(self.columns + tuple(samples))
+        self.records = [] if records is None else records
 
     def add_record(self, record: VCFRecord):
         self.records.append(record)
 
+    def lines(self) -> Iterator[str]:
+        """Yield lines of the file one by one, including the header"""
+        for line in self.header:
+            yield line + "\n"
+
+        yield self.columns_string + "\n"
+
+        for record in self.records:
+            yield str(record) + "\n"
+
     def save(self, file_path: Path):
         with open(file_path, "w") as f:
-            f.write("\n".join(self.header) + "\n")
-            f.write(self.columns_string + "\n")
-            for record in self.records:
-                f.write(str(record) + "\n")
+            f.writelines(self.lines())
+
+
+def encode_lines(lines: Iterable[str], chunk_size: int = BGZF_BLOCK_SIZE) -> Iterator[bytes]:
+    """Encode `lines` and join them into chunks of about `chunk_size` bytes
+
+    Writing many small chunks to a socket or a compressor is much slower than
+    writing a few big ones
+    """
+    chunk: List[bytes] = []
+    current_size = 0
+
+    for line in lines:
+        encoded_line = line.encode()
+        chunk.append(encoded_line)
+        current_size += len(encoded_line)
+
+        if current_size >= chunk_size:
+            yield b"".join(chunk)
+            chunk = []
+            current_size = 0
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+def bgzf_block(data: bytes) -> bytes:
+    """Compress `data` into a single BGZF block
+
+    BGZF is a gzip variant used by htslib (and bgzip tool), which allows random
+    access to the compressed file. Every block is a valid gzip member with an extra
+    field containing the size of the block
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    header_size, footer_size = 18, 8
+    block_size = header_size + len(compressed_data) + footer_size
+
+    header = struct.pack(
+        "<BBBBIBBHBBHH",
+        0x1F, 0x8B,  # gzip ID
+        8,  # compression method: deflate
+        4,  # flags: extra field is present
+        0,  # modification time
+        0,  # extra flags
+        0xFF,  # unknown OS
+        6,  # length of the extra field
+        66, 67,  # "BC" subfield ID
+        2,  # subfield length
+        block_size - 1,
+    )
+    footer = struct.pack("<II", zlib.crc32(data), len(data))
+
+    return header + compressed_data + footer
+
+
+def bgzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compress stream of `chunks` in BGZF format block by block
+
+    Only one block of uncompressed data is kept in memory
+    """
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer.extend(chunk)
+
+        while len(buffer) >= BGZF_BLOCK_SIZE:
+            yield bgzf_block(bytes(buffer[:BGZF_BLOCK_SIZE]))
+            del buffer[:BGZF_BLOCK_SIZE]
+
+    if buffer:
+        yield bgzf_block(bytes(buffer))
+
+    yield BGZF_EOF
@@ -1,14 +1,47 @@
+import re
+from pathlib import Path
 from typing import Dict
 
+from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
 from django.forms import formset_factory
-from django.http import HttpResponse
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render, redirect, get_object_or_404
 from loguru import logger
 
-from .forms import SNPSearchForm, VCFFileForm
-from .models import RawVCF, Sample
+from .forms import (
+    ListFilterForm,
+    SampleFilterForm,
+    SNPSearchForm,
+    VCFFileFilterForm,
+    VCFFileForm,
+)
+from .metrics import DEFAULT_METRIC
+from .models import Profile, RawVCF, Sample
+from .profiling import is_profiling_requested
+from .progress import (
+    PROGRESS_OPERATIONS,
+    get_progress_key,
+    iter_progress_events,
+    parse_since,
+)
 from .types import SamplesSearchResult, SamplesStatisticsTable, SampleStatistics
-from .utils import get_similar_samples_from_snp
+from .utils import (
+    cohort_to_vcf,
+    get_cohort_samples,
+    get_similar_samples_from_snp,
+    keyset_paginate,
+)
+from .vcf_processing import VCFFile, bgzip, encode_lines
+
+_BYTE_RANGE_PATTERN = re.compile(r"^bytes=(?P<start>\d*)-(?P<end>\d*)$")
 
 
 def index(request):
@@ -64,24 +97,230 @@ def vcf_view(
     )
 
 
+def keyset_list_response(
+    request,
+    queryset,
+    filter_form: ListFilterForm,
+    key: str,
+    template: str,
+    serialize,
+    default_page_size: int = 50,
+):
+    """Render a page of `queryset` filtered with `filter_form` and paginated by `key`
+
+    Add `?format=json` to get items serialized with `serialize` instead of HTML. Link
+    to the next page keeps the filters and sets `after` to the last item's key
+    """
+    is_json = request.GET.get("format") == "json"
+
+    if not filter_form.is_valid():
+        logger.warning("Invalid list filters: {}", filter_form.errors)
+        if is_json:
+            return JsonResponse({"errors": filter_form.errors}, status=400)
+        return render(request, template, {"form": filter_form, "items": []}, status=400)
+
+    page = keyset_paginate(
+        filter_form.filter_queryset(queryset),
+        key=key,
+        after=filter_form.cleaned_data["after"],
+        page_size=filter_form.cleaned_data["page_size"] or default_page_size,
+    )
+
+    next_query = None
+    if page.has_next:
+        query = request.GET.copy()
+        query["after"] = page.next_cursor
+        next_query = query.urlencode()
+
+    if is_json:
+        return JsonResponse(
+            {
+                "items": [serialize(item) for item in page.items],
+                "next": page.next_cursor,
+            }
+        )
+
+    return render(
+        request,
+        template,
+        {"form": filter_form, "items": page.items, "next_query": next_query},
+    )
+
+
+def serialize_vcf_file(file: RawVCF) -> dict:
+    return {
+        "id": file.id,
+        "name": file.file.name,
+        "date_created": file.date_created,
+        "saved": file.saved,
+        "n_samples": file.n_samples,
+    }
+
+
 def vcf_files_list(request):
-    files = RawVCF.objects.all()
-    return render(request, "vcf_list.html", {"files": files})
+    return keyset_list_response(
+        request,
+        RawVCF.objects.all(),
+        filter_form=VCFFileFilterForm(request.GET),
+        key="-id",
+        template="vcf_list.html",
+        serialize=serialize_vcf_file,
+    )
 
 
 def vcf_file_download(request, file_id: int):
-    file_object: RawVCF = RawVCF.objects.get(pk=file_id)
-    file = file_object.file
-
-    response = HttpResponse(file.read(), content_type="text/plain")
-    response["Content-Disposition"] = f"attachment; filename={file.name}"
+    """Download uploaded file
+
+    The whole file is sent as is, with support of HTTP Range requests. If `region`
+    (e.g. "chr1:1-1000000") and/or `samples` (comma-separated names) query parameters
+    are given, only matching records and samples are streamed as a plain text VCF
+    """
+    file_object: RawVCF = get_object_or_404(RawVCF, pk=file_id)
+    filename = Path(file_object.file.name).name
+
+    region = request.GET.get("region")
+    samples = [sample for sample in request.GET.get("samples", "").split(",") if sample]
+
+    if region or samples:
+        try:
+            lines = file_object.iter_region_lines(region=region, samples=samples)
+        except FileNotFoundError:
+            raise Http404(f"File {filename} doesn't exist")
+        except ValueError as e:
+            logger.warning("Can't slice file {}: {}", filename, e)
+            return HttpResponseBadRequest(str(e))
+
+        response = StreamingHttpResponse(encode_lines(lines), content_type="text/plain")
+        response["Content-Disposition"] = f"attachment; filename={Path(filename).stem}.slice.vcf"
+        return response
+
+    return ranged_file_response(request, Path(file_object.file.path), filename)
+
+
+def ranged_file_response(request, path: Path, filename: str, chunk_size: int = 2 ** 16):
+    """Send file at `path` as an attachment, supporting a single HTTP byte range
+
+    Requests with several ranges or a syntactically invalid range (e.g. "bytes=5-2") get
+    the whole file, which is required by RFC 7233
+
+    :raises Http404: if the file doesn't exist
+    """
+    try:
+        file_size = path.stat().st_size
+    except FileNotFoundError:
+        raise Http404(f"File {filename} doesn't exist")
+
+    content_type = "text/plain" if filename.endswith(".vcf") else "application/octet-stream"
+    match = _BYTE_RANGE_PATTERN.match(request.headers.get("Range", ""))
+    start = end = None
+    if match is not None:
+        start, end = (
+            int(value) if value else None for value in match.group("start", "end")
+        )
+
+    if (start is None and end is None) or (None not in (start, end) and start > end):
+        response = FileResponse(
+            open(path, "rb"), as_attachment=True, filename=filename, content_type=content_type
+        )
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    if start is None:  # Suffix range, e.g. "bytes=-500" means the last 500 bytes
+        start, end = max(file_size - end, 0), file_size - 1
+    else:
+        end = file_size - 1 if end is None else min(end, file_size - 1)
+
+    if start > end:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{file_size}"
+        return response
+
+    def content():
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    response = StreamingHttpResponse(content(), status=206, content_type=content_type)
+    response["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["Content-Disposition"] = f"attachment; filename={filename}"
 
     return response
 
 
+def serialize_sample(sample: Sample) -> dict:
+    return {
+        "cypher": sample.cypher,
+        "gender": sample.gender,
+        "nationality": str(sample.nationality) if sample.nationality else None,
+        "predicted_nationality": (
+            str(sample.predicted_nationality) if sample.predicted_nationality else None
+        ),
+        "vcf_file": sample.vcf_file_id,
+        "date_uploaded": sample.vcf_file.date_created if sample.vcf_file else None,
+    }
+
+
 def samples_list(request):
-    samples = Sample.objects.all()
-    return render(request, "samples_list.html", {"samples": samples})
+    return keyset_list_response(
+        request,
+        Sample.objects.select_related("nationality", "predicted_nationality", "vcf_file"),
+        filter_form=SampleFilterForm(request.GET),
+        key="cypher",
+        template="samples_list.html",
+        serialize=serialize_sample,
+    )
+
+
+def vcf_streaming_response(
+    vcf: VCFFile, name: str, compress: bool = False
+) -> StreamingHttpResponse:
+    """Stream `vcf` as a downloadable file `name`.vcf or, if `compress` is True, `name`.vcf.gz"""
+    content = encode_lines(vcf.lines())
+
+    if compress:
+        response = StreamingHttpResponse(bgzip(content), content_type="application/gzip")
+        filename = f"{name}.vcf.gz"
+    else:
+        response = StreamingHttpResponse(content, content_type="text/plain")
+        filename = f"{name}.vcf"
+
+    response["Content-Disposition"] = f"attachment; filename={filename}"
+
+    return response
+
+
+def sample_vcf_download(request, cypher: str):
+    """Stream VCF file of a sample from the database. Add `?bgzip=1` to get it compressed"""
+    sample: Sample = get_object_or_404(Sample, pk=cypher)
+    return vcf_streaming_response(
+        sample.to_vcf(), name=sample.cypher, compress=bool(request.GET.get("bgzip"))
+    )
+
+
+def cohort_vcf_download(request):
+    """Stream multi-sample VCF file of samples from the database
+
+    Query parameters:
+    * samples — comma-separated cyphers of samples. All samples are exported by default
+    * nationality — export only samples of this nationality
+    * bgzip — compress the file if set
+    """
+    cyphers = [cypher for cypher in request.GET.get("samples", "").split(",") if cypher]
+    samples = get_cohort_samples(
+        cyphers=cyphers, nationality=request.GET.get("nationality")
+    )
+
+    return vcf_streaming_response(
+        cohort_to_vcf(samples), name="cohort", compress=bool(request.GET.get("bgzip"))
+    )
 
 
 def snp_search_form(
@@ -90,15 +329,28 @@ def snp_search_form(
     form_template="snp_search.html",
     result_template="snp_search_result.html",
 ):
+    """Search samples by SNPs. Samples are ranked by the "metric" query parameter, see
+    `find_similar_samples_in_db`
+    """
+    from .genotype_metrics import get_metric
+
     formset_class = formset_factory(form_class)
 
+    metric = request.GET.get("metric", DEFAULT_METRIC)
+    try:
+        get_metric(metric)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
     if request.method == "POST":
         logger.info("{} received a POST request", snp_search_form.__name__)
         formset = formset_class(request.POST)
 
         if formset.is_valid():
             logger.success("Formset is valid, returning success")
-            samples: SamplesSearchResult = get_similar_samples_from_snp(formset)
+            samples: SamplesSearchResult = get_similar_samples_from_snp(
+                formset, metric=metric
+            )
             return render(request, result_template, {"result": samples})
 
         else:
@@ -112,17 +364,17 @@ def snp_search_form(
 
 def save_vcf(request, file_id: int):
     vcf: RawVCF = get_object_or_404(RawVCF, pk=file_id)
-    vcf.save_samples_to_db()
+    vcf.save_samples_to_db(profile=is_profiling_requested(request))
     return redirect("vcf_view", file_id=vcf.pk)
 
 
-def predict_nationality_from_vcf(
+async def predict_nationality_from_vcf(
         request,
         file_id: int,
         result_template="nationality_prediction_result.html"
 ):
-    vcf: RawVCF = get_object_or_404(RawVCF, pk=file_id)
-    nationalities_prediction: Dict[str, Dict[str, float]] = vcf.predict_nationality()
+    vcf: RawVCF = await sync_to_async(get_object_or_404)(RawVCF, pk=file_id)
+    nationalities_prediction: Dict[str, Dict[str, float]] = await vcf.apredict_nationality()
 
     return render(
         request,
@@ -136,7 +388,60 @@ def find_similar_samples_in_db(
         file_id: int,
         result_template="similar_samples.html"
 ):
+    """Show similarities of samples of the file to samples in the database
+
+    Query parameters:
+    * metric — name of a metric from `vcf_uploading.genotype_metrics.METRICS`.
+      By default it is "identity"
+    """
+    from .genotype_metrics import get_metric
+
     logger.info("{} receined a request", find_similar_samples_in_db.__name__)
     vcf: RawVCF = get_object_or_404(RawVCF, pk=file_id)
-    similar_samples: Dict[str, Dict[str, float]] = vcf.find_similar_samples_in_db()
-    return render(request, result_template, {"similar_samples": similar_samples})
+
+    metric = request.GET.get("metric", DEFAULT_METRIC)
+    try:
+        get_metric(metric)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    similar_samples: Dict[str, Dict[str, float]] = vcf.find_similar_samples_in_db(
+        metric=metric, profile=is_profiling_requested(request)
+    )
+    return render(
+        request, result_template, {"similar_samples": similar_samples, "metric": metric}
+    )
+
+
+def progress_events(request, file_id: int, operation: str):
+    """Stream progress of `operation` with the file as server-sent events
+
+    Operations started before the "since" query parameter (a timestamp) are ignored.
+    Under ASGI this URL is served by `vcf_uploading.progress.ProgressEventsApp`, which
+    doesn't occupy a thread for each connection. This view is used under WSGI
+    """
+    if operation not in PROGRESS_OPERATIONS:
+        raise Http404(f"Unknown operation {operation}")
+
+    since = parse_since(dict(request.GET.lists()))
+    response = StreamingHttpResponse(
+        iter_progress_events(get_progress_key(file_id, operation), since=since),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@staff_member_required
+def profile_download(request, profile_id: int, kind: str):
+    """Download pstats (`kind` is "pstats") or collapsed stacks ("collapsed") of a profile"""
+    profile: Profile = get_object_or_404(Profile, pk=profile_id)
+    files = {"pstats": profile.pstats_file, "collapsed": profile.collapsed_stacks_file}
+
+    if kind not in files or not files[kind]:
+        raise Http404(f"Profile has no {kind} file")
+
+    return FileResponse(
+        files[kind].open("rb"), as_attachment=True, filename=Path(files[kind].name).name
+    )